@@ -0,0 +1,104 @@
+import atexit
+import threading
+import time
+
+# Seconds without further changes after which pending changes are written
+DEFAULT_QUIET_PERIOD = 2.0
+
+# Longest time (in seconds) a change waits to be written while changes keep coming
+DEFAULT_MAX_DELAY = 10.0
+
+
+class AutosaveScheduler:
+    # Debounced background writer. Changes only mark the library dirty; a thread
+    # calls `flush` once no change has come in for `quiet_period` seconds, or once
+    # the oldest unwritten change is `max_delay` seconds old, so a burst of changes
+    # costs one write. Pending changes are also written when the process exits
+    def __init__(self, flush, quiet_period=DEFAULT_QUIET_PERIOD, max_delay=DEFAULT_MAX_DELAY):
+        self.quiet_period = quiet_period
+        self.max_delay = max_delay
+        # Wall-clock time of the last successful write, or None before the first one
+        self.last_flush = None
+        # The exception raised by the last write, if it failed
+        self.last_error = None
+        self.flush_count = 0
+        self._flush = flush
+        self._pending = 0
+        self._first_change = None
+        self._last_change = None
+        self._closed = False
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="library-autosave", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    # Number of changes made since the last write
+    @property
+    def pending_changes(self):
+        return self._pending
+
+    @property
+    def dirty(self):
+        return self._pending > 0
+
+    def mark_dirty(self):
+        with self._condition:
+            now = time.monotonic()
+            if self._first_change is None:
+                self._first_change = now
+            self._last_change = now
+            self._pending += 1
+            self._condition.notify()
+
+    # Monotonic time at which the pending changes are due, or None when there are none
+    def _due(self):
+        if self._first_change is None:
+            return None
+        return min(self._last_change + self.quiet_period, self._first_change + self.max_delay)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._closed:
+                    due = self._due()
+                    if due is not None and due <= time.monotonic():
+                        break
+                    self._condition.wait(None if due is None else due - time.monotonic())
+                if self._closed:
+                    return
+            self.flush()
+
+    # Write pending changes now. Returns False if the write failed; the changes then
+    # stay pending and are retried after the quiet period
+    def flush(self):
+        with self._flush_lock:
+            with self._condition:
+                pending = self._pending
+                self._pending = 0
+                self._first_change = self._last_change = None
+            if not pending:
+                return True
+            try:
+                self._flush()
+            except Exception as e:
+                self.last_error = e
+                with self._condition:
+                    self._pending += pending
+                    self._first_change = self._last_change = time.monotonic()
+                    self._condition.notify()
+                return False
+            self.last_error = None
+            self.last_flush = time.time()
+            self.flush_count += 1
+            return True
+
+    # Stop the background thread and write whatever is still pending
+    def close(self):
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+        self.flush()
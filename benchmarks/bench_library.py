@@ -0,0 +1,294 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+# The benchmarks import the app's modules from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import library_engine
+from library_store import LibraryStore
+
+DEFAULT_SIZES = [10_000, 100_000]
+
+GENRES = ["Fiction", "Fantasy", "Science Fiction", "Mystery", "Biography", "History", "Romance",
+          "Thriller", "Poetry", "Philosophy", "Horror", "Travel", "Cooking", "Art", ""]
+
+WORDS = ["the", "of", "night", "river", "house", "shadow", "garden", "winter", "ring", "sea",
+         "empire", "silent", "glass", "city", "fire", "stone", "letters", "storm", "island", "road",
+         "journey", "machine", "queen", "memory", "forest", "clock", "mirror", "wolf", "light", "star"]
+
+FIRST_NAMES = ["Ada", "Ben", "Clara", "David", "Elena", "Frank", "Grace", "Hugo", "Iris", "Jon",
+               "Kara", "Leo", "Mona", "Nils", "Olga", "Paul", "Rosa", "Sam", "Tara", "Umar"]
+
+
+# Function to build Zipf-style weights: the k-th most common value gets weight 1 / k^skew
+def zipf_weights(count, skew):
+    return [1 / (rank ** skew) for rank in range(1, count + 1)]
+
+
+# Function to generate `count` synthetic books. `genre_skew` and `author_skew` are
+# Zipf exponents: 0 spreads books evenly, larger values pile them onto a few names
+def generate_books(count, rng, genre_skew=1.0, author_skew=1.1, authors=None):
+    authors = authors or max(count // 20, 1)
+    author_names = [f"{rng.choice(FIRST_NAMES)} {rng.choice(WORDS).title()}son {index}" for index in range(authors)]
+    genres = rng.choices(GENRES, weights=zipf_weights(len(GENRES), genre_skew), k=count)
+    book_authors = rng.choices(author_names, weights=zipf_weights(authors, author_skew), k=count)
+    max_year = datetime.now().year
+    books = []
+    for index in range(count):
+        title = " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 5))).title()
+        books.append({
+            "title": f"{title} {index}",
+            "author": book_authors[index],
+            "year": rng.randint(1800, max_year),
+            "genre": genres[index],
+            "read": rng.random() < 0.4,
+        })
+    return books
+
+
+def open_backend(backend, directory):
+    return library_engine.open_backend(backend, os.path.join(directory, "library.json"),
+                                       os.path.join(directory, "library.db"))
+
+
+# Function to get the `fraction` percentile of sorted samples, interpolating between ranks
+def percentile(samples, fraction):
+    position = (len(samples) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(samples) - 1)
+    return samples[lower] + (samples[upper] - samples[lower]) * (position - lower)
+
+
+# Function to time `run` over `repeat` samples. `setup` runs untimed before every
+# sample and its result is passed to `run`; `run` returns the number of items it
+# processed, which the throughput is computed from. One extra, untimed sample runs
+# under tracemalloc to measure the peak memory of the operation
+def measure(name, size, run, repeat, setup=None):
+    timings = []
+    items = 0
+    for _ in range(repeat):
+        argument = setup() if setup is not None else None
+        start = time.perf_counter()
+        items += run(argument)
+        timings.append(time.perf_counter() - start)
+    argument = setup() if setup is not None else None
+    tracemalloc.start()
+    try:
+        run(argument)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    timings.sort()
+    total = sum(timings)
+    result = {
+        "size": size,
+        "operation": name,
+        "samples": repeat,
+        "items": items,
+        "mean_s": total / repeat,
+        "p50_s": percentile(timings, 0.50),
+        "p95_s": percentile(timings, 0.95),
+        "p99_s": percentile(timings, 0.99),
+        "max_s": timings[-1],
+        "throughput_per_s": items / total if total else None,
+        "peak_memory_bytes": peak_memory,
+    }
+    print(f"{size:>9} {name:<24} p50 {result['p50_s'] * 1000:10.3f} ms   p99 {result['p99_s'] * 1000:10.3f} ms"
+          f"   peak {peak_memory / 1e6:9.1f} MB", file=sys.stderr)
+    return result
+
+
+# Function to time `run` once more over `arguments` (one sample each) after every
+# one of them ran once untimed, so the results are served from the query cache
+def measure_warm(name, size, run, arguments):
+    for argument in arguments:
+        run(argument)
+    cycle = itertools.cycle(arguments)
+    return measure(name, size, run, len(arguments), setup=lambda: next(cycle))
+
+
+# Function to run every benchmark against a library of `size` books
+def bench_size(size, args):
+    rng = random.Random(args.seed)
+    books = generate_books(size, rng, args.genre_skew, args.author_skew, args.authors)
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        store = LibraryStore(open_backend(args.backend, directory))
+        store.load()
+        store.add_many(books)
+        store.save()
+        store.backend.close()
+        del books
+
+        def load(_):
+            fresh = LibraryStore(open_backend(args.backend, directory))
+            fresh.load()
+            fresh.backend.close()
+            return size
+
+        # load_library in main.py: parse the file and build every index
+        results.append(measure("load", size, load, args.heavy_repeat))
+
+        store = LibraryStore(open_backend(args.backend, directory))
+        store.load()
+        library = store.view()
+        ids = library.ids()
+        queries = [rng.choice(WORDS) for _ in range(args.repeat)] + [rng.choice(WORDS)[:2] for _ in range(args.repeat)]
+
+        def cold(setup):
+            # Query-style samples repeat arguments; the cache is emptied (untimed) before
+            # each one, so these numbers measure the indexes rather than cache hits
+            def cold_setup():
+                store.query_cache.clear()
+                return setup()
+            return cold_setup
+
+        def save(_):
+            store.save()
+            return size
+
+        # save_library in main.py: write a full snapshot
+        results.append(measure("save", size, save, args.heavy_repeat))
+
+        def basic_search(query):
+            # Search Books > Basic Search: title match, count plus the first page
+            cursor = library.cursor(title=query)
+            cursor.page(0, 10)
+            return 1
+
+        query_iter = itertools.cycle(queries)
+        results.append(measure("basic_search", size, basic_search, len(queries),
+                               setup=cold(lambda: next(query_iter))))
+        # The same searches again when a rerun finds them cached
+        results.append(measure_warm("basic_search_warm", size, basic_search, queries))
+
+        genres = library.genres()
+
+        def advanced_criteria():
+            start = rng.randint(1800, 1990)
+            return {
+                "title": rng.choice(WORDS),
+                "genre": rng.choice(genres),
+                "read": rng.random() < 0.5,
+                "year_range": (start, start + rng.randint(10, 100)),
+            }
+
+        def advanced_search(criteria):
+            # Search Books > Advanced Search: every criterion set
+            cursor = library.cursor(**criteria)
+            cursor.page(0, 10)
+            return 1
+
+        results.append(measure("advanced_search", size, advanced_search, args.repeat,
+                               setup=cold(advanced_criteria)))
+
+        def view_options():
+            return (rng.sample(genres, min(3, len(genres))), rng.choice([True, False]),
+                    rng.choice(["title", "author", "year", "genre"]), rng.choice([True, False]))
+
+        def view_library(options):
+            # View Library: the frame sorted and filtered by genre and read status
+            selected_genres, read, sort_col, ascending = options
+            library.frame(sort_by=sort_col, descending=not ascending, genres=selected_genres, read=read)
+            return 1
+
+        results.append(measure("view_library", size, view_library, args.repeat, setup=cold(view_options)))
+        results.append(measure_warm("view_library_warm", size, view_library,
+                                    [view_options() for _ in range(args.repeat)]))
+
+        def change_one_book():
+            book = library.get(rng.choice(ids))
+            store.update(book["id"], {"read": not book["read"]})
+
+        def frame_rebuild(_):
+            # View Library right after a change: the frame is rebuilt from the columns
+            library.frame()
+            return 1
+
+        results.append(measure("frame_rebuild", size, frame_rebuild, args.repeat, setup=change_one_book))
+
+        def bulk_selection():
+            return library.cursor(genre=rng.choice(genres)).ids()
+
+        def bulk_remove(book_ids):
+            # Remove Book > Bulk Remove by genre; the books are put back afterwards
+            removed = store.remove(book_ids)
+            store.add_many(removed)
+            return len(removed)
+
+        results.append(measure("bulk_remove_and_restore", size, bulk_remove, args.heavy_repeat,
+                               setup=bulk_selection))
+
+        def statistics(_):
+            library.statistics()
+            return 1
+
+        results.append(measure("statistics", size, statistics, args.repeat))
+        store.backend.close()
+    return results
+
+
+# Function to print how each operation's p50 moved against an earlier report
+def compare(results, baseline_path):
+    with open(baseline_path) as file:
+        baseline = {(row["size"], row["operation"]): row for row in json.load(file)["results"]}
+    for row in results:
+        old = baseline.get((row["size"], row["operation"]))
+        if old is None or not old["p50_s"]:
+            continue
+        change = (row["p50_s"] - old["p50_s"]) / old["p50_s"] * 100
+        print(f"{row['size']:>9} {row['operation']:<24} p50 {change:+7.1f}%", file=sys.stderr)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the library store on synthetic libraries")
+    parser.add_argument("--sizes", default=",".join(str(size) for size in DEFAULT_SIZES),
+                        help="comma-separated library sizes, e.g. 10000,100000,1000000")
+    parser.add_argument("--backend", choices=["json", "sqlite"], default="json")
+    parser.add_argument("--genre-skew", type=float, default=1.0, help="Zipf exponent of the genre distribution")
+    parser.add_argument("--author-skew", type=float, default=1.1, help="Zipf exponent of the author distribution")
+    parser.add_argument("--authors", type=int, default=None, help="number of distinct authors (default: size / 20)")
+    parser.add_argument("--repeat", type=int, default=50, help="samples per query-style operation")
+    parser.add_argument("--heavy-repeat", type=int, default=5, help="samples for load, save and bulk removal")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--compare", help="earlier JSON report to compare p50 latencies against")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+    results = []
+    for size in sizes:
+        results.extend(bench_size(size, args))
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "arguments": vars(args),
+        },
+        "results": results,
+    }
+    if args.compare:
+        compare(results, args.compare)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import sys
+from collections.abc import Mapping
+
+# Fields every book has, in the order they are saved
+FIELDS = ("id", "title", "author", "year", "genre", "read")
+
+_FIELD_SET = frozenset(FIELDS)
+
+# One int object per publication year, handed out by Book.year so the indexes
+# holding a year share it instead of each keeping its own copy
+_YEARS = {}
+
+
+def _intern(value):
+    return sys.intern(value) if type(value) is str else value
+
+
+class Book(Mapping):
+    # Compact, read-only book record. Fields live in slots instead of a per-book
+    # dict, authors and genres are interned so repeated names share one string,
+    # and the read flag is packed into the low bit of the year. It behaves like
+    # the dicts books used to be (book["title"], book.get("genre"), dict(book)),
+    # and changes make a new record through `replace`.
+    # Fields other than the standard ones are kept in a small dict, `_extra`
+    __slots__ = ("id", "title", "author", "genre", "_year_read", "_extra")
+
+    def __init__(self, id, title, author, year, genre="", read=False, extra=None):
+        self.id = id
+        self.title = title
+        self.author = _intern(author)
+        self.genre = _intern(genre)
+        self._year_read = (int(year) << 1) | bool(read)
+        self._extra = extra or None
+
+    @property
+    def year(self):
+        year = self._year_read >> 1
+        return _YEARS.setdefault(year, year)
+
+    @property
+    def read(self):
+        return bool(self._year_read & 1)
+
+    # Build a record from a book dict (or return `book` unchanged if it already is one)
+    @classmethod
+    def from_mapping(cls, book):
+        if isinstance(book, cls):
+            return book
+        extra = None
+        if not book.keys() <= _FIELD_SET:
+            extra = {key: value for key, value in book.items() if key not in _FIELD_SET}
+        return cls(book.get("id"), book["title"], book["author"], book["year"],
+                   book.get("genre") or "", book.get("read", False), extra)
+
+    # Copy of this record with `fields` changed
+    def replace(self, **fields):
+        return Book.from_mapping({**self.to_dict(), **fields})
+
+    # Plain dict of the record, as saved to disk
+    def to_dict(self):
+        book = {
+            "id": self.id,
+            "title": self.title,
+            "author": self.author,
+            "year": self.year,
+            "genre": self.genre,
+            "read": self.read,
+        }
+        if self._extra:
+            book.update(self._extra)
+        return book
+
+    def __getitem__(self, key):
+        if key in _FIELD_SET:
+            return getattr(self, key)
+        if self._extra and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __iter__(self):
+        yield from FIELDS
+        if self._extra:
+            yield from self._extra
+
+    def __len__(self):
+        return len(FIELDS) + (len(self._extra) if self._extra else 0)
+
+    def __repr__(self):
+        return f"Book({self.to_dict()!r})"
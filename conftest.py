@@ -0,0 +1,2 @@
+# The app's modules live at the top of the repository, beside main.py. Having this
+# file here puts that directory on sys.path, so `pytest` runs from anywhere
@@ -0,0 +1,200 @@
+import re
+import unicodedata
+from itertools import islice
+
+from search_index import add_posting, default_max_distance, osa_distance, posting_ids, remove_posting
+
+# Leading words dropped from a title before comparing it
+TITLE_ARTICLES = frozenset(("the", "a", "an"))
+
+# Books by the same author checked for a similar title when one book is checked
+MAX_AUTHOR_CANDIDATES = 500
+
+# Typos two titles may differ by and still count as the same book
+MAX_TITLE_TYPOS = 2
+
+# Books a book is compared with in each sorted order by the library-wide search
+WINDOW = 3
+
+_PUNCTUATION = re.compile(r"[^\w\s]|_")
+_NUMBERS = re.compile(r"\d+")
+
+
+def _words(text):
+    text = str(text)
+    if not text.isascii():
+        # Compare letters without their accents
+        text = "".join(char for char in unicodedata.normalize("NFKD", text) if not unicodedata.combining(char))
+    return _PUNCTUATION.sub(" ", text.casefold()).split()
+
+
+# Function to normalize a title for duplicate checks: case, accents, punctuation,
+# spacing and a leading article do not count
+def normalize_title(title):
+    words = _words(title)
+    if len(words) > 1 and words[0] in TITLE_ARTICLES:
+        del words[0]
+    return " ".join(words)
+
+
+# Function to normalize an author for duplicate checks: like titles, and the order
+# of the names does not count either ("Tolkien, J.R.R." is "J. R. R. Tolkien")
+def normalize_author(author):
+    return " ".join(sorted(_words(author)))
+
+
+# Function to get the (title, author) key two books are exact duplicates under
+def duplicate_key(book):
+    return normalize_title(book["title"]), normalize_author(book["author"])
+
+
+# Function to tell whether two normalized titles are close enough to be the same
+# book: word for word the same, except for typos (search_index.default_max_distance
+# per word, at most MAX_TITLE_TYPOS in all) or a missing space. Short words and numbers have to match,
+# so "of the sea" and "of the sky", or volume 1 and volume 2, stay apart
+def similar_titles(title, other):
+    if title == other:
+        return True
+    words, other_words = title.split(), other.split()
+    if not -MAX_TITLE_TYPOS <= len(title) - len(other) <= MAX_TITLE_TYPOS:
+        return False
+    if len(words) != len(other_words):
+        # Only a missing or extra space
+        return "".join(words) == "".join(other_words)
+    typos = 0
+    for word, other_word in zip(words, other_words):
+        if word == other_word:
+            continue
+        limit = default_max_distance(word if len(word) < len(other_word) else other_word)
+        if not limit or not word.isalpha() or not other_word.isalpha():
+            return False
+        typos += osa_distance(word, other_word, limit)
+        if typos > MAX_TITLE_TYPOS:
+            return False
+    return True
+
+
+class DuplicateIndex:
+    # Maps the hash of every book's duplicate key, and of its normalized author, to
+    # the books having it, so checking one book for duplicates is a dictionary
+    # lookup plus a look at a bounded number of the author's books. Only hashes are
+    # kept; candidates are confirmed against the books themselves. Like
+    # indexes.SortedIndex, adds are buffered and indexed on the next lookup or
+    # removal; the store settles a load's books on its loader thread
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._exact = {}
+        self._authors = {}
+        self._pending = []
+
+    def add(self, book):
+        self._pending.append(book)
+
+    def settle(self):
+        pending, self._pending = self._pending, []
+        for book in pending:
+            title, author = duplicate_key(book)
+            add_posting(self._exact, hash((title, author)), book["id"])
+            add_posting(self._authors, hash(author), book["id"])
+
+    def remove(self, book):
+        self.settle()
+        title, author = duplicate_key(book)
+        remove_posting(self._exact, hash((title, author)), book["id"])
+        remove_posting(self._authors, hash(author), book["id"])
+
+    # Books of `books` (the ID-to-book dict) that `book` may duplicate, as
+    # (book, exact) pairs: exact duplicates, then books by the same author with a
+    # similar title when `near` is set. `book` itself is left out
+    def find(self, book, books, near=True):
+        self.settle()
+        title, author = duplicate_key(book)
+        matches = {}
+        for book_id in posting_ids(self._exact, hash((title, author))):
+            other = books.get(book_id)
+            if other is not None and book_id != book.get("id") and duplicate_key(other) == (title, author):
+                matches[book_id] = (other, True)
+        if near:
+            candidates = posting_ids(self._authors, hash(author))
+            for book_id in islice(candidates, MAX_AUTHOR_CANDIDATES):
+                other = books.get(book_id)
+                if other is None or book_id in matches or book_id == book.get("id"):
+                    continue
+                other_title, other_author = duplicate_key(other)
+                if other_author == author and similar_titles(title, other_title):
+                    matches[book_id] = (other, False)
+        return list(matches.values())
+
+
+# Function to group `books` (an iterable of books) into duplicates: the same
+# normalized title and author, or the same author and similar titles. Exact keys
+# are grouped by hashing; similar titles by sorted neighbourhoods, sorting the
+# books by author and title (and again by author and reversed title, so a typo
+# at either end of a title still leaves the two close) and comparing each book
+# with the next WINDOW books by the same author and with the same first (last)
+# letter. Matches are joined with a
+# union-find, so the whole search is O(n log n). Returns lists of book IDs with
+# more than one book, each in the order `books` listed them
+def duplicate_groups(books, near=True):
+    books = list(books)
+    keys = [duplicate_key(book) for book in books]
+    parent = list(range(len(books)))
+
+    def find(position):
+        while parent[position] != position:
+            parent[position] = parent[parent[position]]
+            position = parent[position]
+        return position
+
+    def union(position, other):
+        root, other_root = find(position), find(other)
+        if root != other_root:
+            # The root stays the earliest book, which keeps the groups in order
+            parent[max(root, other_root)] = min(root, other_root)
+
+    first = {}
+    for position, key in enumerate(keys):
+        earlier = first.setdefault(key, position)
+        if earlier != position:
+            union(position, earlier)
+    if near:
+        for reverse in (False, True):
+            if reverse:
+                sort_keys = [(author, title[::-1]) for title, author in keys]
+                edge = slice(-1, None)
+            else:
+                sort_keys = [(author, title) for title, author in keys]
+                edge = slice(0, 1)
+            order = sorted(range(len(keys)), key=sort_keys.__getitem__)
+            del sort_keys
+            for rank, position in enumerate(order):
+                title, author = keys[position]
+                for other in order[rank + 1:rank + 1 + WINDOW]:
+                    other_title, other_author = keys[other]
+                    # A typo leaves the first letter (or, for the reverse order, the
+                    # last letter) alone, and neighbours past a different one differ too
+                    if other_author != author or other_title[edge] != title[edge]:
+                        break
+                    if title != other_title and similar_titles(title, other_title):
+                        union(position, other)
+    groups = {}
+    for position in range(len(books)):
+        groups.setdefault(find(position), []).append(books[position]["id"])
+    return [ids for ids in groups.values() if len(ids) > 1]
+
+
+# Function to merge a group of duplicate books into the first one: it is read if
+# any of them is, and fields it lacks (genre, enriched metadata) are taken from
+# the others. Returns the fields the first book has to change, possibly none
+def merged_fields(books):
+    survivor, others = books[0], books[1:]
+    fields = {}
+    if not survivor["read"] and any(book["read"] for book in others):
+        fields["read"] = True
+    for book in others:
+        for name, value in book.items():
+            if value not in (None, "") and not survivor.get(name) and name not in fields and name != "read":
+                fields[name] = value
+    return fields
@@ -0,0 +1,328 @@
+import json
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import instrumentation
+from library_io import format_from_name, iter_rows
+
+# Fields filled in when a run is not told which ones to fill
+DEFAULT_FIELDS = ("genre",)
+
+# Fields that identify a book and are never taken from a provider
+PROTECTED_FIELDS = frozenset(("id", "title", "author", "year", "read"))
+
+# Lookups running at once, unless the provider allows fewer
+DEFAULT_WORKERS = 4
+
+# Attempts after the first one before a failing batch is given up on
+MAX_RETRIES = 3
+
+# Seconds waited before the first retry; doubled for every further one
+RETRY_BACKOFF = 0.5
+
+# Enriched books written back to the library per storage write
+WRITE_BATCH_SIZE = 1000
+
+# Seconds a cached provider answer stays valid
+DEFAULT_CACHE_TTL = 30 * 24 * 3600
+
+# Keys looked up in the response cache per query (SQLite limits query parameters)
+CACHE_QUERY_SIZE = 500
+
+
+# Raised by a provider for failures worth retrying (timeouts, rate limits, server
+# errors). `retry_after`, if known, is the number of seconds to wait first
+class ProviderError(Exception):
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+# Function to get the key a book is looked up under: its title and author, lowercased
+def lookup_key(book):
+    return (str(book["title"]).strip().casefold(), str(book["author"]).strip().casefold())
+
+
+class MetadataProvider:
+    # Source of book metadata for an EnrichmentPipeline. `lookup` gets a list of
+    # lookup keys and returns {key: fields} for the books it knows, where fields is
+    # a dict such as {"genre": "Fantasy"}; keys it leaves out count as not found.
+    # It is called from worker threads, at most `max_concurrency` calls at a time
+    # and with at most `batch_size` keys per call, and should raise ProviderError
+    # for failures worth retrying
+    name = "provider"
+    batch_size = 50
+    max_concurrency = DEFAULT_WORKERS
+
+    def lookup(self, keys):
+        raise NotImplementedError
+
+
+class DatasetProvider(MetadataProvider):
+    # Offline provider answering from a CSV, JSON Lines or Parquet file with title
+    # and author columns plus the metadata columns to fill in (genre, isbn, ...).
+    # The file is read on the first lookup, so creating one costs nothing
+    batch_size = 500
+
+    def __init__(self, path, fmt=None, name=None):
+        self.path = path
+        self.fmt = fmt or format_from_name(path)
+        self.name = name or f"dataset:{path}"
+        self._records = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        records = {}
+        with open(self.path, "rb") as file:
+            for row in iter_rows(file, self.fmt):
+                if not row.get("title") or not row.get("author"):
+                    continue
+                fields = {name: value for name, value in row.items()
+                          if name not in PROTECTED_FIELDS and value not in (None, "")}
+                records.setdefault(lookup_key(row), {}).update(fields)
+        return records
+
+    def lookup(self, keys):
+        with self._lock:
+            if self._records is None:
+                self._records = self._load()
+        return {key: self._records[key] for key in keys if key in self._records}
+
+
+class ResponseCache:
+    # Provider answers kept in an SQLite file, per provider name and lookup key,
+    # so a rerun (or another process) does not ask again for `ttl` seconds.
+    # "Not found" answers are cached too, as None
+    def __init__(self, path, ttl=DEFAULT_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses (provider TEXT NOT NULL, key TEXT NOT NULL, "
+            "fields TEXT, fetched_at REAL NOT NULL, PRIMARY KEY (provider, key))")
+
+    # Fresh answers for `keys` as {key: fields or None}; keys without one are left out
+    def get_many(self, provider, keys):
+        texts = {json.dumps(key): key for key in keys}
+        ordered = list(texts)
+        found = {}
+        with self._lock:
+            for start in range(0, len(ordered), CACHE_QUERY_SIZE):
+                chunk = ordered[start:start + CACHE_QUERY_SIZE]
+                rows = self._connection.execute(
+                    f"SELECT key, fields FROM responses WHERE provider = ? AND fetched_at >= ? "
+                    f"AND key IN ({', '.join('?' * len(chunk))})",
+                    [provider, time.time() - self.ttl, *chunk])
+                for text, fields in rows:
+                    found[texts[text]] = json.loads(fields) if fields is not None else None
+        return found
+
+    # Store answers given as {key: fields or None}
+    def put_many(self, provider, answers):
+        now = time.time()
+        rows = [(provider, json.dumps(key), json.dumps(fields) if fields else None, now)
+                for key, fields in answers.items()]
+        with self._lock, self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", rows)
+
+    # Delete expired answers. Returns the number deleted
+    def purge(self):
+        with self._lock, self._connection:
+            return self._connection.execute("DELETE FROM responses WHERE fetched_at < ?",
+                                            (time.time() - self.ttl,)).rowcount
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class EnrichmentPipeline:
+    # Fills in missing metadata of a LibraryStore's books from a MetadataProvider
+    # in the background, so the caller (the Streamlit script) never waits for it.
+    # A runner thread walks the books in provider-sized batches of lookup keys
+    # (books sharing a title and author are looked up once): keys answered by the
+    # ResponseCache are used at once, the rest go to a pool of at most `workers`
+    # threads, and a failing batch is retried with exponential backoff before it
+    # is given up on. Answers are written back through LibraryStore.update_many
+    # every `write_batch_size` books. Only fields a book still lacks when its
+    # answer is written are filled in, unless `overwrite` is set; `fields` of
+    # None takes every field the provider returns
+    def __init__(self, store, provider, cache=None, fields=DEFAULT_FIELDS, workers=DEFAULT_WORKERS,
+                 max_retries=MAX_RETRIES, backoff=RETRY_BACKOFF, write_batch_size=WRITE_BATCH_SIZE,
+                 overwrite=False):
+        self.store = store
+        self.provider = provider
+        self.cache = cache
+        self.fields = tuple(fields) if fields is not None else None
+        self.workers = max(1, min(workers, provider.max_concurrency))
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.write_batch_size = write_batch_size
+        self.overwrite = overwrite
+        # Books picked for this run, and how far it got with them
+        self.total = 0
+        self.found = 0
+        self.enriched = 0
+        self.not_found = 0
+        self.failed = 0
+        self.cache_hits = 0
+        # The exception that made the last batch (or the whole run) fail, if any
+        self.last_error = None
+        self.started_at = None
+        self.finished_at = None
+        self._wanted = {}
+        self._pending = {}
+        self._cancel = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    # Fraction (0 to 1) of the picked books looked up so far
+    @property
+    def progress(self):
+        if not self.total:
+            return 0.0 if self.running else 1.0
+        return (self.found + self.not_found + self.failed) / self.total
+
+    # Whether `book` lacks one of the fields this run fills in
+    def needs(self, book):
+        if self.overwrite or self.fields is None:
+            return True
+        return any(not book.get(name) for name in self.fields)
+
+    # Start enriching the books that need it (or those of `book_ids`). Returns at once
+    def start(self, book_ids=None):
+        if self.running:
+            raise RuntimeError("An enrichment run is already in progress")
+        self.total = self.found = self.enriched = self.not_found = self.failed = self.cache_hits = 0
+        self.last_error = None
+        self.started_at = time.time()
+        self.finished_at = None
+        self._cancel.clear()
+        self._thread = threading.Thread(target=self._run, args=(book_ids,), name="library-enrich", daemon=True)
+        self._thread.start()
+        return self
+
+    # Stop looking up further batches; answers already received are still written
+    def cancel(self):
+        self._cancel.set()
+
+    # Block until the run has finished. Returns False if `timeout` ran out first
+    def wait(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return not self.running
+
+    @instrumentation.timed("enrichment.run")
+    def _run(self, book_ids):
+        try:
+            # Enriching a half-loaded library would skip the books still to come
+            self.store.wait_until_loaded()
+            view = self.store.view()
+            books = view if book_ids is None else filter(None, map(view.get, book_ids))
+            self._wanted = {}
+            for book in books:
+                if self.needs(book):
+                    self._wanted.setdefault(lookup_key(book), []).append(book["id"])
+                    self.total += 1
+            keys = list(self._wanted)
+            batch_size = max(1, self.provider.batch_size)
+            with ThreadPoolExecutor(self.workers, thread_name_prefix="library-enrich") as pool:
+                in_flight = {}
+                for start in range(0, len(keys), batch_size):
+                    if self._cancel.is_set():
+                        break
+                    batch = keys[start:start + batch_size]
+                    cached = self.cache.get_many(self.provider.name, batch) if self.cache is not None else {}
+                    if cached:
+                        self.cache_hits += sum(len(self._wanted[key]) for key in cached)
+                        instrumentation.count("enrichment.cache_hit", len(cached))
+                        self._collect(cached)
+                    missing = [key for key in batch if key not in cached]
+                    if missing:
+                        in_flight[pool.submit(self._fetch, missing)] = missing
+                    # Bounded: the next batch is only read once a worker is free for it
+                    while len(in_flight) >= self.workers:
+                        self._finish(in_flight)
+                while in_flight:
+                    self._finish(in_flight)
+        except Exception as e:
+            self.last_error = e
+        finally:
+            try:
+                self._write()
+            except Exception as e:
+                self.last_error = e
+            self._wanted = {}
+            self.finished_at = time.time()
+
+    # Look up one batch of keys, retrying failures. Returns {key: fields or None}
+    def _fetch(self, keys):
+        attempt = 0
+        while True:
+            try:
+                with instrumentation.timed("enrichment.lookup"):
+                    found = self.provider.lookup(keys)
+                return {key: found.get(key) or None for key in keys}
+            except ProviderError as e:
+                if attempt >= self.max_retries or self._cancel.is_set():
+                    raise
+                instrumentation.count("enrichment.retry")
+                # Jittered so workers that failed together do not retry together
+                delay = self.backoff * 2 ** attempt * random.uniform(1.0, 1.5)
+                self._cancel.wait(max(delay, e.retry_after or 0))
+                attempt += 1
+
+    # Wait for at least one batch of `in_flight` ({future: keys}) to finish and take in its answers
+    def _finish(self, in_flight):
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            keys = in_flight.pop(future)
+            try:
+                answers = future.result()
+            except Exception as e:
+                self.last_error = e
+                self.failed += sum(len(self._wanted[key]) for key in keys)
+                instrumentation.count("enrichment.failed_batch")
+                continue
+            if self.cache is not None:
+                self.cache.put_many(self.provider.name, answers)
+            self._collect(answers)
+
+    def _collect(self, answers):
+        for key, fields in answers.items():
+            book_ids = self._wanted[key]
+            if not fields:
+                self.not_found += len(book_ids)
+                continue
+            for book_id in book_ids:
+                self._pending[book_id] = fields
+            self.found += len(book_ids)
+        if len(self._pending) >= self.write_batch_size:
+            self._write()
+
+    # Write the collected answers back with one storage write
+    def _write(self):
+        pending, self._pending = self._pending, {}
+        view = self.store.view()
+        changes = {}
+        for book_id, fields in pending.items():
+            book = view.get(book_id)
+            if book is None:
+                continue
+            update = {name: value for name, value in fields.items()
+                      if name not in PROTECTED_FIELDS and value not in (None, "")
+                      and (self.fields is None or name in self.fields)
+                      and (self.overwrite or not book.get(name))}
+            if update:
+                changes[book_id] = update
+        if changes:
+            with instrumentation.timed("enrichment.write"):
+                self.enriched += len(self.store.update_many(changes))
@@ -0,0 +1,164 @@
+from bisect import bisect_left, bisect_right
+from itertools import chain
+from operator import itemgetter
+
+# Largest number of entries one chunk of a SortedIndex holds before it is split in two
+CHUNK_SIZE = 2000
+
+
+class FieldIndex:
+    # Maps each value of one book field to the set of IDs of the books holding it
+    def __init__(self, field):
+        self.field = field
+        self._postings = {}
+
+    def add(self, book):
+        self._postings.setdefault(book[self.field], set()).add(book["id"])
+
+    def remove(self, book):
+        value = book[self.field]
+        ids = self._postings.get(value)
+        if ids is not None:
+            ids.discard(book["id"])
+            if not ids:
+                del self._postings[value]
+
+    def clear(self):
+        self._postings = {}
+
+    # IDs of the books whose field equals `value` (shared set, do not modify)
+    def get(self, value):
+        return self._postings.get(value, frozenset())
+
+    # Distinct values currently present
+    def values(self):
+        return list(self._postings)
+
+
+class SortedIndex:
+    # Book IDs ordered by one field (ties broken by ID), for range queries and
+    # ready-sorted views. Entries live in sorted chunks, a flat B-tree: a lookup
+    # bisects the chunk maxima and then a single chunk, so a removal or the start
+    # of a range costs O(log n) plus a short list shift, and the smallest and
+    # largest values are read off the two ends. Each chunk is a pair of parallel
+    # lists (values and IDs), so an entry costs two references rather than a tuple.
+    # Adds are buffered and merged in on the next read or removal: a few are
+    # inserted one by one, a large batch (such as a whole load) is sorted in one go
+    def __init__(self, field):
+        self.field = field
+        self.clear()
+
+    def clear(self):
+        self._values = []
+        self._ids = []
+        # (value, ID) of the last entry of every chunk
+        self._maxes = []
+        self._size = 0
+        # Books added since the last merge
+        self._pending = []
+
+    def __len__(self):
+        return self._size + len(self._pending)
+
+    def add(self, book):
+        self._pending.append(book)
+
+    def remove(self, book):
+        self.settle()
+        if not self._maxes:
+            return
+        value = book[self.field]
+        book_id = book["id"]
+        chunk, position = self._locate(value, book_id)
+        values = self._values[chunk]
+        ids = self._ids[chunk]
+        if position == len(ids) or ids[position] != book_id or values[position] != value:
+            return
+        del values[position]
+        del ids[position]
+        self._size -= 1
+        if not values:
+            del self._values[chunk]
+            del self._ids[chunk]
+            del self._maxes[chunk]
+        elif position == len(values):
+            self._maxes[chunk] = (values[-1], ids[-1])
+
+    # Chunk holding (value, ID), or the one it would be inserted into, and the position in it
+    def _locate(self, value, book_id):
+        chunk = min(bisect_left(self._maxes, (value, book_id)), len(self._maxes) - 1)
+        values = self._values[chunk]
+        start = bisect_left(values, value)
+        end = bisect_right(values, value, start)
+        return chunk, bisect_left(self._ids[chunk], book_id, start, end)
+
+    def _insert(self, value, book_id):
+        chunk, position = self._locate(value, book_id)
+        values = self._values[chunk]
+        ids = self._ids[chunk]
+        values.insert(position, value)
+        ids.insert(position, book_id)
+        self._size += 1
+        if position == len(values) - 1:
+            self._maxes[chunk] = (value, book_id)
+        if len(values) > CHUNK_SIZE:
+            half = len(values) // 2
+            self._values[chunk:chunk + 1] = [values[:half], values[half:]]
+            self._ids[chunk:chunk + 1] = [ids[:half], ids[half:]]
+            self._maxes[chunk:chunk] = [(values[half - 1], ids[half - 1])]
+
+    # Merge the buffered adds into the chunks
+    def settle(self):
+        pending = self._pending
+        if not pending:
+            return
+        self._pending = []
+        entries = list(map(itemgetter(self.field, "id"), pending))
+        if len(entries) * 8 < self._size:
+            for value, book_id in entries:
+                self._insert(value, book_id)
+            return
+        # Rebuild with one sort. Two stable key sorts (by ID, then by value) order
+        # the pairs like a tuple sort but compare plain strings and ints, which is
+        # several times faster
+        entries.extend(zip(chain.from_iterable(self._values), chain.from_iterable(self._ids)))
+        entries.sort(key=itemgetter(1))
+        entries.sort(key=itemgetter(0))
+        values = list(map(itemgetter(0), entries))
+        ids = list(map(itemgetter(1), entries))
+        step = CHUNK_SIZE // 2
+        self._values = [values[start:start + step] for start in range(0, len(values), step)]
+        self._ids = [ids[start:start + step] for start in range(0, len(ids), step)]
+        self._maxes = [(chunk_values[-1], chunk_ids[-1]) for chunk_values, chunk_ids in zip(self._values, self._ids)]
+        self._size = len(entries)
+
+    # Smallest and largest value, or None when the index is empty
+    def bounds(self):
+        self.settle()
+        if not self._maxes:
+            return None
+        return self._values[0][0], self._values[-1][-1]
+
+    # IDs of the books with start <= value <= end, in value order
+    def range_ids(self, start, end):
+        self.settle()
+        ids = []
+        chunk = bisect_left(self._maxes, (start,))
+        position = bisect_left(self._values[chunk], start) if chunk < len(self._maxes) else 0
+        while chunk < len(self._maxes):
+            values = self._values[chunk]
+            stop = bisect_right(values, end, position)
+            ids.extend(self._ids[chunk][position:stop])
+            if stop < len(values):
+                break
+            chunk += 1
+            position = 0
+        return ids
+
+    # Every ID in value order, or in reverse
+    def ordered_ids(self, descending=False):
+        self.settle()
+        ids = list(chain.from_iterable(self._ids))
+        if descending:
+            ids.reverse()
+        return ids
@@ -0,0 +1,181 @@
+import functools
+import json
+import os
+import threading
+import time
+
+# Set LIBRARY_INSTRUMENTATION=1 to collect timings and counters. When it is off,
+# `timed` hands back a shared do-nothing timer and `count` returns at once, so the
+# calls can stay in place in production
+ENABLED = os.environ.get("LIBRARY_INSTRUMENTATION", "").lower() in ("1", "true", "yes", "on")
+
+# Upper bounds (in seconds) of the latency histogram buckets in the Prometheus dump
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, float("inf"))
+
+METRIC_PREFIX = "library"
+
+_lock = threading.Lock()
+_timings = {}
+_counters = {}
+
+
+class _Timing:
+    # Running totals of one timed operation
+    __slots__ = ("count", "total", "max", "last", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.last = seconds
+        if seconds > self.max:
+            self.max = seconds
+        for position, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[position] += 1
+                break
+
+
+def _record(name, seconds):
+    with _lock:
+        timing = _timings.get(name)
+        if timing is None:
+            timing = _timings[name] = _Timing()
+        timing.add(seconds)
+
+
+class _Timer:
+    # Times one operation: use it with `with`, as a decorator, or through start/stop
+    # when the timed code cannot be wrapped in a block
+    __slots__ = ("name", "_start")
+
+    def __init__(self, name):
+        self.name = name
+        self._start = None
+
+    def start(self):
+        self._start = time.perf_counter()
+        return self
+
+    def stop(self):
+        if self._start is not None:
+            _record(self.name, time.perf_counter() - self._start)
+            self._start = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        return False
+
+    def __call__(self, function):
+        name = self.name
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with _Timer(name):
+                return function(*args, **kwargs)
+        return wrapper
+
+
+class _NullTimer:
+    # Stand-in for _Timer while instrumentation is disabled
+    __slots__ = ()
+
+    def start(self):
+        return self
+
+    def stop(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def __call__(self, function):
+        return function
+
+
+_NULL_TIMER = _NullTimer()
+
+
+# Function to time an operation under `name`
+def timed(name):
+    if not ENABLED:
+        return _NULL_TIMER
+    return _Timer(name)
+
+
+# Function to add `amount` to the counter `name`
+def count(name, amount=1):
+    if not ENABLED:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+# Function to forget every timing and counter collected so far
+def reset():
+    with _lock:
+        _timings.clear()
+        _counters.clear()
+
+
+# Function to get the collected numbers as plain data: per-operation timings in
+# seconds (count, total, mean, max, last) and the counters
+def snapshot():
+    with _lock:
+        timings = {
+            name: {
+                "count": timing.count,
+                "total": timing.total,
+                "mean": timing.total / timing.count if timing.count else 0.0,
+                "max": timing.max,
+                "last": timing.last,
+            }
+            for name, timing in sorted(_timings.items())
+        }
+        return {"enabled": ENABLED, "timings": timings, "counters": dict(sorted(_counters.items()))}
+
+
+def to_json():
+    return json.dumps(snapshot(), indent=2)
+
+
+def _label(name):
+    return name.replace("\\", "\\\\").replace('"', '\\"')
+
+
+# Function to render the collected numbers in the Prometheus text exposition format
+def to_prometheus():
+    with _lock:
+        timings = sorted((name, timing.count, timing.total, list(timing.buckets))
+                         for name, timing in _timings.items())
+        counters = sorted(_counters.items())
+    lines = [
+        f"# HELP {METRIC_PREFIX}_operation_seconds Time spent in instrumented operations.",
+        f"# TYPE {METRIC_PREFIX}_operation_seconds histogram",
+    ]
+    for name, calls, total, buckets in timings:
+        label = f'operation="{_label(name)}"'
+        cumulative = 0
+        for bound, hits in zip(BUCKETS, buckets):
+            cumulative += hits
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f'{METRIC_PREFIX}_operation_seconds_bucket{{{label},le="{le}"}} {cumulative}')
+        lines.append(f"{METRIC_PREFIX}_operation_seconds_sum{{{label}}} {total!r}")
+        lines.append(f"{METRIC_PREFIX}_operation_seconds_count{{{label}}} {calls}")
+    lines.append(f"# HELP {METRIC_PREFIX}_events_total Counted events.")
+    lines.append(f"# TYPE {METRIC_PREFIX}_events_total counter")
+    for name, value in counters:
+        lines.append(f'{METRIC_PREFIX}_events_total{{event="{_label(name)}"}} {value}')
+    return "\n".join(lines) + "\n"
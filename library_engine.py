@@ -0,0 +1,318 @@
+import os
+from itertools import chain
+
+from enrichment import DEFAULT_CACHE_TTL, DEFAULT_FIELDS, DatasetProvider, EnrichmentPipeline, ResponseCache
+from library_io import export_books, format_from_name, import_books
+from library_store import LibraryStore, make_book
+from parallel_scan import ParallelScanner
+from query_cache import DEFAULT_MAX_BYTES
+from reading_history import FINISHED, STARTED, TOGGLED, ReadingHistory
+from storage import LOCK_SUFFIX, FileLock, LibraryJournal, library_exists
+
+# Settings read by LibraryEngine.from_env (the Streamlit app uses these)
+
+# File path for saving/loading library data
+FILE_PATH = os.environ.get("LIBRARY_FILE_PATH", "library.json")
+
+# Storage mode: "journal" appends each change to a log next to the library file,
+# "snapshot" rewrites the whole file on every change
+STORAGE_MODE = os.environ.get("LIBRARY_STORAGE_MODE", "journal")
+
+# Storage backend: "json" keeps the library in FILE_PATH, "sqlite" in DB_PATH
+STORAGE_BACKEND = os.environ.get("LIBRARY_STORAGE_BACKEND", "json")
+DB_PATH = os.environ.get("LIBRARY_DB_PATH", "library.db")
+
+# Changes are written in the background once none came in for AUTOSAVE_QUIET_PERIOD seconds,
+# or AUTOSAVE_MAX_DELAY seconds after the first unwritten one. A quiet period of 0 writes
+# every change before the call that made it returns
+AUTOSAVE_QUIET_PERIOD = float(os.environ.get("LIBRARY_AUTOSAVE_QUIET_PERIOD", "2"))
+AUTOSAVE_MAX_DELAY = float(os.environ.get("LIBRARY_AUTOSAVE_MAX_DELAY", "10"))
+
+# Memory budget (in MB) for cached search results and sorted/filtered tables
+QUERY_CACHE_MB = float(os.environ.get("LIBRARY_QUERY_CACHE_MB", str(DEFAULT_MAX_BYTES // (1024 * 1024))))
+
+# Worker processes for full scans (text searches the token index cannot narrow down,
+# filtered breakdowns); 0 or 1 scans in the app process
+SCAN_WORKERS = int(os.environ.get("LIBRARY_SCAN_WORKERS", "0"))
+
+# Offline metadata file (CSV, JSON Lines or Parquet with title, author and e.g. genre
+# columns) the app fills in missing genres from; enrichment is off when unset
+ENRICHMENT_DATASET = os.environ.get("LIBRARY_ENRICHMENT_DATASET", "")
+
+# SQLite file caching metadata lookups, and how long (in hours) an answer is reused
+ENRICHMENT_CACHE_PATH = os.environ.get("LIBRARY_ENRICHMENT_CACHE", "enrichment_cache.db")
+ENRICHMENT_CACHE_TTL_HOURS = float(os.environ.get("LIBRARY_ENRICHMENT_CACHE_TTL_HOURS",
+                                                  str(DEFAULT_CACHE_TTL / 3600)))
+
+# Append-only log of reading events (books started, finished, marked unread again)
+HISTORY_PATH = os.environ.get("LIBRARY_HISTORY_PATH", "reading_history.jsonl")
+
+
+# Function to open a storage backend: "json" keeps the library in `file_path`,
+# "sqlite" in `db_path` (migrating `file_path` into it on first use)
+def open_backend(backend="json", file_path=FILE_PATH, db_path=DB_PATH):
+    if backend == "sqlite":
+        # Imported here so the JSON backend does not pay for it
+        from storage_sqlite import SQLiteStorage, migrate_json_to_sqlite
+        # Under a lock, so processes starting together do not each migrate
+        with FileLock(db_path + LOCK_SUFFIX):
+            if not os.path.exists(db_path) and library_exists(file_path):
+                # First start on SQLite: bring the existing JSON library over once
+                migrate_json_to_sqlite(file_path, db_path)
+        return SQLiteStorage(db_path)
+    if backend != "json":
+        raise ValueError(f"Unknown storage backend: {backend!r}")
+    return LibraryJournal(file_path)
+
+
+class LibraryEngine:
+    # Headless API over one library: loading and saving, changes, search, sorted and
+    # filtered tables and statistics, without Streamlit. The app in main.py is a UI
+    # over it; scripts, benchmarks and worker processes can open their own engine
+    # on the same files (journal mode merges what other processes write).
+    # Reads are answered from the in-memory store and its indexes; changes are
+    # written at once, or by a background autosave when `autosave_quiet_period` is set
+    def __init__(self, file_path="library.json", backend="json", mode="journal", db_path="library.db",
+                 autosave_quiet_period=0, autosave_max_delay=AUTOSAVE_MAX_DELAY, cache_mb=QUERY_CACHE_MB,
+                 scan_workers=0, enrichment_cache_path=ENRICHMENT_CACHE_PATH,
+                 enrichment_cache_ttl_hours=ENRICHMENT_CACHE_TTL_HOURS, history_path=HISTORY_PATH):
+        self.enrichment_cache_path = enrichment_cache_path
+        self.enrichment_cache_ttl_hours = enrichment_cache_ttl_hours
+        # The last enrichment run started (see `enrich`), and the response cache it uses
+        self.enrichment = None
+        self._enrichment_cache = None
+        self.history = ReadingHistory(history_path)
+        self.store = LibraryStore(open_backend(backend, file_path, db_path), mode,
+                                  cache_bytes=int(cache_mb * 1024 * 1024),
+                                  scanner=ParallelScanner(scan_workers) if scan_workers > 1 else None)
+        if autosave_quiet_period > 0:
+            self.store.start_autosave(autosave_quiet_period, autosave_max_delay)
+
+    # Engine configured from the LIBRARY_* environment variables
+    @classmethod
+    def from_env(cls):
+        return cls(FILE_PATH, STORAGE_BACKEND, STORAGE_MODE, DB_PATH,
+                   AUTOSAVE_QUIET_PERIOD, AUTOSAVE_MAX_DELAY, QUERY_CACHE_MB, SCAN_WORKERS,
+                   ENRICHMENT_CACHE_PATH, ENRICHMENT_CACHE_TTL_HOURS, HISTORY_PATH)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    # Read-only view of the books (see library_store.LibraryView)
+    @property
+    def library(self):
+        return self.store.view()
+
+    @property
+    def loading(self):
+        return self.store.loading
+
+    # Fraction (0 to 1) of the library read so far by a load in progress
+    @property
+    def load_progress(self):
+        return self.store.backend.load_progress
+
+    # The exception that ended the last load, if it failed
+    @property
+    def load_error(self):
+        return self.store.load_error
+
+    # Problems found while loading, when an older generation of the file had to be used
+    @property
+    def recovery_errors(self):
+        return self.store.backend.recovery_errors
+
+    # Load the library on first use, or pick up changes other processes made since.
+    # With `background` set, large libraries keep loading after this returns.
+    # Returns True if anything was (re)loaded or merged
+    def load(self, background=False):
+        return self.store.refresh_if_stale(background)
+
+    # Block until a background load has finished
+    def wait_until_loaded(self, timeout=None):
+        return self.store.wait_until_loaded(timeout)
+
+    # Write a full snapshot of the library
+    def save(self):
+        self.store.save()
+
+    # Validate and add one book (same rules as the Add Book form). Returns the stored book
+    def add_book(self, title, author, year, genre="", read=False):
+        return self.add(make_book(title, author, year, genre, read))
+
+    def add(self, book):
+        book = self.store.add(book)
+        self._log_read_changes([book], {})
+        return book
+
+    def add_many(self, books):
+        books = self.store.add_many(books)
+        self._log_read_changes(books, {})
+        return books
+
+    # Change fields (a dict) of one book. Returns the updated book, or None if it no longer exists
+    def update(self, book_id, fields):
+        previous = self._read_flags([book_id])
+        try:
+            book = self.store.update(book_id, fields)
+        except KeyError:
+            if self.library.get(book_id) is not None:
+                raise
+            # Removed meanwhile (possibly by another session), as update_many skips such books
+            return None
+        self._log_read_changes([book], previous)
+        return book
+
+    # Change fields of many books ({book ID: fields}) with one storage write. Returns the updated books
+    def update_many(self, changes):
+        previous = self._read_flags(changes)
+        books = self.store.update_many(changes)
+        self._log_read_changes(books, previous)
+        return books
+
+    def set_read(self, book_id, read=True):
+        return self.update(book_id, {"read": bool(read)})
+
+    # {book ID: read flag} of the books of `book_ids` still in the library
+    def _read_flags(self, book_ids):
+        flags = {}
+        for book_id in book_ids:
+            book = self.library.get(book_id)
+            if book is not None:
+                flags[book_id] = book["read"]
+        return flags
+
+    # Log every book of `books` whose read flag differs from `previous` (its flags
+    # before the change; a book missing from it counts as unread) as finished, or
+    # marked unread again. Every change of the read flag made through the engine
+    # (adds, updates, merged duplicates) is logged here. Imports are not: a file
+    # brings in books read in the past, not reading done now
+    def _log_read_changes(self, books, previous):
+        changes = [(FINISHED if book["read"] else TOGGLED, book) for book in books
+                   if book["read"] != previous.get(book["id"], False)]
+        if changes:
+            self.history.record_many(changes)
+
+    # Log that reading one book started. Returns the event, or None if the book no longer exists
+    def start_reading(self, book_id):
+        book = self.library.get(book_id)
+        return self.history.record(STARTED, book) if book is not None else None
+
+    # Remove books by ID. Returns the removed books
+    def remove(self, book_ids):
+        return self.store.remove(book_ids)
+
+    # Cursor over the books matching `criteria`: title, author, read, genre and
+    # year_range (see LibraryStore.select_ids)
+    def search(self, **criteria):
+        return self.library.cursor(**criteria)
+
+    # Cursor over the books whose `field` ("title" or "author") matches `query` with
+    # up to `max_distance` typos per word, best matches first
+    def fuzzy_search(self, field, query, max_distance=None):
+        return self.library.fuzzy_cursor(field, query, max_distance)
+
+    # The library as a DataFrame, optionally sorted by one of title, author, year
+    # or genre and filtered to some genres and a read status
+    def table(self, sort_by=None, descending=False, genres=None, read=None):
+        return self.store.frame(sort_by, descending, genres, read)
+
+    def genres(self):
+        return self.store.genres()
+
+    def year_bounds(self):
+        return self.store.year_bounds()
+
+    def statistics(self, top_authors=10):
+        return self.store.statistics(top_authors=top_authors)
+
+    # (value, books, books read) of the books matching `criteria` (as in search),
+    # grouped by "author", "genre" or "decade", most books first; the first `top` rows if given
+    def breakdown(self, field, top=None, **criteria):
+        rows = self.store.breakdown(field, **criteria)
+        return rows[:top] if top is not None else rows
+
+    # (bucket, events) of reading events of `kind` ("finished", "started" or "toggled")
+    # per "day", "week" or "month", oldest first: the last `count` buckets, or every
+    # bucket with an event when `count` is None; only books of one genre if given.
+    # Answered from the history's running per-bucket counts
+    def reading_activity(self, period="month", kind=FINISHED, count=12, genre=None):
+        self.history.refresh()
+        return self.history.rollups.series(period, kind, genre, count)
+
+    # {genre: average books finished (or events of `kind`) per period} over the last
+    # `count` periods, fastest genre first
+    def reading_velocity(self, period="month", count=6, kind=FINISHED):
+        self.history.refresh()
+        return self.history.rollups.velocity(period, kind, count)
+
+    # The most recent reading events, newest first
+    def reading_events(self, count=10):
+        self.history.refresh()
+        return self.history.recent(count)
+
+    # Books already in the library that `book` may duplicate, as (book, exact) pairs
+    # (see LibraryStore.find_duplicates)
+    def find_duplicates(self, book, near=True):
+        return self.store.find_duplicates(book, near)
+
+    # Groups of duplicate book IDs across the library, oldest book first
+    def duplicate_groups(self, near=True):
+        return self.store.duplicate_groups(near)
+
+    # Merge duplicates into the oldest book of each group (all groups found when
+    # `groups` is None). Returns the removed books
+    def merge_duplicates(self, groups=None, near=True):
+        if groups is None:
+            groups = self.duplicate_groups(near)
+        # The book kept from a group takes the read flag of any of the others
+        previous = self._read_flags(chain.from_iterable(groups))
+        removed = self.store.merge_duplicates(groups)
+        kept = [self.library.get(book_id) for book_id in previous]
+        self._log_read_changes([book for book in kept if book is not None], previous)
+        return removed
+
+    # Start filling in missing `fields` of every book (or of `book_ids`) from an
+    # enrichment.MetadataProvider on background threads; answers are cached on disk.
+    # `options` go to enrichment.EnrichmentPipeline. Returns the running pipeline
+    def enrich(self, provider, fields=DEFAULT_FIELDS, book_ids=None, **options):
+        if self.enrichment is not None and self.enrichment.running:
+            raise RuntimeError("An enrichment run is already in progress")
+        if self._enrichment_cache is None:
+            self._enrichment_cache = ResponseCache(self.enrichment_cache_path,
+                                                   self.enrichment_cache_ttl_hours * 3600)
+        self.enrichment = EnrichmentPipeline(self.store, provider, self._enrichment_cache, fields, **options)
+        return self.enrichment.start(book_ids)
+
+    # Provider over ENRICHMENT_DATASET, or None when it is not set
+    @staticmethod
+    def dataset_provider():
+        return DatasetProvider(ENRICHMENT_DATASET) if ENRICHMENT_DATASET else None
+
+    # Stream books in from a CSV, JSON Lines or Parquet file (format guessed from
+    # `name` when `fmt` is not given). Returns a library_io.ImportReport
+    def import_file(self, file, fmt=None, name=None, progress=None):
+        # Duplicates are checked against the whole library, so it has to be loaded
+        self.store.wait_until_loaded()
+        return import_books(self.store, file, fmt or format_from_name(name or file.name), progress=progress)
+
+    # Write every book to `path` as CSV, JSON Lines or Parquet. Returns the number written
+    def export(self, path, fmt=None):
+        return export_books(self.library, path, fmt or format_from_name(path))
+
+    # Stop an enrichment run, write pending changes, stop the scan workers and
+    # release the storage files
+    def close(self):
+        if self.enrichment is not None:
+            self.enrichment.cancel()
+            self.enrichment.wait()
+        if self._enrichment_cache is not None:
+            self._enrichment_cache.close()
+        if self.store.autosave is not None:
+            self.store.autosave.close()
+        self.store.scanner.close()
+        self.store.backend.close()
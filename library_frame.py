@@ -0,0 +1,146 @@
+import numpy as np
+
+# Columns of the View Library table, in display order
+COLUMNS = ["title", "author", "year", "genre", "read"]
+
+INITIAL_CAPACITY = 1024
+
+
+class LibraryFrame:
+    # Columnar copy of the library: typed NumPy columns with genres stored as
+    # category codes and read flags as booleans. Adds append a row, removes mark
+    # it dead and updates write in place; `frame()` slices the live rows into a
+    # DataFrame indexed by book ID and keeps it until the next change
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._ids = np.empty(INITIAL_CAPACITY, dtype=object)
+        self._titles = np.empty(INITIAL_CAPACITY, dtype=object)
+        self._authors = np.empty(INITIAL_CAPACITY, dtype=object)
+        self._years = np.zeros(INITIAL_CAPACITY, dtype=np.int64)
+        self._genre_codes = np.zeros(INITIAL_CAPACITY, dtype=np.int32)
+        self._read = np.zeros(INITIAL_CAPACITY, dtype=bool)
+        self._alive = np.zeros(INITIAL_CAPACITY, dtype=bool)
+        self._genres = []
+        self._genre_codes_by_name = {}
+        self._rows = {}
+        self._size = 0
+        self._dead = 0
+        self._frame = None
+
+    def _columns(self):
+        return ["_ids", "_titles", "_authors", "_years", "_genre_codes", "_read", "_alive"]
+
+    def _grow(self):
+        capacity = len(self._ids) * 2
+        for name in self._columns():
+            column = getattr(self, name)
+            grown = np.zeros(capacity, dtype=column.dtype)
+            grown[:len(column)] = column
+            setattr(self, name, grown)
+
+    def _genre_code(self, genre):
+        code = self._genre_codes_by_name.get(genre)
+        if code is None:
+            code = self._genre_codes_by_name[genre] = len(self._genres)
+            self._genres.append(genre)
+        return code
+
+    def _write_row(self, row, book):
+        self._titles[row] = book["title"]
+        self._authors[row] = book["author"]
+        self._years[row] = book["year"]
+        self._genre_codes[row] = self._genre_code(book["genre"])
+        self._read[row] = bool(book["read"])
+
+    def add(self, book):
+        book_id = book["id"]
+        row = self._rows.get(book_id)
+        if row is None:
+            if self._size == len(self._ids):
+                self._grow()
+            row = self._size
+            self._size += 1
+            self._ids[row] = book_id
+            self._rows[book_id] = row
+        elif not self._alive[row]:
+            # The store updates a book by removing and re-adding it; reuse its row
+            self._dead -= 1
+        self._alive[row] = True
+        self._write_row(row, book)
+        self._frame = None
+
+    def remove(self, book):
+        row = self._rows.get(book["id"])
+        if row is None or not self._alive[row]:
+            return
+        self._alive[row] = False
+        self._dead += 1
+        self._frame = None
+
+    # Release the row of a removed book, so adding the book again appends a new
+    # row at the end instead of reviving the old one
+    def forget(self, book_id):
+        row = self._rows.get(book_id)
+        if row is not None and not self._alive[row]:
+            del self._rows[book_id]
+
+    # Row of a live book. Rows follow the order books were added in (compaction
+    # keeps it), so they sort books in library order
+    def row(self, book_id):
+        return self._rows[book_id]
+
+    # Drop dead rows once they make up half of the table
+    def _compact(self):
+        live = np.flatnonzero(self._alive[:self._size])
+        for name in self._columns():
+            column = getattr(self, name)
+            column[:len(live)] = column[live]
+        self._size = len(live)
+        self._alive[self._size:] = False
+        self._dead = 0
+        self._rows = {book_id: row for row, book_id in enumerate(self._ids[:self._size])}
+
+    # Live rows as a DataFrame indexed by book ID (shared, do not modify in place)
+    def frame(self):
+        if self._frame is not None:
+            return self._frame
+        # Imported on first use so loading and searching do not pay pandas' import time
+        import pandas as pd
+        if self._dead and self._dead * 2 >= self._size:
+            self._compact()
+        live = self._alive[:self._size]
+        # Categories in alphabetical order so sorting by genre matches sorting the names
+        order = sorted(range(len(self._genres)), key=self._genres.__getitem__)
+        remap = np.empty(len(order), dtype=np.int32)
+        remap[order] = np.arange(len(order), dtype=np.int32)
+        genres = pd.Categorical.from_codes(
+            remap[self._genre_codes[:self._size][live]],
+            categories=[self._genres[code] for code in order],
+        )
+        self._frame = pd.DataFrame(
+            {
+                "title": self._titles[:self._size][live],
+                "author": self._authors[:self._size][live],
+                "year": self._years[:self._size][live],
+                "genre": genres,
+                "read": self._read[:self._size][live],
+            },
+            index=pd.Index(self._ids[:self._size][live], name="id"),
+            columns=COLUMNS,
+        )
+        return self._frame
+
+    # Live rows as plain NumPy columns (copies): ids, titles, authors, years,
+    # genre codes and read flags, plus `genres`, the name of every genre code
+    def columns(self):
+        live = self._alive[:self._size]
+        columns = {name.lstrip("_"): getattr(self, name)[:self._size][live] for name in self._columns()[:-1]}
+        columns["genres"] = list(self._genres)
+        return columns
+
+    # Positions in `frame()` of the books with the given IDs; call after `frame()`
+    def positions(self, ids):
+        rows = np.fromiter(map(self._rows.__getitem__, ids), dtype=np.int64, count=len(ids))
+        return (np.cumsum(self._alive[:self._size]) - 1)[rows]
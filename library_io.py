@@ -0,0 +1,181 @@
+import csv
+import io
+import json
+from dataclasses import dataclass, field
+
+from dedupe import duplicate_key
+from library_store import make_book
+
+# Formats understood by the importer and exporter
+FORMATS = ["csv", "jsonl", "parquet"]
+
+# Fields written by the exporter, in column order
+EXPORT_FIELDS = ["id", "title", "author", "year", "genre", "read"]
+
+# Books committed to the library per storage write during an import
+IMPORT_BATCH_SIZE = 5000
+
+# Number of rejected rows whose reasons are kept in an import report
+MAX_REPORTED_ERRORS = 20
+
+TRUE_VALUES = {"true", "yes", "y", "1", "read"}
+
+
+@dataclass
+class ImportReport:
+    added: int = 0
+    duplicates: int = 0
+    invalid: int = 0
+    errors: list = field(default_factory=list)
+
+
+# Function to guess a file's format from its name
+def format_from_name(name):
+    extension = name.rsplit(".", 1)[-1].lower()
+    if extension in ("jsonl", "ndjson"):
+        return "jsonl"
+    if extension in FORMATS:
+        return extension
+    raise ValueError(f"Unsupported file type: {name}")
+
+
+# Function to interpret the read column of an imported row
+def parse_read(value):
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in TRUE_VALUES
+
+
+# Function to get the key two imported books are considered duplicates under: the
+# normalized title and author (see dedupe.duplicate_key) and the year
+def book_key(book):
+    return (*duplicate_key(book), book["year"])
+
+
+def _text_stream(file):
+    # Uploaded files and files opened in binary mode need decoding for csv/json
+    if isinstance(file, io.TextIOBase):
+        return file
+    return io.TextIOWrapper(file, encoding="utf-8", newline="")
+
+
+def _iter_csv(file):
+    reader = csv.DictReader(_text_stream(file))
+    for row in reader:
+        yield {str(key).strip().lower(): value for key, value in row.items() if key is not None}
+
+
+def _iter_jsonl(file):
+    for line in _text_stream(file):
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ValueError("Parquet support needs the optional 'pyarrow' package")
+    return pyarrow
+
+
+def _iter_parquet(file, batch_size=IMPORT_BATCH_SIZE):
+    pyarrow = _import_pyarrow()
+    # Read one record batch at a time so memory stays bounded
+    for batch in pyarrow.parquet.ParquetFile(file).iter_batches(batch_size=batch_size):
+        yield from batch.to_pylist()
+
+
+# Function to stream rows (as dicts) from a CSV, JSON Lines or Parquet file
+def iter_rows(file, fmt):
+    if fmt == "csv":
+        return _iter_csv(file)
+    if fmt == "jsonl":
+        return _iter_jsonl(file)
+    if fmt == "parquet":
+        return _iter_parquet(file)
+    raise ValueError(f"Unsupported format: {fmt}")
+
+
+# Function to stream books from `file` into the store. Rows are validated with the
+# Add Book form's rules, duplicates (of the library or of earlier rows) are skipped,
+# and valid books are committed in batches with one storage write per batch.
+# `progress`, if given, is called with the running report after every batch
+def import_books(store, file, fmt, batch_size=IMPORT_BATCH_SIZE, progress=None):
+    report = ImportReport()
+    # Keys of the rows in the batch not committed yet; committed rows and the rest of
+    # the library are checked through the duplicate index, so memory stays bounded
+    seen = set()
+    batch = []
+    for line_number, row in enumerate(iter_rows(file, fmt), 1):
+        try:
+            book = make_book(row.get("title"), row.get("author"), row.get("year"),
+                             row.get("genre"), parse_read(row.get("read", False)))
+        except ValueError as e:
+            report.invalid += 1
+            if len(report.errors) < MAX_REPORTED_ERRORS:
+                report.errors.append(f"Row {line_number}: {e}")
+            continue
+        key = book_key(book)
+        if key in seen or any(other["year"] == book["year"] for other, _ in store.find_duplicates(book, near=False)):
+            report.duplicates += 1
+            continue
+        seen.add(key)
+        batch.append(book)
+        if len(batch) >= batch_size:
+            report.added += len(store.add_many(batch))
+            batch = []
+            seen.clear()
+            if progress is not None:
+                progress(report)
+    if batch:
+        report.added += len(store.add_many(batch))
+    if progress is not None:
+        progress(report)
+    return report
+
+
+def _export_row(book):
+    return {name: book[name] for name in EXPORT_FIELDS}
+
+
+# Function to stream every book of a library view to `path`, one book at a time.
+# Returns the number of books written
+def export_books(view, path, fmt, batch_size=IMPORT_BATCH_SIZE):
+    books = (view.get(book_id) for book_id in view.ids())
+    books = (book for book in books if book is not None)
+    count = 0
+    if fmt == "csv":
+        with open(path, "w", newline="", encoding="utf-8") as file:
+            writer = csv.DictWriter(file, fieldnames=EXPORT_FIELDS)
+            writer.writeheader()
+            for book in books:
+                writer.writerow(_export_row(book))
+                count += 1
+    elif fmt == "jsonl":
+        with open(path, "w", encoding="utf-8") as file:
+            for book in books:
+                file.write(json.dumps(_export_row(book)) + "\n")
+                count += 1
+    elif fmt == "parquet":
+        pyarrow = _import_pyarrow()
+        schema = pyarrow.schema([
+            ("id", pyarrow.string()), ("title", pyarrow.string()), ("author", pyarrow.string()),
+            ("year", pyarrow.int64()), ("genre", pyarrow.string()), ("read", pyarrow.bool_()),
+        ])
+        with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+            batch = []
+            for book in books:
+                batch.append(_export_row(book))
+                if len(batch) >= batch_size:
+                    writer.write_batch(pyarrow.RecordBatch.from_pylist(batch, schema=schema))
+                    count += len(batch)
+                    batch = []
+            if batch:
+                writer.write_batch(pyarrow.RecordBatch.from_pylist(batch, schema=schema))
+                count += len(batch)
+    else:
+        raise ValueError(f"Unsupported format: {fmt}")
+    return count
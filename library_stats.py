@@ -0,0 +1,64 @@
+import heapq
+
+# Label used for books without a genre
+UNCATEGORIZED = "Uncategorized"
+
+
+# Function to get the decade a publication year falls in
+def decade_of(year):
+    return (year // 10) * 10
+
+
+class LibraryStats:
+    # Running aggregates for the Statistics page. Every add and remove adjusts a
+    # handful of counters, so the page renders from precomputed numbers instead
+    # of walking the library. Each breakdown maps a key to [books, books read]
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.total = 0
+        self.read = 0
+        self._genres = {}
+        self._decades = {}
+        self._authors = {}
+
+    @staticmethod
+    def _bump(counts, key, read, step):
+        entry = counts.get(key)
+        if entry is None:
+            entry = counts[key] = [0, 0]
+        entry[0] += step
+        if read:
+            entry[1] += step
+        if entry[0] == 0:
+            del counts[key]
+
+    def _apply(self, book, step):
+        read = bool(book["read"])
+        self.total += step
+        if read:
+            self.read += step
+        self._bump(self._genres, book["genre"] or UNCATEGORIZED, read, step)
+        self._bump(self._decades, decade_of(book["year"]), read, step)
+        self._bump(self._authors, book["author"], read, step)
+
+    def add(self, book):
+        self._apply(book, 1)
+
+    def remove(self, book):
+        self._apply(book, -1)
+
+    # (genre, books, books read) for every genre, most books first
+    def by_genre(self):
+        rows = [(genre, count, read) for genre, (count, read) in self._genres.items()]
+        return sorted(rows, key=lambda row: row[1], reverse=True)
+
+    # (decade, books, books read) for every decade, oldest first
+    def by_decade(self):
+        return [(decade, count, read) for decade, (count, read) in sorted(self._decades.items())]
+
+    # (author, books, books read) for the `count` authors with the most books
+    def top_authors(self, count):
+        top = heapq.nlargest(count, self._authors.items(), key=lambda item: item[1][0])
+        return [(author, books, read) for author, (books, read) in top]
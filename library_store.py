@@ -0,0 +1,629 @@
+import threading
+from datetime import datetime
+from itertools import islice
+
+import instrumentation
+from autosave import AutosaveScheduler
+from book_record import Book
+from dedupe import DuplicateIndex, duplicate_groups, merged_fields
+from indexes import FieldIndex, SortedIndex
+from library_frame import LibraryFrame
+from library_stats import LibraryStats
+from parallel_scan import ParallelScanner
+from query_cache import DEFAULT_MAX_BYTES, QueryCache
+from search_index import TextIndex, needs_full_scan
+from storage import new_book_id, record_changes
+
+# Oldest publication year accepted for a book
+MIN_YEAR = 1000
+
+# Number of concurrent-edit conflicts kept for display
+MAX_CONFLICTS = 20
+
+# Fields the library can be listed in order of
+SORT_FIELDS = ("title", "author", "year", "genre")
+
+
+# Function to build a new book from raw field values, applying the rules of the
+# Add Book form. Raises ValueError describing the first rule that fails
+def make_book(title, author, year, genre="", read=False):
+    title = str(title or "").strip()
+    author = str(author or "").strip()
+    if not title or not author:
+        raise ValueError("Title and author are required fields!")
+    try:
+        year = int(year)
+    except (TypeError, ValueError):
+        raise ValueError(f"Publication year must be a number, got {year!r}")
+    max_year = datetime.now().year
+    if not MIN_YEAR <= year <= max_year:
+        raise ValueError(f"Publication year must be between {MIN_YEAR} and {max_year}, got {year}")
+    return Book(new_book_id(), title, author, year, str(genre or "").strip(), bool(read))
+
+
+# Function to turn a book (record or dict) into a stored record with an ID
+def as_record(book):
+    book = Book.from_mapping(book)
+    if not book.id:
+        book = book.replace(id=new_book_id())
+    return book
+
+
+class ResultCursor:
+    # A result set kept as the matching book IDs; books are only looked up for
+    # the page being shown
+    def __init__(self, view, ids):
+        self._view = view
+        self._ids = ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    # Matching IDs in library order (shared with the query cache, do not modify)
+    def ids(self):
+        return self._ids
+
+    # Books on page `number` (counting from 0) of `size` books each, skipping
+    # any that were removed since the results were computed
+    def page(self, number, size):
+        start = number * size
+        books = (self._view.get(book_id) for book_id in self._ids[start:start + size])
+        return [book for book in books if book is not None]
+
+
+class LibraryView:
+    # Read-only window onto the shared library: sessions iterate it and look books
+    # up by ID without copying. Books are read-only Book records
+    def __init__(self, store):
+        self._store = store
+
+    def __len__(self):
+        return len(self._store._books)
+
+    def __iter__(self):
+        yield from list(self._store._books.values())
+
+    def __contains__(self, book_id):
+        return book_id in self._store._books
+
+    # Look a book up by ID in O(1); returns None when it no longer exists
+    def get(self, book_id):
+        return self._store._books.get(book_id)
+
+    # IDs of every book, in the order they were added
+    def ids(self):
+        return list(self._store._books)
+
+    # The most recently added books, newest first
+    def recent(self, count):
+        books = self._store._books
+        return [books[book_id] for book_id in islice(reversed(books), count)]
+
+    def select_ids(self, **criteria):
+        return self._store.select_ids(**criteria)
+
+    # Cursor over the books matching `criteria` (see LibraryStore.select_ids)
+    def cursor(self, **criteria):
+        return ResultCursor(self, self._store.select_ids(**criteria))
+
+    # Cursor over a typo-tolerant search, best matches first (see LibraryStore.fuzzy_ids)
+    def fuzzy_cursor(self, field, query, max_distance=None):
+        return ResultCursor(self, self._store.fuzzy_ids(field, query, max_distance))
+
+    def genres(self):
+        return self._store.genres()
+
+    def year_bounds(self):
+        return self._store.year_bounds()
+
+    def sorted_ids(self, field, descending=False):
+        return self._store.sorted_ids(field, descending)
+
+    def frame(self, sort_by=None, descending=False, genres=None, read=None):
+        return self._store.frame(sort_by, descending, genres, read)
+
+    def statistics(self, top_authors=10):
+        return self._store.statistics(top_authors=top_authors)
+
+    def breakdown(self, field, **criteria):
+        return self._store.breakdown(field, **criteria)
+
+
+class LibraryStore:
+    # One parsed copy of the library per process, shared by every session.
+    # Books are kept as Book records in an ID-to-book dict in insertion order; reads go through
+    # `view()` and all mutations take the lock and are passed on to the storage
+    # backend (storage.LibraryJournal or storage_sqlite.SQLiteStorage)
+    def __init__(self, backend, mode="journal", cache_bytes=DEFAULT_MAX_BYTES, scanner=None):
+        self.backend = backend
+        self.mode = mode
+        # Bumped on every change so callers can tell whether the library moved on
+        self.version = 0
+        self.loaded = False
+        # Set while a load is filling the store; readers see the books parsed so far
+        self.loading = False
+        # The exception that ended the last load, if it failed
+        self.load_error = None
+        self._loaded = threading.Event()
+        self._loaded.set()
+        self._first_batch = threading.Event()
+        self._books = {}
+        self._read_index = FieldIndex("read")
+        self._genre_index = FieldIndex("genre")
+        self._title_index = TextIndex("title")
+        self._author_index = TextIndex("author")
+        # Book IDs kept in order of each sortable field, for ranges and sorted listings
+        self._sorted_indexes = {field: SortedIndex(field) for field in SORT_FIELDS}
+        self._year_index = self._sorted_indexes["year"]
+        self._frame = LibraryFrame()
+        # Search results, genre lists and sorted/filtered frames, valid for one version
+        self.query_cache = QueryCache(cache_bytes)
+        # Runs the scans the indexes cannot answer; without a pool it scans in this process
+        self.scanner = scanner if scanner is not None else ParallelScanner(workers=0)
+        self._stats = LibraryStats()
+        # Hashed normalized title/author keys, for duplicate warnings
+        self._duplicate_index = DuplicateIndex()
+        self._indexes = [self._read_index, self._genre_index, self._title_index, self._author_index,
+                         *self._sorted_indexes.values(), self._frame, self._stats, self._duplicate_index]
+        self._lock = threading.RLock()
+        # Serializes writes to the backend so an older state never lands after a newer one
+        self._flush_lock = threading.Lock()
+        # AutosaveScheduler once `start_autosave` was called; until then every change is written at once
+        self.autosave = None
+        # Recent changes of this process that overlapped changes made by another process,
+        # as (time, book title, description), newest last
+        self.conflicts = []
+        self.conflict_count = 0
+
+    def view(self):
+        return LibraryView(self)
+
+    # Parse the library from disk, replacing whatever is in memory. Books are
+    # indexed batch by batch as the backend streams them, so readers see the
+    # library fill up. With `background` set the parsing runs on its own thread
+    # and this returns once the first batch is in; mutations wait for the rest
+    def load(self, background=False):
+        with self._lock:
+            if self.loading:
+                return
+            self.loading = True
+            self.loaded = False
+            self.load_error = None
+            self._loaded.clear()
+            self._first_batch.clear()
+            self._books = {}
+            self._rebuild_indexes()
+            self.version += 1
+        if not background:
+            self._load()
+            if self.load_error is not None:
+                raise self.load_error
+            return
+        threading.Thread(target=self._load, name="library-load", daemon=True).start()
+        self._first_batch.wait()
+
+    @instrumentation.timed("store.load")
+    def _load(self):
+        try:
+            for kind, payload in self.backend.stream():
+                with self._lock:
+                    if kind == "reset":
+                        self._books = {}
+                        self._rebuild_indexes()
+                    elif kind == "books":
+                        for book in payload:
+                            self._put(Book.from_mapping(book))
+                    else:
+                        self.backend.upgrade_record(self._books, payload)
+                        self._replay(payload)
+                    self.version += 1
+                self._first_batch.set()
+            with self._lock:
+                if self.backend.migrated:
+                    # Persist the IDs handed out during migration so they stay stable
+                    self.backend.compact(self._books.values())
+                # Sort and normalize the loaded books here, so the first removal,
+                # sorted listing or duplicate check does not pay for it
+                for index in self._sorted_indexes.values():
+                    index.settle()
+                self._duplicate_index.settle()
+                self.loaded = True
+        except Exception as e:
+            self.load_error = e
+        finally:
+            self.loading = False
+            self._loaded.set()
+            self._first_batch.set()
+
+    # Block until a load in progress has finished
+    def wait_until_loaded(self, timeout=None):
+        return self._loaded.wait(timeout)
+
+    # Load on first use. When another process has changed the files, apply its
+    # changes from the log, or reload if they cannot be followed that way
+    def refresh_if_stale(self, background=False):
+        with self._lock:
+            if self.loading:
+                return False
+            stale = not self.loaded
+            if not stale and self.backend.changed_on_disk():
+                # Snapshot mode keeps no log to follow
+                records = self.backend.catch_up() if self.mode == "journal" else None
+                if records is not None:
+                    self._merge(records, self.backend.pending_records())
+                    return bool(records)
+                stale = True
+        # Outside the lock: a background load needs it to index its first batch
+        if stale:
+            if self.autosave is not None:
+                # Changes still waiting for the autosave would be lost by the reload
+                self.autosave.flush()
+            self.load(background)
+        return stale
+
+    # Apply records another process committed, then re-apply this process's own
+    # records that come after them in the log (`own`, already applied once), so
+    # memory ends up matching the log order. Updates to different fields of the same
+    # book merge; anything else touching the same book is kept as a conflict, and
+    # the later change wins
+    def _merge(self, foreign, own):
+        if not foreign:
+            return
+        touched = {}
+        for record in foreign:
+            for book_id, fields in record_changes(record):
+                touched.setdefault(book_id, []).append((record, fields))
+        conflicts = []
+        for record in own:
+            for book_id, fields in record_changes(record):
+                for other, other_fields in touched.get(book_id, ()):
+                    if fields is not None and other_fields is not None and not fields.keys() & other_fields.keys():
+                        continue
+                    conflicts.append((book_id, record, other))
+        titles = {book_id: self._books[book_id]["title"] for book_id, _, _ in conflicts if book_id in self._books}
+        for record in foreign:
+            self._replay(record)
+        for record in own:
+            self._replay(record)
+        self.version += 1
+        for book_id, record, other in conflicts:
+            if other["op"] == "remove":
+                description = "was removed by another session; this session's change to it was dropped"
+            elif record["op"] == "remove":
+                description = "was changed by another session; this session's removal still applies"
+            else:
+                description = "was changed by another session too; this session's change was applied last"
+            self.conflicts.append((datetime.now(), titles.get(book_id, book_id), description))
+            self.conflict_count += 1
+        del self.conflicts[:-MAX_CONFLICTS]
+
+    # Write changes in the background after `quiet_period` seconds without further
+    # changes (or at most `max_delay` seconds after the first one) instead of at once
+    def start_autosave(self, quiet_period, max_delay):
+        if self.autosave is None:
+            self.autosave = AutosaveScheduler(self.flush, quiet_period, max_delay)
+        return self.autosave
+
+    # Write the changes made since the last write to the backend, merging in
+    # whatever other processes wrote first
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                foreign, written = self.backend.flush()
+                self._merge(foreign, written)
+                if self.mode == "journal":
+                    self.backend.maybe_compact(self._books.values())
+                    return
+                books = list(self._books.values())
+            # Snapshot mode rewrites the whole file; readers need not wait for that
+            self.backend.compact(books)
+
+    def _rebuild_indexes(self):
+        for index in self._indexes:
+            index.clear()
+        for book in self._books.values():
+            self._index_book(book)
+
+    def _index_book(self, book):
+        for index in self._indexes:
+            index.add(book)
+
+    def _unindex_book(self, book, forget=True):
+        for index in self._indexes:
+            index.remove(book)
+        if forget:
+            self._frame.forget(book["id"])
+
+    # Store `book` under its ID, replacing (and unindexing) any earlier version
+    def _put(self, book):
+        old_book = self._books.get(book["id"])
+        self._books[book["id"]] = book
+        if old_book is not None:
+            self._unindex_book(old_book, forget=False)
+        self._index_book(book)
+
+    # Apply a log record read back from the backend while loading
+    def _replay(self, record):
+        op = record["op"]
+        if op == "add":
+            self._put(Book.from_mapping(record["book"]))
+        elif op == "add_many":
+            for book in record["books"]:
+                self._put(Book.from_mapping(book))
+        elif op == "update":
+            old_book = self._books.get(record["id"])
+            if old_book is not None:
+                self._put(old_book.replace(**record["fields"]))
+        elif op == "update_many":
+            for change in record["changes"]:
+                old_book = self._books.get(change["id"])
+                if old_book is not None:
+                    self._put(old_book.replace(**change["fields"]))
+        elif op == "remove":
+            for book_id in record["ids"]:
+                book = self._books.pop(book_id, None)
+                if book is not None:
+                    self._unindex_book(book)
+        else:
+            raise ValueError(f"Unknown journal operation: {op}")
+
+    def _record(self, op, **fields):
+        self.version += 1
+        if self.mode == "journal":
+            self.backend.append(op, **fields)
+
+    # Called after every change, outside the lock: hand the write to the autosave or do it now
+    def _changed(self):
+        if self.autosave is not None:
+            self.autosave.mark_dirty()
+        else:
+            self.flush()
+
+    def add(self, book):
+        # Changes made before the load has replayed the log would be lost or misapplied
+        self.wait_until_loaded()
+        with self._lock:
+            book = as_record(book)
+            self._put(book)
+            self._record("add", book=book.to_dict())
+        self._changed()
+        return book
+
+    # Add a batch of books with a single storage write
+    def add_many(self, books):
+        self.wait_until_loaded()
+        with self._lock:
+            added = []
+            for book in books:
+                book = as_record(book)
+                self._put(book)
+                added.append(book)
+            if added:
+                self._record("add_many", books=[book.to_dict() for book in added])
+        if added:
+            self._changed()
+        return added
+
+    def update(self, book_id, fields):
+        self.wait_until_loaded()
+        with self._lock:
+            # Books are replaced rather than edited so readers never see half an update
+            book = self._books[book_id].replace(**fields)
+            self._put(book)
+            self._record("update", id=book_id, fields=fields)
+        self._changed()
+        return book
+
+    # Change fields of many books with a single storage write. `changes` maps book
+    # IDs to dicts of fields; books that no longer exist are skipped. Returns the
+    # updated books
+    def update_many(self, changes):
+        self.wait_until_loaded()
+        with self._lock:
+            updated = []
+            written = []
+            for book_id, fields in dict(changes).items():
+                book = self._books.get(book_id)
+                if book is None or not fields:
+                    continue
+                book = book.replace(**fields)
+                self._put(book)
+                updated.append(book)
+                written.append({"id": book_id, "fields": fields})
+            if written:
+                self._record("update_many", changes=written)
+        if written:
+            self._changed()
+        return updated
+
+    def remove(self, book_ids):
+        self.wait_until_loaded()
+        with self._lock:
+            removed = [self._books.pop(book_id) for book_id in dict.fromkeys(book_ids)
+                       if book_id in self._books]
+            if removed:
+                for book in removed:
+                    self._unindex_book(book)
+                self._record("remove", ids=[book["id"] for book in removed])
+        if removed:
+            self._changed()
+        return removed
+
+    @staticmethod
+    def _criteria_key(title, author, read, genre, year_range):
+        return (
+            str(title).lower() if title is not None else None,
+            str(author).lower() if author is not None else None,
+            bool(read) if read is not None else None,
+            genre,
+            (int(year_range[0]), int(year_range[1])) if year_range is not None else None,
+        )
+
+    # IDs of the books matching every given criterion, in library order. Criteria
+    # left as None are not applied; `title` and `author` are case-insensitive
+    # substrings and `year_range` is an inclusive (start, end) pair. The list is
+    # cached until the library changes and must not be modified
+    def select_ids(self, title=None, author=None, read=None, genre=None, year_range=None):
+        criteria = self._criteria_key(title, author, read, genre, year_range)
+        with self._lock:
+            return self.query_cache.get(("select",) + criteria, self.version, lambda: self._select_ids(*criteria))
+
+    def _select_ids(self, title, author, read, genre, year_range):
+        if self.scanner.uses_pool(len(self._books)) and any(
+                query is not None and needs_full_scan(query) for query in (title, author)):
+            # The token index would walk most of the library; scan it in parallel instead
+            snapshot = self.scanner.snapshot(self.version, self._frame.columns)
+            ids = self.scanner.select_ids(snapshot, title, author, read, genre, year_range)
+            return sorted(ids, key=self._frame.row)
+        candidates = []
+        if title is not None:
+            candidates.append(self._title_index.search(title, self._books))
+        if author is not None:
+            candidates.append(self._author_index.search(author, self._books))
+        if read is not None:
+            candidates.append(self._read_index.get(read))
+        if genre is not None:
+            candidates.append(self._genre_index.get(genre))
+        if year_range is not None:
+            start, end = year_range
+            candidates.append(self._year_index.range_ids(start, end))
+        if not candidates:
+            return list(self._books)
+        # Intersect starting from the smallest set so the work follows the result size
+        candidates.sort(key=len)
+        ids = set(candidates[0]).intersection(*candidates[1:])
+        return sorted(ids, key=self._frame.row)
+
+    # IDs of the books whose `field` ("title" or "author") matches `query` allowing
+    # typos: every word of the query within `max_distance` edits of a word of the
+    # field (search_index.default_max_distance per word when None). Books that
+    # contain the query exactly come first, then by total edits, then in library
+    # order. Cached like select_ids
+    def fuzzy_ids(self, field, query, max_distance=None):
+        query = str(query).lower()
+        index = {"title": self._title_index, "author": self._author_index}[field]
+        with self._lock:
+            def compute():
+                distances = index.fuzzy_search(query, max_distance)
+                distances.update(dict.fromkeys(index.search(query, self._books), -1))
+                return sorted(distances, key=lambda book_id: (distances[book_id], self._frame.row(book_id)))
+            return self.query_cache.get(("fuzzy", field, query, max_distance), self.version, compute)
+
+    # Books `book` may duplicate, as (book, exact) pairs: the same normalized title
+    # and author, or (with `near`) a similar title by the same author. See dedupe.DuplicateIndex
+    def find_duplicates(self, book, near=True):
+        with self._lock:
+            return self._duplicate_index.find(book, self._books, near)
+
+    # Groups of duplicate book IDs across the library, oldest book first (see
+    # dedupe.duplicate_groups). Cached like select_ids; the search runs on a copy of
+    # the book list, so changes need not wait for it
+    def duplicate_groups(self, near=True):
+        key = ("duplicates", near)
+        with self._lock:
+            version = self.version
+            groups = self.query_cache.peek(key, version)
+            if groups is not None:
+                return groups
+            books = list(self._books.values())
+        with instrumentation.timed("store.duplicate_groups"):
+            groups = duplicate_groups(books, near)
+        with self._lock:
+            if self.version == version:
+                self.query_cache.get(key, version, lambda: groups)
+        return groups
+
+    # Merge every group of duplicate book IDs into its first book, which takes the
+    # read flag and missing fields of the others (see dedupe.merged_fields), and
+    # remove the rest, with two storage writes. Returns the removed books
+    def merge_duplicates(self, groups):
+        self.wait_until_loaded()
+        changes = {}
+        removed_ids = []
+        with self._lock:
+            for group in groups:
+                books = [self._books[book_id] for book_id in group if book_id in self._books]
+                if len(books) < 2:
+                    continue
+                fields = merged_fields(books)
+                if fields:
+                    changes[books[0]["id"]] = fields
+                removed_ids.extend(book["id"] for book in books[1:])
+        self.update_many(changes)
+        return self.remove(removed_ids)
+
+    # (value, books, books read) of the books matching `criteria` (as in select_ids)
+    # grouped by `field`: "author", "genre" or "decade", most books first. A full
+    # scan, spread over the scanner's worker processes when it has them
+    def breakdown(self, field, title=None, author=None, read=None, genre=None, year_range=None):
+        criteria = self._criteria_key(title, author, read, genre, year_range)
+        with self._lock:
+            def compute():
+                snapshot = self.scanner.snapshot(self.version, self._frame.columns)
+                return self.scanner.breakdown(snapshot, field, *criteria)
+            return self.query_cache.get(("breakdown", field) + criteria, self.version, compute)
+
+    # Distinct non-empty genres, sorted
+    def genres(self):
+        with self._lock:
+            return self.query_cache.get(("genres",), self.version,
+                                        lambda: sorted(genre for genre in self._genre_index.values() if genre))
+
+    # Oldest and newest publication years, or None when the library is empty
+    def year_bounds(self):
+        with self._lock:
+            return self._year_index.bounds()
+
+    # IDs of every book ordered by `field` (one of SORT_FIELDS), ties in ID order
+    def sorted_ids(self, field, descending=False):
+        with self._lock:
+            return self._sorted_indexes[field].ordered_ids(descending)
+
+    # First book (in library order) published in `year`
+    def _first_book_of_year(self, year):
+        return self._books[min(self._year_index.range_ids(year, year), key=self._frame.row)]
+
+    # Precomputed numbers for the Statistics page
+    def statistics(self, top_authors=10):
+        with self._lock:
+            bounds = self._year_index.bounds()
+            return {
+                "total": self._stats.total,
+                "read": self._stats.read,
+                "by_genre": self._stats.by_genre(),
+                "by_decade": self._stats.by_decade(),
+                "top_authors": self._stats.top_authors(top_authors),
+                "oldest": self._first_book_of_year(bounds[0]) if bounds else None,
+                "newest": self._first_book_of_year(bounds[1]) if bounds else None,
+            }
+
+    # Columnar DataFrame of the library indexed by book ID, rebuilt only after a change.
+    # With `sort_by` (one of SORT_FIELDS) the rows come in that field's order, taken
+    # from its sorted index instead of sorting the frame; `genres` (a collection)
+    # and `read` keep only the matching rows. Sorted and filtered frames are cached
+    # until the library changes
+    def frame(self, sort_by=None, descending=False, genres=None, read=None):
+        with self._lock:
+            if sort_by is None and not genres and read is None:
+                return self._frame.frame()
+            key = ("frame", sort_by, bool(descending), tuple(sorted(genres)) if genres else None,
+                   None if read is None else bool(read))
+            return self.query_cache.get(key, self.version, lambda: self._query_frame(*key[1:]))
+
+    def _query_frame(self, sort_by, descending, genres, read):
+        frame = self._frame.frame()
+        if sort_by is not None:
+            ids = self._sorted_indexes[sort_by].ordered_ids(descending)
+            frame = frame.take(self._frame.positions(ids))
+        if genres:
+            frame = frame[frame["genre"].isin(genres)]
+        if read is not None:
+            frame = frame[frame["read"] == read]
+        return frame
+
+    # Write a full snapshot of the library
+    def save(self):
+        self.wait_until_loaded()
+        with self._flush_lock, self._lock:
+            self._merge(*self.backend.flush())
+            self.backend.compact(self._books.values())
@@ -1,9 +1,16 @@
 import streamlit as st
 import pandas as pd
-import json
 import os
+import tempfile
+import time
 from datetime import datetime
 
+import instrumentation
+from library_engine import LibraryEngine
+from library_io import FORMATS
+from library_store import MIN_YEAR, make_book
+from reading_history import FINISHED, PERIODS, STARTED, TOGGLED
+
 # Set page configuration
 st.set_page_config(
     page_title="Personal Library Manager",
@@ -11,32 +18,151 @@ st.set_page_config(
     layout="wide"
 )
 
-# File path for saving/loading library data
-FILE_PATH = "library.json"
+# Seconds between reruns while the library is still loading in the background
+LOAD_POLL_INTERVAL = 0.5
+
+# Library engine shared by every session of this process, configured from the
+# LIBRARY_* environment variables (see library_engine)
+@st.cache_resource
+def get_engine():
+    return LibraryEngine.from_env()
 
-# Function to load library from file
+# Function to load library from file (parsed once per process, re-read only when the file changes).
+# Large files are streamed in the background; pages render from the books loaded so far
+@instrumentation.timed("load_library")
 def load_library():
-    if os.path.exists(FILE_PATH):
-        try:
-            with open(FILE_PATH, "r") as file:
-                return json.load(file)
-        except Exception as e:
-            st.error(f"Error loading library: {e}")
-    return []
+    engine = get_engine()
+    try:
+        engine.load(background=True)
+        if engine.load_error is not None:
+            raise engine.load_error
+        if not engine.loading and engine.recovery_errors and 'recovery_warned' not in st.session_state:
+            st.session_state.recovery_warned = True
+            st.warning(f"Library file was damaged, recovered generation {engine.store.backend.generation}: "
+                       + "; ".join(engine.recovery_errors))
+    except Exception as e:
+        st.error(f"Error loading library: {e}")
+    return engine.library
+
+# Function to wait for a background load before changing the library
+def wait_for_library(engine):
+    if engine.loading:
+        with st.spinner("Waiting for the library to finish loading..."):
+            engine.wait_until_loaded()
 
 # Function to save library to file
-def save_library(library):
+@instrumentation.timed("save_library")
+def save_library():
     try:
-        with open(FILE_PATH, "w") as file:
-            json.dump(library, file)
+        engine = get_engine()
+        wait_for_library(engine)
+        engine.save()
         return True
     except Exception as e:
         st.error(f"Error saving library: {e}")
         return False
 
-# Initialize session state if not already initialized
-if 'library' not in st.session_state:
-    st.session_state.library = load_library()
+# Function to apply a change (add/update/remove) through the shared engine
+def change_library(method, *args):
+    try:
+        engine = get_engine()
+        wait_for_library(engine)
+        with instrumentation.timed(f"change.{method}"):
+            return getattr(engine, method)(*args)
+    except Exception as e:
+        st.error(f"Error saving library: {e}")
+        return None
+
+# Function to format a book for selection dropdowns
+def format_book_option(book):
+    return f"{book['title']} by {book['author']} ({book['year']})"
+
+# Function to display a book as a card
+@instrumentation.timed("render.book_card")
+def render_book_card(book):
+    read_status = "✅ Read" if book["read"] else "📖 Unread"
+    st.markdown(f"""
+    <div class="book-card">
+        <h3>{book['title']}</h3>
+        <p>by <b>{book['author']}</b> ({book['year']}) - {book['genre']} - {read_status}</p>
+    </div>
+    """, unsafe_allow_html=True)
+
+# Function to display a book as a single list line
+@instrumentation.timed("render.book_line")
+def render_book_line(book):
+    read_status = "Read" if book["read"] else "Unread"
+    st.markdown(f"- {book['title']} by {book['author']} ({book['year']}) - {book['genre']} - {read_status}")
+
+# Duplicate groups listed on the Remove Book page before "...and N more"
+MAX_DUPLICATE_GROUPS_SHOWN = 20
+
+# Page sizes offered under paginated result lists
+PAGE_SIZES = [10, 25, 50, 100]
+
+# Function to display one page of a result cursor with previous/next controls.
+# `query` identifies the result set, so a new search starts again from the first page
+def render_paginated(cursor, key, query, render_item=render_book_card):
+    state = st.session_state.get(key)
+    if state is None or state["query"] != query:
+        state = st.session_state[key] = {"query": query, "page": 0}
+    page_size = st.session_state.get(f"{key}_size", PAGE_SIZES[1])
+    total = len(cursor)
+    page_count = max(1, -(-total // page_size))
+    state["page"] = min(state["page"], page_count - 1)
+    
+    # Only the visible page is looked up, formatted and sent to the browser
+    for book in cursor.page(state["page"], page_size):
+        render_item(book)
+    
+    start = state["page"] * page_size
+    col1, col2, col3, col4 = st.columns([1, 3, 1, 1])
+    with col1:
+        st.button("◀ Previous", key=f"{key}_prev", disabled=state["page"] == 0,
+                  on_click=lambda: state.update(page=state["page"] - 1))
+    with col2:
+        st.markdown(f"Page {state['page'] + 1} of {page_count} · "
+                    f"showing {min(start + 1, total)}–{min(start + page_size, total)} of {total} books")
+    with col3:
+        st.button("Next ▶", key=f"{key}_next", disabled=state["page"] >= page_count - 1,
+                  on_click=lambda: state.update(page=state["page"] + 1))
+    with col4:
+        st.selectbox("Books per page", PAGE_SIZES, index=1, key=f"{key}_size", label_visibility="collapsed")
+
+# Seconds between refreshes of the enrichment status while a run is in progress
+ENRICHMENT_POLL_INTERVAL = 1.0
+
+# Function to show the progress of the background enrichment run, or a button to start one
+def render_enrichment():
+    engine = get_engine()
+    enrichment = engine.enrichment
+    if enrichment is not None and enrichment.running:
+        looked_up = enrichment.found + enrichment.not_found + enrichment.failed
+        st.progress(enrichment.progress)
+        st.markdown(f"Looked up {looked_up} of {enrichment.total} books: {enrichment.enriched} filled in so far "
+                    f"({enrichment.cache_hits} answered from the cache)")
+        if st.button("Stop", key="stop_enrichment"):
+            enrichment.cancel()
+        return
+    if enrichment is not None and enrichment.finished_at is not None:
+        st.success(f"Filled in {enrichment.enriched} of {enrichment.total} books "
+                   f"({enrichment.not_found} not found, {enrichment.failed} failed).")
+        if enrichment.last_error is not None:
+            st.warning(f"Some lookups failed: {enrichment.last_error}")
+    provider = engine.dataset_provider()
+    if provider is None:
+        st.info("Set LIBRARY_ENRICHMENT_DATASET to a CSV, JSON Lines or Parquet file with title, "
+                "author and genre columns to fill in missing genres from it.")
+    elif st.button("Fill In Missing Genres", key="start_enrichment"):
+        try:
+            engine.enrich(provider)
+        except Exception as e:
+            st.error(f"Error starting enrichment: {e}")
+        else:
+            st.rerun()
+
+# Read-only view of the shared library for this script run
+library = load_library()
 
 # Initialize success message flags if not already in session state
 if 'show_add_success' not in st.session_state:
@@ -100,28 +226,55 @@ st.markdown("""
 
 # Sidebar for navigation
 st.sidebar.markdown('<p class="main-header">📚 Library Manager</p>', unsafe_allow_html=True)
-page = st.sidebar.radio("Select Operation", 
-                        ["Home", "Add Book", "View Library", "Search Books", 
-                         "Remove Book", "Statistics"])
+pages = ["Home", "Add Book", "View Library", "Search Books", "Remove Book", "Statistics"]
+if instrumentation.ENABLED:
+    pages.append("Diagnostics")
+page = st.sidebar.radio("Select Operation", pages)
+instrumentation.count("reruns")
 
 st.sidebar.markdown("---")
 # Display current library size
-st.sidebar.markdown(f"**Library Size:** {len(st.session_state.library)} books")
+if get_engine().loading:
+    load_progress = get_engine().load_progress
+    st.sidebar.markdown(f"**Library Size:** {len(library)} books (loading… {load_progress:.0%})")
+    st.sidebar.progress(load_progress)
+else:
+    st.sidebar.markdown(f"**Library Size:** {len(library)} books")
 
 # Add auto-save button
 if st.sidebar.button("Save Library"):
-    if save_library(st.session_state.library):
+    if save_library():
         set_save_success()
         st.sidebar.success("Library saved successfully!")
     else:
         st.sidebar.error("Failed to save library!")
 
-# Display last saved time if file exists
-if os.path.exists(FILE_PATH):
-    last_modified = os.path.getmtime(FILE_PATH)
-    last_modified_time = datetime.fromtimestamp(last_modified).strftime("%Y-%m-%d %H:%M:%S")
+# Display when the library was last written: by the autosave if it is on, else the file time
+autosave = get_engine().store.autosave
+last_modified = autosave.last_flush if autosave is not None else None
+if last_modified is None:
+    last_modified = get_engine().store.backend.last_modified()
+last_modified_time = (datetime.fromtimestamp(last_modified).strftime("%Y-%m-%d %H:%M:%S")
+                      if last_modified is not None else None)
+if autosave is not None and autosave.last_error is not None:
+    st.sidebar.error(f"Autosave failed, retrying: {autosave.last_error}")
+if autosave is not None and autosave.dirty:
+    st.sidebar.markdown(f"**Last saved:** {last_modified_time or 'never'} "
+                        f"({autosave.pending_changes} unsaved changes, saving shortly)")
+elif last_modified_time is not None:
     st.sidebar.markdown(f"**Last saved:** {last_modified_time}")
 
+# Point out changes that collided with edits made by another session or process
+conflict_count = get_engine().store.conflict_count
+seen_conflicts = st.session_state.setdefault("seen_conflicts", conflict_count)
+if conflict_count > seen_conflicts:
+    for _, title, description in get_engine().store.conflicts[seen_conflicts - conflict_count:]:
+        st.sidebar.warning(f"'{title}' {description}.")
+    st.session_state.seen_conflicts = conflict_count
+
+# Time spent rendering the selected page (a rerun started mid-page is not counted)
+page_timer = instrumentation.timed(f"page.{page}").start()
+
 # Home page
 if page == "Home":
     st.markdown('<p class="main-header">Welcome to Your Personal Library Manager!</p>', unsafe_allow_html=True)
@@ -156,19 +309,12 @@ if page == "Home":
     """)
     
     # Display a sample of books from the library
-    if st.session_state.library:
+    if library:
         st.markdown('<p class="section-header">Recently Added Books</p>', unsafe_allow_html=True)
-        recent_books = st.session_state.library[-3:] if len(st.session_state.library) > 3 else st.session_state.library
-        recent_books.reverse()  # Show newest first
+        recent_books = library.recent(3)  # Newest first
         
         for book in recent_books:
-            read_status = "✅ Read" if book["read"] else "📖 Unread"
-            st.markdown(f"""
-            <div class="book-card">
-                <h3>{book['title']}</h3>
-                <p>by <b>{book['author']}</b> ({book['year']}) - {book['genre']} - {read_status}</p>
-            </div>
-            """, unsafe_allow_html=True)
+            render_book_card(book)
 
 # Add Book page
 elif page == "Add Book":
@@ -180,7 +326,7 @@ elif page == "Add Book":
     with st.form("add_book_form"):
         title = st.text_input("Book Title", key="title")
         author = st.text_input("Author", key="author")
-        year = st.number_input("Publication Year", min_value=1000, max_value=datetime.now().year, 
+        year = st.number_input("Publication Year", min_value=MIN_YEAR, max_value=datetime.now().year, 
                              value=2020, step=1, key="year")
         genre = st.text_input("Genre", key="genre")
         read = st.radio("Have you read this book?", ["Yes", "No"], key="read")
@@ -188,41 +334,63 @@ elif page == "Add Book":
         submitted = st.form_submit_button("Add Book")
         
         if submitted:
-            if not title or not author:
-                st.error("Title and author are required fields!")
+            # Create the book with the same rules bulk imports use
+            try:
+                book = make_book(title, author, year, genre, read == "Yes")
+            except ValueError as e:
+                st.error(str(e))
             else:
-                # Create and add book to library
-                book = {
-                    "title": title,
-                    "author": author,
-                    "year": int(year),
-                    "genre": genre,
-                    "read": read == "Yes"
-                }
-                
-                st.session_state.library.append(book)
-                # Auto-save after adding
-                save_library(st.session_state.library)
-                
-                # Set success message and redirect to home
-                set_add_success(title, author)
-                # Navigate to home to see the success message
-                st.rerun()
+                # Look for the same book (ignoring case, punctuation and name order) or a
+                # near-identical title by the same author; one index lookup, not a scan
+                duplicates = get_engine().find_duplicates(book)
+                if duplicates and st.session_state.get("duplicate_warning") != (book["title"], book["author"]):
+                    # Warn once; submitting the same book again adds it anyway
+                    st.session_state.duplicate_warning = (book["title"], book["author"])
+                    matches = "; ".join(f"'{other['title']}' by {other['author']} ({other['year']})"
+                                        + ("" if exact else " - similar title") for other, exact in duplicates[:5])
+                    st.warning(f"This book may already be in your library: {matches}. "
+                               "Press Add Book again to add it anyway.")
+                else:
+                    st.session_state.pop("duplicate_warning", None)
+                    
+                    # Auto-save after adding
+                    change_library("add", book)
+                    
+                    # Set success message and redirect to home
+                    set_add_success(title, author)
+                    # Navigate to home to see the success message
+                    st.rerun()
+    
+    # Bulk import, streamed from the uploaded file and committed in batches
+    with st.expander("Import books from a file"):
+        uploaded_file = st.file_uploader("CSV, JSON Lines or Parquet file with title, author, year, genre and read columns",
+                                         type=["csv", "jsonl", "ndjson", "parquet"])
+        if uploaded_file is not None and st.button("Import Books", key="import_books"):
+            import_status = st.empty()
+            
+            def show_import_progress(report):
+                import_status.markdown(f"Imported {report.added} books so far...")
+            
+            try:
+                # Duplicates are checked against the whole library, so it has to be loaded
+                wait_for_library(get_engine())
+                report = get_engine().import_file(uploaded_file, progress=show_import_progress)
+            except Exception as e:
+                # Batches committed before the error stay in the library
+                st.error(f"Error importing books: {e}")
+            else:
+                st.success(f"Imported {report.added} books "
+                           f"({report.duplicates} duplicates and {report.invalid} invalid rows skipped).")
+                for error in report.errors:
+                    st.warning(error)
     
     # Show recently added books on this page as well
-    if st.session_state.library:
+    if library:
         st.markdown('<p class="section-header">Recently Added Books</p>', unsafe_allow_html=True)
-        recent_books = st.session_state.library[-3:] if len(st.session_state.library) > 3 else st.session_state.library
-        recent_books.reverse()  # Show newest first
+        recent_books = library.recent(3)  # Newest first
         
         for book in recent_books:
-            read_status = "✅ Read" if book["read"] else "📖 Unread"
-            st.markdown(f"""
-            <div class="book-card">
-                <h3>{book['title']}</h3>
-                <p>by <b>{book['author']}</b> ({book['year']}) - {book['genre']} - {read_status}</p>
-            </div>
-            """, unsafe_allow_html=True)
+            render_book_card(book)
 
 # View Library page
 elif page == "View Library":
@@ -233,14 +401,15 @@ elif page == "View Library":
         st.success(st.session_state.add_success_message)
         st.session_state.show_add_success = False
     
-    if not st.session_state.library:
+    if not library:
         st.info("Your library is empty. Add some books to get started!")
     else:
         # Add an "Edit Mode" toggle
         edit_mode = st.checkbox("Enable Edit Mode")
         
-        # Convert library data to DataFrame for display
-        df = pd.DataFrame(st.session_state.library)
+        # Columnar DataFrame kept by the store (rebuilt only after the library changes)
+        with instrumentation.timed("view.frame"):
+            df = library.frame()
         
         # Add sorting options
         sort_by = st.selectbox("Sort by:", ["Title", "Author", "Year", "Genre"])
@@ -251,44 +420,67 @@ elif page == "View Library":
         ascending = sort_order == "Ascending"
         
         # Filter options
+        selected_genres = []
+        read_filter = "All"
         show_filter = st.checkbox("Show filters")
         if show_filter:
             col1, col2 = st.columns(2)
             
             with col1:
                 # Only show filter options for existing genres
-                all_genres = sorted(list(set(book["genre"] for book in st.session_state.library if book["genre"])))
+                all_genres = library.genres()
+                selected_genres = []
                 if all_genres:
                     selected_genres = st.multiselect("Filter by genre:", all_genres)
             
             with col2:
                 read_filter = st.radio("Filter by read status:", ["All", "Read", "Unread"])
         
-            # Apply filters
-            filtered_df = df.copy()
-            if selected_genres:
-                filtered_df = filtered_df[filtered_df["genre"].isin(selected_genres)]
-            
-            if read_filter != "All":
-                filtered_df = filtered_df[filtered_df["read"] == (read_filter == "Read")]
-        else:
-            filtered_df = df.copy()
-        
-        # Sort the DataFrame
-        filtered_df = filtered_df.sort_values(by=sort_col, ascending=ascending)
-        
-        # Convert boolean to yes/no for display
-        filtered_df["read"] = filtered_df["read"].map({True: "Yes", False: "No"})
+        # Sorted (from the store's sorted index) and filtered; the store caches the
+        # result until the library changes, so reruns with the same choices are free
+        with instrumentation.timed("view.table"):
+            filtered_df = get_engine().table(sort_by=sort_col, descending=not ascending, genres=selected_genres,
+                                             read=None if read_filter == "All" else read_filter == "Read")
         
-        # Rename columns for display
-        filtered_df.columns = [col.capitalize() for col in filtered_df.columns]
-        
-        # Display the table
-        st.dataframe(filtered_df, use_container_width=True)
+        # Display the table; column labels and the read checkbox are set by the column config
+        st.dataframe(filtered_df, use_container_width=True, hide_index=True, column_config={
+            "title": "Title",
+            "author": "Author",
+            "year": st.column_config.NumberColumn("Year", format="%d"),
+            "genre": "Genre",
+            "read": st.column_config.CheckboxColumn("Read"),
+        })
         
         # Show count of displayed books
         st.markdown(f"**Displaying {len(filtered_df)} of {len(df)} books**")
         
+        # Export the whole library, streamed book by book to a temporary file
+        with st.expander("Export library"):
+            export_format = st.selectbox("Format:", FORMATS, key="export_format")
+            if st.button("Prepare Export", key="prepare_export"):
+                fd, export_path = tempfile.mkstemp(prefix="library-export-", suffix=f".{export_format}")
+                os.close(fd)
+                try:
+                    exported = get_engine().export(export_path, export_format)
+                    # The download button serves the export from memory; the file is not kept
+                    with open(export_path, "rb") as export_file:
+                        st.session_state.export = (export_file.read(), f"library.{export_format}")
+                    st.success(f"Exported {exported} books.")
+                except Exception as e:
+                    st.error(f"Error exporting library: {e}")
+                finally:
+                    os.remove(export_path)
+            export = st.session_state.get("export")
+            if export:
+                export_data, export_name = export
+                st.download_button("Download Export", export_data, file_name=export_name)
+        
+        # Missing genres are looked up in the background; only this panel refreshes while that runs
+        with st.expander("Fill in missing genres"):
+            enrichment = get_engine().enrichment
+            running = enrichment is not None and enrichment.running
+            st.fragment(run_every=ENRICHMENT_POLL_INTERVAL if running else None)(render_enrichment)()
+        
         # If edit mode is enabled, add quick actions
         if edit_mode:
             st.markdown("### Quick Actions")
@@ -296,34 +488,36 @@ elif page == "View Library":
             # Mark as read/unread function
             st.markdown("#### Mark Book as Read/Unread")
             
-            # Get list of books
-            book_options = [f"{book['title']} by {book['author']} ({book['year']})" 
-                          for book in st.session_state.library]
-            
             col1, col2 = st.columns([3, 1])
             
             with col1:
-                selected_book = st.selectbox("Select a book:", book_options, key="read_status_book")
+                # Options are book IDs, so the selection is never ambiguous
+                selected_id = st.selectbox("Select a book:", library.ids(), key="read_status_book",
+                                           format_func=lambda book_id: format_book_option(library.get(book_id)))
             
             with col2:
                 # Get current read status
+                selected_book = library.get(selected_id)
                 if selected_book:
-                    index = book_options.index(selected_book)
-                    current_status = st.session_state.library[index]["read"]
+                    current_status = selected_book["read"]
                     new_status = not current_status
                     button_label = f"Mark as {'Unread' if current_status else 'Read'}"
                     
                     if st.button(button_label):
-                        st.session_state.library[index]["read"] = new_status
-                        save_library(st.session_state.library)
-                        st.success(f"'{st.session_state.library[index]['title']}' marked as {'Read' if new_status else 'Unread'}")
+                        change_library("update", selected_id, {"read": new_status})
+                        st.success(f"'{selected_book['title']}' marked as {'Read' if new_status else 'Unread'}")
                         st.rerun()
+                    
+                    # Starting a book only goes into the reading history
+                    if not current_status and st.button("Start Reading"):
+                        change_library("start_reading", selected_id)
+                        st.success(f"Started reading '{selected_book['title']}'")
 
 # Search Books page
 elif page == "Search Books":
     st.markdown('<p class="section-header">Search Your Library</p>', unsafe_allow_html=True)
     
-    if not st.session_state.library:
+    if not library:
         st.info("Your library is empty. Add some books to search!")
     else:
         # Create tabs for different search types
@@ -333,27 +527,28 @@ elif page == "Search Books":
             search_type = st.radio("Search by:", ["Title", "Author"], horizontal=True)
             search_term = st.text_input(f"Enter {search_type.lower()} to search:")
             
+            # Typo-tolerant mode: matches words within a few edits, best matches first
+            col1, col2 = st.columns([1, 1])
+            with col1:
+                fuzzy = st.checkbox("Allow typos", key="fuzzy_search")
+            with col2:
+                typos = st.selectbox("Typos per word:", ["Auto", 1, 2, 3], key="fuzzy_typos", disabled=not fuzzy)
+            
             if search_term:
-                # Perform search based on search type
-                if search_type == "Title":
-                    results = [book for book in st.session_state.library 
-                              if search_term.lower() in book["title"].lower()]
-                else:  # Author
-                    results = [book for book in st.session_state.library 
-                              if search_term.lower() in book["author"].lower()]
+                # Perform search based on search type (answered by the title/author token indexes)
+                with instrumentation.timed("search.fuzzy" if fuzzy else "search.basic"):
+                    if fuzzy:
+                        results = get_engine().fuzzy_search(search_type.lower(), search_term,
+                                                            None if typos == "Auto" else typos)
+                    elif search_type == "Title":
+                        results = get_engine().search(title=search_term)
+                    else:  # Author
+                        results = get_engine().search(author=search_term)
                 
-                # Display results
+                # Display results, one page at a time
                 if results:
                     st.success(f"Found {len(results)} matching books!")
-                    
-                    for i, book in enumerate(results, 1):
-                        read_status = "✅ Read" if book["read"] else "📖 Unread"
-                        st.markdown(f"""
-                        <div class="book-card">
-                            <h3>{book['title']}</h3>
-                            <p>by <b>{book['author']}</b> ({book['year']}) - {book['genre']} - {read_status}</p>
-                        </div>
-                        """, unsafe_allow_html=True)
+                    render_paginated(results, "basic_search_page", (search_type, search_term, fuzzy, typos))
                 else:
                     st.warning(f"No books found with {search_type.lower()} containing '{search_term}'.")
         
@@ -368,54 +563,38 @@ elif page == "Search Books":
             
             with col2:
                 # Get unique genres
-                all_genres = sorted(list(set(book["genre"] for book in st.session_state.library if book["genre"])))
+                all_genres = library.genres()
                 adv_genre = st.selectbox("Genre:", ["Any"] + all_genres)
                 
                 adv_read = st.radio("Read status:", ["Any", "Read", "Unread"])
             
             # Year range slider
-            if st.session_state.library:
-                min_year = min(book["year"] for book in st.session_state.library)
-                max_year = max(book["year"] for book in st.session_state.library)
-                year_range = st.slider("Publication year range:", 
-                                      min_value=min_year, max_value=max_year, 
-                                      value=(min_year, max_year))
+            min_year, max_year = library.year_bounds()
+            year_range = st.slider("Publication year range:", 
+                                  min_value=min_year, max_value=max_year, 
+                                  value=(min_year, max_year))
             
-            # Perform advanced search when button is clicked
+            # Perform advanced search when button is clicked; the criteria are kept so
+            # the results stay up while paging through them
             if st.button("Search", key="adv_search_btn"):
-                results = st.session_state.library.copy()
-                
-                # Apply title filter
-                if adv_title:
-                    results = [book for book in results if adv_title.lower() in book["title"].lower()]
-                
-                # Apply author filter
-                if adv_author:
-                    results = [book for book in results if adv_author.lower() in book["author"].lower()]
-                
-                # Apply genre filter
-                if adv_genre != "Any":
-                    results = [book for book in results if book["genre"] == adv_genre]
-                
-                # Apply read status filter
-                if adv_read != "Any":
-                    results = [book for book in results if book["read"] == (adv_read == "Read")]
-                
-                # Apply year range filter
-                results = [book for book in results if year_range[0] <= book["year"] <= year_range[1]]
+                st.session_state.adv_search_criteria = {
+                    "title": adv_title or None,
+                    "author": adv_author or None,
+                    "genre": adv_genre if adv_genre != "Any" else None,
+                    "read": (adv_read == "Read") if adv_read != "Any" else None,
+                    "year_range": tuple(year_range),
+                }
+            
+            adv_criteria = st.session_state.get("adv_search_criteria")
+            if adv_criteria is not None:
+                # All filters are answered together by intersecting the store's indexes
+                with instrumentation.timed("search.advanced"):
+                    results = get_engine().search(**adv_criteria)
                 
-                # Display results
+                # Display results, one page at a time
                 if results:
                     st.success(f"Found {len(results)} matching books!")
-                    
-                    for i, book in enumerate(results, 1):
-                        read_status = "✅ Read" if book["read"] else "📖 Unread"
-                        st.markdown(f"""
-                        <div class="book-card">
-                            <h3>{book['title']}</h3>
-                            <p>by <b>{book['author']}</b> ({book['year']}) - {book['genre']} - {read_status}</p>
-                        </div>
-                        """, unsafe_allow_html=True)
+                    render_paginated(results, "adv_search_page", tuple(adv_criteria.items()))
                 else:
                     st.warning("No books found matching your search criteria.")
 
@@ -426,26 +605,23 @@ elif page == "Remove Book":
     # Reset success message flags
     st.session_state.show_remove_success = False
     
-    if not st.session_state.library:
+    if not library:
         st.info("Your library is empty. There are no books to remove.")
     else:
         # Create tabs for different removal methods
-        remove_tabs = st.tabs(["Remove by Selection", "Bulk Remove"])
+        remove_tabs = st.tabs(["Remove by Selection", "Bulk Remove", "Duplicates"])
         
         with remove_tabs[0]:  # Remove by Selection
-            # Create a list of book titles with authors for the selection dropdown
-            book_options = [f"{book['title']} by {book['author']} ({book['year']})" 
-                          for book in st.session_state.library]
-            
-            selected_book = st.selectbox("Select a book to remove:", book_options)
+            # Select by book ID, showing titles with authors in the dropdown
+            selected_id = st.selectbox("Select a book to remove:", library.ids(),
+                                       format_func=lambda book_id: format_book_option(library.get(book_id)))
             
             col1, col2 = st.columns([3, 1])
             
             with col1:
                 # Show book details
-                if selected_book:
-                    index = book_options.index(selected_book)
-                    book = st.session_state.library[index]
+                book = library.get(selected_id)
+                if book:
                     read_status = "Read" if book["read"] else "Unread"
                     st.markdown(f"""
                     <div class="book-card">
@@ -456,17 +632,11 @@ elif page == "Remove Book":
             
             with col2:
                 if st.button("Remove Book", key="remove_single"):
-                    # Find the index of the selected book
-                    index = book_options.index(selected_book)
-                    
                     # Get book details before removing
-                    removed_book = st.session_state.library[index]
-                    
-                    # Remove the book from the library
-                    st.session_state.library.pop(index)
+                    removed_book = library.get(selected_id)
                     
-                    # Auto-save after removing
-                    save_library(st.session_state.library)
+                    # Remove the book from the library (auto-saved by the store)
+                    change_library("remove", [selected_id])
                     
                     # Set success message and redirect to home
                     set_remove_success(removed_book['title'])
@@ -479,68 +649,98 @@ elif page == "Remove Book":
             bulk_option = st.radio("Remove books by:", 
                                 ["Read Status", "Genre", "Publication Year"])
             
+            # Matching IDs come from the store's field indexes and feed both the preview and the delete
+            bulk_criteria = None
             if bulk_option == "Read Status":
                 status_to_remove = st.radio("Remove books that are:", ["Read", "Unread"])
-                books_to_remove = [book for book in st.session_state.library 
-                                  if book["read"] == (status_to_remove == "Read")]
+                bulk_criteria = {"read": status_to_remove == "Read"}
             
             elif bulk_option == "Genre":
                 # Get unique genres
-                all_genres = sorted(list(set(book["genre"] for book in st.session_state.library if book["genre"])))
+                all_genres = library.genres()
                 if all_genres:
                     genre_to_remove = st.selectbox("Select genre to remove:", all_genres)
-                    books_to_remove = [book for book in st.session_state.library 
-                                      if book["genre"] == genre_to_remove]
+                    bulk_criteria = {"genre": genre_to_remove}
                 else:
                     st.warning("No genres found in your library.")
-                    books_to_remove = []
             
             elif bulk_option == "Publication Year":
                 # Year range slider
-                if st.session_state.library:
-                    min_year = min(book["year"] for book in st.session_state.library)
-                    max_year = max(book["year"] for book in st.session_state.library)
-                    year_range = st.slider("Remove books published between:", 
-                                          min_value=min_year, max_value=max_year, 
-                                          value=(min_year, min_year + 9))
-                    
-                    books_to_remove = [book for book in st.session_state.library 
-                                      if year_range[0] <= book["year"] <= year_range[1]]
+                min_year, max_year = library.year_bounds()
+                year_range = st.slider("Remove books published between:", 
+                                      min_value=min_year, max_value=max_year, 
+                                      value=(min_year, min(min_year + 9, max_year)))
+                
+                bulk_criteria = {"year_range": tuple(year_range)}
+            
+            with instrumentation.timed("remove.select"):
+                books_to_remove = get_engine().search(**bulk_criteria) if bulk_criteria else []
             
-            # Display books that will be removed
+            # Display books that will be removed, one page at a time
             if books_to_remove:
                 st.markdown(f"### {len(books_to_remove)} Books Selected for Removal:")
-                
-                for book in books_to_remove:
-                    read_status = "Read" if book["read"] else "Unread"
-                    st.markdown(f"- {book['title']} by {book['author']} ({book['year']}) - {book['genre']} - {read_status}")
+                render_paginated(books_to_remove, "bulk_remove_page", tuple(bulk_criteria.items()),
+                                 render_item=render_book_line)
                 
                 # Confirmation
                 if st.button("Confirm Bulk Remove", key="bulk_remove"):
-                    # Save book count before removal
-                    removed_count = len(books_to_remove)
-                    
-                    # Filter out the books to remove
-                    st.session_state.library = [book for book in st.session_state.library 
-                                              if book not in books_to_remove]
-                    
-                    # Auto-save after removing
-                    save_library(st.session_state.library)
+                    # Remove every selected book in one pass with a single save
+                    removed = change_library("remove", books_to_remove.ids())
+                    removed_count = len(removed) if removed else 0
                     
                     st.success(f"Successfully removed {removed_count} books from your library!")
                     st.rerun()
             else:
                 st.info("No books match the selected criteria for removal.")
+        
+        with remove_tabs[2]:  # Duplicates
+            st.markdown("### Merge Duplicates")
+            
+            # The library-wide search sorts the whole library, so it only runs on request
+            # (its result is cached until the library changes)
+            near = st.checkbox("Also match similar titles (typos) by the same author", value=True,
+                               key="duplicates_near")
+            if st.button("Find Duplicates", key="find_duplicates"):
+                st.session_state.show_duplicates = True
+            
+            if st.session_state.get("show_duplicates"):
+                with st.spinner("Looking for duplicates..."):
+                    groups = get_engine().duplicate_groups(near)
+                
+                if groups:
+                    extra_copies = sum(len(group) - 1 for group in groups)
+                    st.markdown(f"**{len(groups)} books are in the library more than once "
+                                f"({extra_copies} extra copies).** Merging keeps the oldest copy of each, "
+                                "marked as read if any copy was, with genres and other details filled in from the others.")
+                    for group in groups[:MAX_DUPLICATE_GROUPS_SHOWN]:
+                        st.markdown("---")
+                        for book_id in group:
+                            book = library.get(book_id)
+                            if book is not None:
+                                render_book_line(book)
+                    if len(groups) > MAX_DUPLICATE_GROUPS_SHOWN:
+                        st.markdown(f"...and {len(groups) - MAX_DUPLICATE_GROUPS_SHOWN} more.")
+                    
+                    if st.button("Merge Duplicates", key="merge_duplicates"):
+                        removed = change_library("merge_duplicates", groups)
+                        removed_count = len(removed) if removed else 0
+                        st.session_state.show_duplicates = False
+                        st.success(f"Merged duplicates, removing {removed_count} extra copies.")
+                else:
+                    st.info("No duplicates found.")
 
 # Statistics page
 elif page == "Statistics":
     st.markdown('<p class="section-header">Library Statistics</p>', unsafe_allow_html=True)
     
-    if not st.session_state.library:
+    if not library:
         st.info("Your library is empty. Add some books to see statistics!")
     else:
-        total_books = len(st.session_state.library)
-        read_books = sum(1 for book in st.session_state.library if book["read"])
+        # Every number on this page comes from the store's running aggregates
+        with instrumentation.timed("statistics"):
+            stats = get_engine().statistics()
+        total_books = stats["total"]
+        read_books = stats["read"]
         unread_books = total_books - read_books
         
         if total_books > 0:
@@ -549,7 +749,7 @@ elif page == "Statistics":
             percent_read = 0
         
         # Create tabs for different statistics views
-        stat_tabs = st.tabs(["Overview", "By Genre", "By Year", "Authors"])
+        stat_tabs = st.tabs(["Overview", "By Genre", "By Year", "Authors", "Reading Activity"])
         
         with stat_tabs[0]:  # Overview
             # Display basic statistics
@@ -571,52 +771,23 @@ elif page == "Statistics":
             # Display recent activity if library has books
             if total_books > 0:
                 # Get the most recently added books (assuming they're added at the end)
-                recent_books = st.session_state.library[-3:] if len(st.session_state.library) > 3 else st.session_state.library
-                recent_books.reverse()  # Show newest first
+                recent_books = library.recent(3)  # Newest first
                 
                 st.markdown("### Recent Activity")
                 for book in recent_books:
-                    read_status = "✅ Read" if book["read"] else "📖 Unread"
-                    st.markdown(f"""
-                    <div class="book-card">
-                        <h3>{book['title']}</h3>
-                        <p>by <b>{book['author']}</b> ({book['year']}) - {book['genre']} - {read_status}</p>
-                    </div>
-                    """, unsafe_allow_html=True)
+                    render_book_card(book)
         
         with stat_tabs[1]:  # By Genre
             # Create genre statistics
             st.markdown("### Breakdown by Genre")
             
-            genres = {}
-            read_by_genre = {}
-            
-            for book in st.session_state.library:
-                genre = book["genre"] if book["genre"] else "Uncategorized"
-                
-                # Count by genre
-                if genre in genres:
-                    genres[genre] += 1
-                    if book["read"]:
-                        read_by_genre[genre] += 1
-                else:
-                    genres[genre] = 1
-                    read_by_genre[genre] = 1 if book["read"] else 0
-            
-            # Convert to DataFrame for visualization
-            genre_df = pd.DataFrame({
-                "Genre": list(genres.keys()),
-                "Count": list(genres.values()),
-                "Read": list(read_by_genre.values())
-            })
+            # Convert to DataFrame for visualization (rows come sorted by count)
+            genre_df = pd.DataFrame(stats["by_genre"], columns=["Genre", "Count", "Read"])
             
             # Calculate percentage read for each genre
             genre_df["Unread"] = genre_df["Count"] - genre_df["Read"]
             genre_df["Percent_Read"] = (genre_df["Read"] / genre_df["Count"] * 100).round(1)
             
-            # Sort by count
-            genre_df = genre_df.sort_values("Count", ascending=False)
-            
             # Display genre breakdown chart
             st.bar_chart(genre_df.set_index("Genre")[["Read", "Unread"]])
             
@@ -630,32 +801,9 @@ elif page == "Statistics":
             # Publication year distribution
             st.markdown("### Books by Publication Decade")
             
-            # Create decade groups
-            decades = {}
-            read_by_decade = {}
-            
-            for book in st.session_state.library:
-                decade = (book["year"] // 10) * 10
-                decade_label = f"{decade}s"
-                
-                # Count by decade
-                if decade_label in decades:
-                    decades[decade_label] += 1
-                    if book["read"]:
-                        read_by_decade[decade_label] += 1
-                else:
-                    decades[decade_label] = 1
-                    read_by_decade[decade_label] = 1 if book["read"] else 0
-            
-            # Sort decades chronologically
-            sorted_decades = sorted(decades.items(), key=lambda x: int(x[0][:-1]))
-            sorted_read_by_decade = {decade: read_by_decade.get(decade, 0) for decade, _ in sorted_decades}
-            
-            decade_df = pd.DataFrame({
-                "Decade": [item[0] for item in sorted_decades],
-                "Count": [item[1] for item in sorted_decades],
-                "Read": list(sorted_read_by_decade.values())
-            })
+            # Decade groups, already in chronological order
+            decade_df = pd.DataFrame([(f"{decade}s", count, read) for decade, count, read in stats["by_decade"]],
+                                     columns=["Decade", "Count", "Read"])
             
             # Calculate unread and percentage
             decade_df["Unread"] = decade_df["Count"] - decade_df["Read"]
@@ -665,63 +813,44 @@ elif page == "Statistics":
             
             # Display oldest and newest books
             if total_books > 0:
-                oldest_book = min(st.session_state.library, key=lambda x: x["year"])
-                newest_book = max(st.session_state.library, key=lambda x: x["year"])
+                oldest_book = stats["oldest"]
+                newest_book = stats["newest"]
                 
                 col1, col2 = st.columns(2)
                 
                 with col1:
                     st.markdown("### Oldest Book")
-                    read_status = "✅ Read" if oldest_book["read"] else "📖 Unread"
-                    st.markdown(f"""
-                    <div class="book-card">
-                        <h3>{oldest_book['title']}</h3>
-                        <p>by <b>{oldest_book['author']}</b> ({oldest_book['year']}) - {oldest_book['genre']} - {read_status}</p>
-                    </div>
-                    """, unsafe_allow_html=True)
+                    render_book_card(oldest_book)
                 
                 with col2:
                     st.markdown("### Newest Book")
-                    read_status = "✅ Read" if newest_book["read"] else "📖 Unread"
-                    st.markdown(f"""
-                    <div class="book-card">
-                        <h3>{newest_book['title']}</h3>
-                        <p>by <b>{newest_book['author']}</b> ({newest_book['year']}) - {newest_book['genre']} - {read_status}</p>
-                    </div>
-                    """, unsafe_allow_html=True)
+                    render_book_card(newest_book)
         
         with stat_tabs[3]:  # Authors
             # Author statistics
             st.markdown("### Author Statistics")
             
-            authors = {}
-            books_by_author = {}
-            
-            for book in st.session_state.library:
-                author = book["author"]
-                if author in authors:
-                    authors[author] += 1
-                    books_by_author[author].append(book)
-                else:
-                    authors[author] = 1
-                    books_by_author[author] = [book]
-            
-            # Get top authors
-            top_authors = sorted(authors.items(), key=lambda x: x[1], reverse=True)
+            # Top authors as (author, books, books read), most books first: from the running
+            # aggregates for the whole library, from a (parallel) scan for one genre
+            author_genre = st.selectbox("Genre:", ["All genres"] + library.genres(), key="author_genre")
+            if author_genre == "All genres":
+                top_authors = stats["top_authors"]
+            else:
+                with instrumentation.timed("statistics.authors"):
+                    top_authors = get_engine().breakdown("author", top=10, genre=author_genre)
             
             # Create a DataFrame for visualization
             if top_authors:
-                author_df = pd.DataFrame(top_authors[:10], columns=["Author", "Count"])
+                author_df = pd.DataFrame([(author, count) for author, count, _ in top_authors],
+                                         columns=["Author", "Count"])
                 
                 # Display author bar chart
                 st.bar_chart(author_df.set_index("Author"))
                 
                 # Display most read authors
                 st.markdown("### Top 5 Authors in Your Library")
-                for author, count in top_authors[:5]:
+                for author, count, read_count in top_authors[:5]:
                     # Calculate percentage read for this author
-                    author_books = books_by_author[author]
-                    read_count = sum(1 for book in author_books if book["read"])
                     percent_read = (read_count / count) * 100 if count > 0 else 0
                     
                     st.markdown(f"""
@@ -729,4 +858,95 @@ elif page == "Statistics":
                         <h3>{author}</h3>
                             <p><b>{count} books</b> ({read_count} read)</p>
                         </div>
-                        """, unsafe_allow_html=True)
\ No newline at end of file
+                        """, unsafe_allow_html=True)
+        
+        with stat_tabs[4]:  # Reading Activity
+            # Books started and finished over time, from the reading history's per-period counts
+            st.markdown("### Reading Activity")
+            
+            col1, col2 = st.columns(2)
+            with col1:
+                period = st.selectbox("Per:", PERIODS, index=PERIODS.index("month"), key="activity_period")
+            with col2:
+                periods_shown = st.slider("Periods shown:", 3, 52, 12, key="activity_count")
+            
+            engine = get_engine()
+            with instrumentation.timed("statistics.activity"):
+                finished = engine.reading_activity(period, FINISHED, periods_shown)
+                started = engine.reading_activity(period, STARTED, periods_shown)
+                velocity = engine.reading_velocity(period, periods_shown)
+            
+            if engine.history.count == 0:
+                st.info("No reading activity yet. Mark books as read (or start reading them) to fill this in.")
+            else:
+                activity_df = pd.DataFrame({
+                    "Period": [bucket for bucket, _ in finished],
+                    "Finished": [count for _, count in finished],
+                    "Started": [count for _, count in started],
+                })
+                st.bar_chart(activity_df.set_index("Period"))
+                
+                # Books finished per period by genre, over the periods shown
+                st.markdown(f"### Reading Velocity by Genre (books per {period})")
+                if velocity:
+                    velocity_df = pd.DataFrame(list(velocity.items()), columns=["Genre", f"Books per {period}"])
+                    st.dataframe(velocity_df, use_container_width=True, hide_index=True)
+                else:
+                    st.info("No books finished in the periods shown.")
+                
+                # Latest events from the log
+                st.markdown("### Recent Reading Events")
+                labels = {STARTED: "Started", FINISHED: "Finished", TOGGLED: "Marked unread"}
+                for event in engine.reading_events(10):
+                    when = datetime.fromtimestamp(event["time"]).strftime("%Y-%m-%d %H:%M")
+                    st.markdown(f"- {when}: **{labels[event['kind']]}** {event['title']}")
+
+# Diagnostics page (only offered when LIBRARY_INSTRUMENTATION is set)
+elif page == "Diagnostics":
+    st.markdown('<p class="section-header">Diagnostics</p>', unsafe_allow_html=True)
+    
+    metrics = instrumentation.snapshot()
+    
+    # Timings in milliseconds, slowest total first
+    if metrics["timings"]:
+        timing_df = pd.DataFrame(
+            [(name, timing["count"], timing["total"] * 1000, timing["mean"] * 1000,
+              timing["max"] * 1000, timing["last"] * 1000)
+             for name, timing in metrics["timings"].items()],
+            columns=["Operation", "Calls", "Total (ms)", "Mean (ms)", "Max (ms)", "Last (ms)"],
+        ).sort_values("Total (ms)", ascending=False)
+        st.dataframe(timing_df, use_container_width=True, hide_index=True)
+    else:
+        st.info("No timings recorded yet.")
+    
+    query_cache = get_engine().store.query_cache
+    st.markdown(f"**Query cache:** {len(query_cache)} results, "
+                f"{query_cache.size / 1e6:.1f} of {query_cache.max_bytes / 1e6:.0f} MB, "
+                f"{query_cache.hits} hits, {query_cache.misses} misses")
+    
+    if metrics["counters"]:
+        st.markdown("### Counters")
+        st.dataframe(pd.DataFrame(list(metrics["counters"].items()), columns=["Event", "Count"]),
+                     use_container_width=True, hide_index=True)
+    
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.download_button("Download JSON", instrumentation.to_json(), file_name="library_metrics.json",
+                           mime="application/json")
+    with col2:
+        st.download_button("Download Prometheus text", instrumentation.to_prometheus(),
+                           file_name="library_metrics.prom", mime="text/plain")
+    with col3:
+        if st.button("Reset Metrics"):
+            instrumentation.reset()
+            st.rerun()
+    
+    with st.expander("Prometheus text"):
+        st.code(instrumentation.to_prometheus(), language="text")
+
+page_timer.stop()
+
+# Keep refreshing while the library loads so the counts and pages fill in
+if get_engine().loading:
+    time.sleep(LOAD_POLL_INTERVAL)
+    st.rerun()
@@ -0,0 +1,274 @@
+import atexit
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# Where scan snapshots are written: tmpfs where there is one, so the column files
+# are shared memory that every worker maps instead of receiving a pickled copy
+SHARED_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+# Libraries smaller than this are scanned in the calling process; for them a round
+# trip through the pool costs more than the scan itself
+MIN_PARALLEL_BOOKS = 50_000
+
+# Shards handed out per worker, so one slow shard does not hold up the whole scan
+SHARDS_PER_WORKER = 4
+
+# Fields a breakdown can be grouped by
+BREAKDOWN_FIELDS = ("author", "genre", "decade")
+
+# Separates the values in a text column file; it cannot occur in a search term
+SEPARATOR = "\x00"
+
+
+# Array columns of a snapshot, as saved to .npy files
+ARRAY_COLUMNS = ("years", "read", "genre_codes", "author_codes", "title_offsets", "author_offsets")
+
+# Text columns of a snapshot, as saved to .bin files
+TEXT_COLUMNS = ("title", "author")
+
+
+def _text_column(values):
+    # All values lowercased, separated by NUL bytes, plus the byte offset each one starts at
+    text = SEPARATOR.join(values)
+    if text.count(SEPARATOR) != max(len(values) - 1, 0):
+        text = SEPARATOR.join(str(value).replace(SEPARATOR, " ") for value in values)
+    data = np.frombuffer((text.lower() + SEPARATOR).encode("utf-8"), dtype=np.uint8)
+    return data, np.concatenate(([0], np.flatnonzero(data == 0) + 1))
+
+
+class ScanSnapshot:
+    # The library's columns at one version: years, read flags, genre and author
+    # codes as arrays, and titles and authors as lowercased NUL-separated text with
+    # byte offsets, so a substring search is one pass over a shard's bytes. With
+    # `shared` set they are written to files under SHARED_DIR for pool workers to
+    # map (`path`); otherwise they stay in memory (`columns`) and are scanned in this
+    # process. The book IDs and the genre and author names stay in this process
+    def __init__(self, columns, version, shared=False):
+        self.version = version
+        self.ids = columns["ids"]
+        self.size = len(self.ids)
+        self.genres = columns["genres"]
+        self._genre_codes = {genre: code for code, genre in enumerate(self.genres)}
+        author_codes = {}
+        codes = np.fromiter((author_codes.setdefault(author, len(author_codes)) for author in columns["authors"]),
+                            dtype=np.int32, count=self.size)
+        self.authors = list(author_codes)
+        self.columns = {
+            "years": columns["years"].astype(np.int32),
+            "read": columns["read"],
+            "genre_codes": columns["genre_codes"],
+            "author_codes": codes,
+        }
+        for name, values in (("title", columns["titles"]), ("author", columns["authors"])):
+            self.columns[name], self.columns[f"{name}_offsets"] = _text_column(values)
+        self.path = None
+        if shared:
+            self.path = tempfile.mkdtemp(prefix="library-scan-", dir=SHARED_DIR)
+            try:
+                for name in ARRAY_COLUMNS:
+                    np.save(os.path.join(self.path, f"{name}.npy"), self.columns[name])
+                for name in TEXT_COLUMNS:
+                    self.columns[name].tofile(os.path.join(self.path, f"{name}.bin"))
+            except BaseException:
+                self.close()
+                raise
+            # The workers read the files; this process needs no copy
+            self.columns = None
+
+    # Code of a genre name, or -1 when no book has it
+    def genre_code(self, genre):
+        return self._genre_codes.get(genre, -1)
+
+    # Name of the value a breakdown code stands for
+    def label(self, field, code):
+        if field == "author":
+            return self.authors[code]
+        if field == "genre":
+            return self.genres[code]
+        return code
+
+    def close(self):
+        if self.path is not None:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+
+# Columns of the snapshot last used in this process, as (path, columns)
+_mapped = None
+
+
+def _columns(path):
+    global _mapped
+    if _mapped is None or _mapped[0] != path:
+        columns = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in ARRAY_COLUMNS}
+        for name in TEXT_COLUMNS:
+            columns[name] = np.memmap(os.path.join(path, f"{name}.bin"), dtype=np.uint8, mode="r")
+        _mapped = (path, columns)
+    return _mapped[1]
+
+
+def _text_mask(data, offsets, term, start, end):
+    # Byte positions where the term's first byte occurs, narrowed down one byte of
+    # the term at a time, so frequent and rare terms both cost a few array passes
+    mask = np.zeros(end - start, dtype=bool)
+    first, stop = int(offsets[start]), int(offsets[end])
+    if SEPARATOR.encode() in term or stop - first < len(term):
+        return mask
+    window = data[first:stop]
+    positions = np.flatnonzero(window[:len(window) - len(term) + 1] == term[0])
+    for index in range(1, len(term)):
+        positions = positions[window[positions + index] == term[index]]
+    if len(positions):
+        mask[np.searchsorted(offsets[start:end + 1], positions + first, side="right") - 1] = True
+    return mask
+
+
+def _shard_mask(columns, start, end, criteria):
+    mask = np.ones(end - start, dtype=bool)
+    if criteria.get("read") is not None:
+        mask &= columns["read"][start:end] == criteria["read"]
+    if criteria.get("genre_code") is not None:
+        mask &= columns["genre_codes"][start:end] == criteria["genre_code"]
+    if criteria.get("year_range") is not None:
+        years = columns["years"][start:end]
+        mask &= (years >= criteria["year_range"][0]) & (years <= criteria["year_range"][1])
+    for field in ("title", "author"):
+        term = criteria.get(field)
+        if term and mask.any():
+            mask &= _text_mask(columns[field], columns[f"{field}_offsets"], term, start, end)
+    return mask
+
+
+# Function to get the rows in [start, end) matching `criteria`
+def scan_shard(columns, start, end, criteria):
+    return np.flatnonzero(_shard_mask(columns, start, end, criteria)) + start
+
+
+# Function to get (codes, books, books read) of the rows in [start, end) matching
+# `criteria`, grouped by `field`
+def breakdown_shard(columns, start, end, criteria, field):
+    mask = _shard_mask(columns, start, end, criteria)
+    if field == "decade":
+        keys = columns["years"][start:end][mask] // 10 * 10
+    else:
+        keys = columns[f"{field}_codes"][start:end][mask]
+    codes, inverse = np.unique(keys, return_inverse=True)
+    counts = np.bincount(inverse, minlength=len(codes))
+    read = np.bincount(inverse, weights=columns["read"][start:end][mask], minlength=len(codes))
+    return codes, counts, read.astype(np.int64)
+
+
+# Function run on a worker: `function` (one of the shard functions) over the
+# snapshot files under `path`
+def run_shard(function, path, start, end, *args):
+    return function(_columns(path), start, end, *args)
+
+
+# Scanners whose workers and snapshot files are cleaned up at exit
+_scanners = weakref.WeakSet()
+
+
+def _close_scanners():
+    for scanner in list(_scanners):
+        scanner.close()
+
+
+atexit.register(_close_scanners)
+
+
+class ParallelScanner:
+    # Full scans of the library on a pool of worker processes. The library is
+    # written once per version to a ScanSnapshot in shared memory and cut into
+    # contiguous shards; each worker filters (or groups) its shards with NumPy
+    # over the mapped columns and only row numbers or small count arrays travel
+    # back. With fewer than two workers, or libraries under `min_books`, the
+    # same shard functions run in this process over a snapshot kept in memory
+    def __init__(self, workers=None, min_books=MIN_PARALLEL_BOOKS):
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.min_books = min_books
+        self._pool = None
+        self._snapshot = None
+        self._lock = threading.Lock()
+        _scanners.add(self)
+
+    @property
+    def parallel(self):
+        return self.workers > 1
+
+    # Whether a library of `size` books is scanned on the pool
+    def uses_pool(self, size):
+        return self.parallel and size >= self.min_books
+
+    # Snapshot of the library at `version`; `columns` (a function returning
+    # LibraryFrame.columns()) is only called when the version moved on
+    def snapshot(self, version, columns):
+        with self._lock:
+            if self._snapshot is None or self._snapshot.version != version:
+                columns = columns()
+                # Only a pooled scan needs the columns in shared files
+                snapshot = ScanSnapshot(columns, version, shared=self.uses_pool(len(columns["ids"])))
+                if self._snapshot is not None:
+                    # Workers still mapping the old files keep them until they move on
+                    self._snapshot.close()
+                self._snapshot = snapshot
+            return self._snapshot
+
+    def _run(self, function, snapshot, *args):
+        if snapshot.path is None:
+            return [function(snapshot.columns, 0, snapshot.size, *args)]
+        if self._pool is None:
+            # Spawned rather than forked: the app process runs threads that fork would copy mid-flight
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        shard_count = min(self.workers * SHARDS_PER_WORKER, snapshot.size)
+        bounds = np.linspace(0, snapshot.size, shard_count + 1).astype(int)
+        futures = [self._pool.submit(run_shard, function, snapshot.path, int(start), int(end), *args)
+                   for start, end in zip(bounds[:-1], bounds[1:])]
+        return [future.result() for future in futures]
+
+    @staticmethod
+    def _criteria(snapshot, title, author, read, genre, year_range):
+        return {
+            "title": str(title).lower().encode("utf-8") if title is not None else None,
+            "author": str(author).lower().encode("utf-8") if author is not None else None,
+            "read": read,
+            "genre_code": snapshot.genre_code(genre) if genre is not None else None,
+            "year_range": year_range,
+        }
+
+    # IDs of the books in `snapshot` matching every given criterion (same meaning
+    # as LibraryStore.select_ids), in snapshot order
+    def select_ids(self, snapshot, title=None, author=None, read=None, genre=None, year_range=None):
+        criteria = self._criteria(snapshot, title, author, read, genre, year_range)
+        rows = np.concatenate(self._run(scan_shard, snapshot, criteria))
+        return snapshot.ids[rows].tolist()
+
+    # (value, books, books read) of the matching books grouped by `field` (one of
+    # BREAKDOWN_FIELDS), most books first
+    def breakdown(self, snapshot, field, title=None, author=None, read=None, genre=None, year_range=None):
+        if field not in BREAKDOWN_FIELDS:
+            raise ValueError(f"Cannot break down by {field!r}")
+        criteria = self._criteria(snapshot, title, author, read, genre, year_range)
+        totals = {}
+        for codes, counts, read_counts in self._run(breakdown_shard, snapshot, criteria, field):
+            for code, count, read_count in zip(codes.tolist(), counts.tolist(), read_counts.tolist()):
+                entry = totals.setdefault(code, [0, 0])
+                entry[0] += count
+                entry[1] += read_count
+        rows = [(snapshot.label(field, code), count, read_count) for code, (count, read_count) in totals.items()]
+        return sorted(rows, key=lambda row: row[1], reverse=True)
+
+    # Stop the workers and delete the snapshot files
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        with self._lock:
+            if self._snapshot is not None:
+                self._snapshot.close()
+                self._snapshot = None
@@ -0,0 +1,89 @@
+import sys
+from collections import OrderedDict
+
+import instrumentation
+
+# Default memory budget of a QueryCache, in bytes
+DEFAULT_MAX_BYTES = 128 * 1024 * 1024
+
+# Default number of results a QueryCache holds at most
+DEFAULT_MAX_ENTRIES = 256
+
+
+# Function to estimate the memory a cached result adds. Results hold references to
+# the store's books and strings, so only the containers themselves are counted
+def estimate_size(value):
+    memory_usage = getattr(value, "memory_usage", None)
+    if memory_usage is not None:
+        # DataFrames: the column buffers and the index
+        return int(memory_usage(index=True, deep=False).sum())
+    return sys.getsizeof(value)
+
+
+class QueryCache:
+    # Least-recently-used cache of query results, tagged with the library version
+    # they were computed at. Every change to the library bumps the version, and the
+    # first lookup at a new version drops all entries at once, so a result is never
+    # served after the books it was computed from changed. Entries are evicted
+    # oldest-first past `max_entries` results or `max_bytes` of estimated memory;
+    # a result larger than the whole budget is not cached.
+    # Cached results are shared between callers and must not be modified
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.version = None
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def _check_version(self, version):
+        if version != self.version:
+            self.clear()
+            self.version = version
+
+    # The result cached under `key` at `version`, or `compute()` (cached for next time)
+    def get(self, key, version, compute):
+        self._check_version(version)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            instrumentation.count("query_cache.hit")
+            return entry[0]
+        self.misses += 1
+        instrumentation.count("query_cache.miss")
+        value = compute()
+        self._put(key, value)
+        return value
+
+    # The result cached under `key` at `version`, or None when there is none; for
+    # results computed outside the caller's lock and stored afterwards with `get`
+    def peek(self, key, version):
+        if version != self.version:
+            return None
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        instrumentation.count("query_cache.hit")
+        return entry[0]
+
+    def _put(self, key, value):
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (value, size)
+        self.size += size
+        while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.size -= evicted_size
+            instrumentation.count("query_cache.eviction")
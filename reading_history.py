@@ -0,0 +1,171 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from datetime import date, datetime, timedelta
+
+from library_stats import UNCATEGORIZED
+from storage import LOCK_SUFFIX, FileLock
+
+# Kinds of reading events: a book was started, finished (marked read), or marked
+# unread again
+STARTED = "started"
+FINISHED = "finished"
+TOGGLED = "toggled"
+EVENT_KINDS = (STARTED, FINISHED, TOGGLED)
+
+# Periods the rollups are kept for
+PERIODS = ("day", "week", "month")
+
+# Most recent events kept in memory for display
+MAX_RECENT_EVENTS = 100
+
+
+# Function to get the bucket (a sortable label) `when` (a datetime) falls into for
+# `period`: "2024-05-17" for a day, the Monday "2024-05-13" for a week, "2024-05" for a month
+def bucket_of(period, when):
+    if period == "day":
+        return when.strftime("%Y-%m-%d")
+    if period == "week":
+        return (when.date() - timedelta(days=when.weekday())).isoformat()
+    if period == "month":
+        return when.strftime("%Y-%m")
+    raise ValueError(f"Unknown period: {period!r}")
+
+
+# Function to get the labels of the `count` buckets of `period` ending with the one
+# `when` falls into, oldest first
+def last_buckets(period, count, when=None):
+    when = when or datetime.now()
+    if period == "month":
+        months = when.year * 12 + when.month - 1
+        return [f"{month // 12:04d}-{month % 12 + 1:02d}" for month in range(months - count + 1, months + 1)]
+    step = timedelta(days=7 if period == "week" else 1)
+    last = date.fromisoformat(bucket_of(period, when))
+    return [(last - step * back).isoformat() for back in range(count - 1, -1, -1)]
+
+
+class ReadingRollups:
+    # Event counts per period bucket, kept up to date as events arrive, so activity
+    # over time is read off pre-aggregated buckets instead of replaying the log.
+    # For each period, every bucket maps (kind, genre) to a count, with a genre of
+    # None holding the count over all genres
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._buckets = {period: {} for period in PERIODS}
+
+    def add(self, event):
+        when = datetime.fromtimestamp(event["time"])
+        kind, genre = event["kind"], event.get("genre") or UNCATEGORIZED
+        for period in PERIODS:
+            counts = self._buckets[period].setdefault(bucket_of(period, when), {})
+            counts[kind, None] = counts.get((kind, None), 0) + 1
+            counts[kind, genre] = counts.get((kind, genre), 0) + 1
+
+    # (bucket, events) of `kind` per bucket of `period`, oldest first: every bucket
+    # with any event, or the last `count` buckets (empty ones included) if given;
+    # only events of one genre if given
+    def series(self, period, kind, genre=None, count=None, when=None):
+        buckets = self._buckets[period]
+        labels = sorted(buckets) if count is None else last_buckets(period, count, when)
+        return [(bucket, buckets.get(bucket, {}).get((kind, genre), 0)) for bucket in labels]
+
+    # (bucket, genre, events) of `kind` per bucket of `period` and genre, oldest first
+    def by_genre(self, period, kind):
+        rows = []
+        for bucket, counts in sorted(self._buckets[period].items()):
+            rows.extend((bucket, genre, count) for (event_kind, genre), count in counts.items()
+                        if event_kind == kind and genre is not None)
+        return rows
+
+    # {genre: average events of `kind` per period} over the last `count` buckets of
+    # `period`, the current one included
+    def velocity(self, period, kind, count, when=None):
+        totals = {}
+        for bucket in last_buckets(period, count, when):
+            for (event_kind, genre), events in self._buckets[period].get(bucket, {}).items():
+                if event_kind == kind and genre is not None:
+                    totals[genre] = totals.get(genre, 0) + events
+        return {genre: total / count for genre, total in sorted(totals.items(), key=lambda item: -item[1])}
+
+
+class ReadingHistory:
+    # Append-only log of reading events, one JSON line per event with its time, kind
+    # and the book's ID, title and genre at that moment, plus the rollups over it.
+    # Events are never edited or removed, so the log keeps what the read flag alone
+    # forgets. Several processes can append to the same file: appends are made under
+    # a file lock, after reading what the others wrote, and events other processes
+    # wrote are picked up by `refresh`
+    def __init__(self, path):
+        self.path = path
+        self.rollups = ReadingRollups()
+        self.count = 0
+        self._recent = deque(maxlen=MAX_RECENT_EVENTS)
+        self._offset = 0
+        self._lock = threading.Lock()
+        self._file_lock = FileLock(path + LOCK_SUFFIX)
+        self.refresh()
+
+    # Read events appended to the log since it was last read (all of them the first time)
+    def refresh(self):
+        with self._lock:
+            self._read_new()
+
+    def _read_new(self):
+        try:
+            file = open(self.path, "rb")
+        except FileNotFoundError:
+            return
+        with file:
+            file.seek(self._offset)
+            data = file.read()
+        # A torn final line is an append still in progress (or one that never finished)
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            if line.strip():
+                self._add(json.loads(line))
+        self._offset += end
+
+    def _add(self, event):
+        self.rollups.add(event)
+        self._recent.append(event)
+        self.count += 1
+
+    # Append an event of `kind` for `book` (at `when`, seconds since the epoch, or now). Returns the event
+    def record(self, kind, book, when=None):
+        return self.record_many([(kind, book)], when)[0]
+
+    # Append an event for every (kind, book) pair with a single write. Returns the events
+    def record_many(self, changes, when=None):
+        when = time.time() if when is None else when
+        events = []
+        for kind, book in changes:
+            if kind not in EVENT_KINDS:
+                raise ValueError(f"Unknown reading event: {kind!r}")
+            events.append({"time": when, "kind": kind, "book": book["id"], "title": book["title"],
+                           "genre": book["genre"]})
+        data = "".join(json.dumps(event) + "\n" for event in events).encode("utf-8")
+        with self._file_lock, self._lock:
+            # Take in other processes' events first; under the lock the file then ends
+            # where this history has read up to, so ours are not read back as theirs
+            self._read_new()
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                if os.fstat(fd).st_size > self._offset:
+                    # Only a writer that died mid-append leaves a torn line behind the lock
+                    os.ftruncate(fd, self._offset)
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+            self._offset += len(data)
+            for event in events:
+                self._add(event)
+        return events
+
+    # The most recent events, newest first
+    def recent(self, count=10):
+        with self._lock:
+            return list(self._recent)[::-1][:count]
@@ -0,0 +1,259 @@
+from collections import Counter
+from itertools import chain
+
+GRAM_SIZE = 3
+
+
+# Function to split a field value into lowercase search tokens
+def tokenize(text):
+    return str(text).lower().split()
+
+
+# Function to get the distinct character n-grams of a token
+def grams(token, size=GRAM_SIZE):
+    return {token[start:start + size] for start in range(len(token) - size + 1)}
+
+
+# Function to get how many typos a fuzzy search tolerates in `word` by default:
+# none under four letters, one up to seven letters and two beyond
+def default_max_distance(word):
+    if len(word) < 4:
+        return 0
+    return 1 if len(word) < 8 else 2
+
+
+# Function to get the optimal string alignment distance between `a` and `b`
+# (insertions, deletions, substitutions and swaps of adjacent letters each count
+# as one edit), or `limit + 1` once it is certain to exceed `limit`. A shared
+# prefix and suffix cost nothing and are cut off first, and only the cells within
+# `limit` of the diagonal can stay under the limit, so only those are computed
+def osa_distance(a, b, limit):
+    over = limit + 1
+    if abs(len(a) - len(b)) > limit:
+        return over
+    start = 0
+    while start < len(a) and start < len(b) and a[start] == b[start]:
+        start += 1
+    end = 0
+    while end < len(a) - start and end < len(b) - start and a[-1 - end] == b[-1 - end]:
+        end += 1
+    # Keep one shared letter on each side, it may take part in a swap
+    a = a[max(start - 1, 0):len(a) - max(end - 1, 0)]
+    b = b[max(start - 1, 0):len(b) - max(end - 1, 0)]
+    before_previous = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [over] * (len(b) + 1)
+        if i <= limit:
+            current[0] = i
+        letter = a[i - 1]
+        row_min = current[0]
+        for j in range(max(1, i - limit), min(len(b), i + limit) + 1):
+            if letter == b[j - 1]:
+                distance = previous[j - 1]
+            else:
+                distance = previous[j - 1] + 1
+                if previous[j] < distance - 1:
+                    distance = previous[j] + 1
+                if current[j - 1] < distance - 1:
+                    distance = current[j - 1] + 1
+                if i > 1 and j > 1 and letter == b[j - 2] and a[i - 2] == b[j - 1] \
+                        and before_previous[j - 2] < distance - 1:
+                    distance = before_previous[j - 2] + 1
+            current[j] = distance
+            if distance < row_min:
+                row_min = distance
+        if row_min > limit:
+            return over
+        before_previous, previous = previous, current
+    return previous[-1] if previous[-1] < over else over
+
+
+# Function to tell whether TextIndex has to walk most of the library to answer
+# `query`: words shorter than a trigram are matched by scanning the vocabulary,
+# and a query spanning several words is confirmed book by book
+def needs_full_scan(query):
+    query = str(query).lower()
+    words = query.split()
+    return len(words) != 1 or words[0] != query or len(query) < GRAM_SIZE
+
+
+# Function to add a book ID to the IDs kept under `key` in `postings`. Most keys
+# belong to a single book, kept as the bare ID instead of a set
+def add_posting(postings, key, book_id):
+    ids = postings.get(key)
+    if ids is None:
+        postings[key] = book_id
+    elif isinstance(ids, set):
+        ids.add(book_id)
+    else:
+        postings[key] = {ids, book_id}
+
+
+# Function to remove a book ID from the IDs kept under `key`, dropping the key with the last one
+def remove_posting(postings, key, book_id):
+    ids = postings.get(key)
+    if ids == book_id:
+        del postings[key]
+    elif isinstance(ids, set):
+        ids.discard(book_id)
+        if len(ids) == 1:
+            postings[key] = ids.pop()
+
+
+# Function to get the IDs kept under `key` (see add_posting) as a collection
+def posting_ids(postings, key):
+    ids = postings.get(key)
+    if ids is None:
+        return ()
+    return ids if isinstance(ids, set) else (ids,)
+
+
+class TextIndex:
+    # Inverted index over the tokens of one text field. Each token maps to the IDs
+    # of the books containing it (a bare ID for a token only one book has, which
+    # most tokens are), and each trigram maps to the tokens containing it, so
+    # substring queries only touch the tokens and books that can match
+    def __init__(self, field):
+        self.field = field
+        self._postings = {}
+        self._grams = {}
+        # Every character seen in a token, for generating one-edit neighbours
+        self._letters = set()
+
+    def add(self, book):
+        book_id = book["id"]
+        for token in set(tokenize(book[self.field])):
+            if token not in self._postings:
+                self._letters.update(token)
+                for gram in grams(token):
+                    self._grams.setdefault(gram, set()).add(token)
+            add_posting(self._postings, token, book_id)
+
+    def remove(self, book):
+        book_id = book["id"]
+        for token in set(tokenize(book[self.field])):
+            if token not in self._postings:
+                continue
+            remove_posting(self._postings, token, book_id)
+            if token not in self._postings:
+                for gram in grams(token):
+                    tokens = self._grams[gram]
+                    tokens.discard(token)
+                    if not tokens:
+                        del self._grams[gram]
+
+    def clear(self):
+        self._postings = {}
+        self._grams = {}
+        self._letters = set()
+
+    # Tokens containing `word` as a substring
+    def _matching_tokens(self, word):
+        if len(word) < GRAM_SIZE:
+            # Too short for a trigram; the vocabulary is still far smaller than the library
+            return [token for token in self._postings if word in token]
+        token_sets = []
+        for gram in grams(word):
+            tokens = self._grams.get(gram)
+            if not tokens:
+                return []
+            token_sets.append(tokens)
+        token_sets.sort(key=len)
+        return [token for token in token_sets[0].intersection(*token_sets[1:]) if word in token]
+
+    # IDs of the books whose field contains `query` (case-insensitive substring match).
+    # `books` is the ID-to-book dict, used to confirm matches that span several tokens
+    def search(self, query, books):
+        query = str(query).lower()
+        words = query.split()
+        if not words:
+            # Empty or whitespace-only queries have no tokens to look up
+            return {book_id for book_id, book in books.items() if query in str(book[self.field]).lower()}
+        word_sets = []
+        for word in words:
+            ids = set()
+            for token in self._matching_tokens(word):
+                ids.update(posting_ids(self._postings, token))
+            if not ids:
+                return set()
+            word_sets.append(ids)
+        word_sets.sort(key=len)
+        ids = word_sets[0].intersection(*word_sets[1:])
+        if len(words) == 1 and query == words[0]:
+            # A query without whitespace always falls inside a single token
+            return ids
+        return {book_id for book_id in ids if query in str(books[book_id][self.field]).lower()}
+
+    # Tokens one edit away from `word`, looked up directly: every deletion, swap,
+    # substitution and insertion of the word that is itself a token
+    def _neighbours(self, word):
+        variants = set()
+        for position in range(len(word) + 1):
+            head, tail = word[:position], word[position:]
+            if tail:
+                variants.add(head + tail[1:])
+                if len(tail) > 1:
+                    variants.add(head + tail[1] + tail[0] + tail[2:])
+            for letter in self._letters:
+                variants.add(head + letter + tail)
+                if tail:
+                    variants.add(head + letter + tail[1:])
+        variants.discard(word)
+        return {variant: 1 for variant in variants if variant in self._postings}
+
+    # Tokens within `max_distance` edits of `word`, as {token: distance}. One edit
+    # changes at most GRAM_SIZE + 1 trigrams (a swap), so a token has to share all
+    # but that many per edit of the word's trigrams. Words too short for that bound
+    # to rule anything out get their one-edit neighbours, so a single typo is always
+    # found, plus the tokens sharing a third of their trigrams. Each edit also adds or
+    # drops at most one distinct letter, which rules out most candidates before the
+    # exact distance is computed
+    def _similar_tokens(self, word, max_distance):
+        if max_distance == 0:
+            return {word: 0} if word in self._postings else {}
+        word_grams = grams(word)
+        needed = len(word_grams) - (GRAM_SIZE + 1) * max_distance
+        similar = {}
+        if needed < 1:
+            similar = self._neighbours(word)
+            needed = max(1, -(-len(word_grams) // 3))
+            if word in self._postings:
+                similar[word] = 0
+        counts = Counter(chain.from_iterable(self._grams.get(gram, ()) for gram in word_grams))
+        letters = set(word)
+        for token, count in counts.items():
+            if count < needed or token in similar or abs(len(token) - len(word)) > max_distance:
+                continue
+            token_letters = set(token)
+            if len(letters - token_letters) > max_distance or len(token_letters - letters) > max_distance:
+                continue
+            distance = osa_distance(word, token, max_distance)
+            if distance <= max_distance:
+                similar[token] = distance
+        return similar
+
+    # Typo-tolerant search: {book ID: edits} for the books having, for every word of
+    # `query`, a token within `max_distance` edits of it (default_max_distance per
+    # word when None). The edits are summed over the words, taking each word's
+    # closest token in the book
+    def fuzzy_search(self, query, max_distance=None):
+        totals = None
+        for word in tokenize(query):
+            limit = default_max_distance(word) if max_distance is None else max_distance
+            similar = self._similar_tokens(word, limit)
+            distances = {}
+            # Closest tokens first, so each book keeps its best distance
+            for token in sorted(similar, key=similar.__getitem__):
+                distances.update((book_id, similar[token]) for book_id in posting_ids(self._postings, token)
+                                 if book_id not in distances)
+            if totals is None:
+                totals = distances
+            else:
+                if len(distances) > len(totals):
+                    totals, distances = distances, totals
+                totals = {book_id: distance + totals[book_id]
+                          for book_id, distance in distances.items() if book_id in totals}
+            if not totals:
+                return {}
+        return totals or {}
@@ -0,0 +1,829 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import uuid
+
+try:
+    import fcntl
+except ImportError:
+    # Windows has no flock; msvcrt locks a byte range of the file instead
+    fcntl = None
+    import msvcrt
+
+# Suffix of the append-only mutation log kept next to the snapshot file
+JOURNAL_SUFFIX = ".log"
+
+# Suffix of the lock file every writing process holds while it appends or compacts
+LOCK_SUFFIX = ".lock"
+
+# Size of the mutation log (in bytes) after which it is folded into a new snapshot
+COMPACT_THRESHOLD = 4 * 1024 * 1024
+
+# Number of older snapshot generations kept next to the current one for recovery
+KEEP_GENERATIONS = 1
+
+# Characters read from a snapshot file at a time while streaming it
+READ_CHUNK_SIZE = 1024 * 1024
+
+# Books handed over per batch while streaming a library from disk
+LOAD_BATCH_SIZE = 5000
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+# Raised when a snapshot file is damaged or no usable generation is left
+class SnapshotError(Exception):
+    pass
+
+
+def _encode_books(books):
+    return json.dumps(books, separators=(",", ":"))
+
+
+def _checksum(body):
+    return "sha256:" + hashlib.sha256(body.encode("utf-8")).hexdigest()
+
+
+def _empty_header():
+    return {"generation": 0, "seq": 0, "previous_seq": 0}
+
+
+# Function to get the file name an older snapshot generation is kept under
+def generation_path(path, generation):
+    return f"{path}.gen{generation}"
+
+
+# Function to list the older snapshot generations on disk, newest first
+def list_generations(path):
+    directory = os.path.dirname(os.path.abspath(path))
+    prefix = os.path.basename(path) + ".gen"
+    generations = []
+    for name in os.listdir(directory):
+        suffix = name[len(prefix):]
+        if name.startswith(prefix) and suffix.isdigit():
+            generations.append(int(suffix))
+    return sorted(generations, reverse=True)
+
+
+# Function to tell whether a JSON library is kept at `path`: a snapshot, an older
+# generation or, for a library never compacted, only a log
+def library_exists(path):
+    return os.path.exists(path) or os.path.exists(path + JOURNAL_SUFFIX) or bool(list_generations(path))
+
+
+class _JsonReader:
+    # Decodes JSON values one at a time from a sliding window over a text file, so
+    # a large top-level array is never held in memory as a whole. Optionally hashes
+    # the exact text consumed between `start_hash` and `finish_hash`
+    def __init__(self, file):
+        self._file = file
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+        self._hasher = None
+        self._hash_from = 0
+        self.chars_read = 0
+
+    def _fill(self):
+        chunk = self._file.read(READ_CHUNK_SIZE)
+        if not chunk:
+            self._eof = True
+            return False
+        if self._hasher is not None:
+            self._hasher.update(self._buffer[self._hash_from:self._pos].encode("utf-8"))
+            self._hash_from = 0
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        self.chars_read += len(chunk)
+        return True
+
+    # Next non-whitespace character without consuming it, or "" at the end of the file
+    def peek(self):
+        while True:
+            self._pos = WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"expected {char!r} but found {found or 'end of file'!r} "
+                             f"at character {self.chars_read - len(self._buffer) + self._pos}")
+        self._pos += 1
+
+    # Decode the next JSON value
+    def value(self):
+        if self._pos >= len(self._buffer) or self._buffer[self._pos] in " \t\n\r":
+            self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # A number ending at the edge of the window may continue in the next chunk
+            if end == len(self._buffer) and self._fill():
+                continue
+            self._pos = end
+            return value
+
+    # Consume the "," before the next array item or the closing "]".
+    # Returns whether another item follows
+    def next_item(self):
+        # Snapshots are written without whitespace, so check the next character first
+        if self._pos < len(self._buffer) and self._buffer[self._pos] == ",":
+            self._pos += 1
+            return True
+        if self.peek() == ",":
+            self._pos += 1
+            return True
+        self.expect("]")
+        return False
+
+    # Decode array items starting at the current one: every item that ends inside
+    # the window in one json.loads call, cut at the last "},{" (snapshots are written
+    # without whitespace), or a single item when there is no cut or it falls inside
+    # a string or a nested value, which json.loads rejects. Returns the items and
+    # whether another item follows
+    def items(self):
+        cut = self._buffer.rfind("},{", self._pos)
+        if cut != -1:
+            try:
+                items = json.loads("[" + self._buffer[self._pos:cut + 1] + "]")
+            except json.JSONDecodeError:
+                items = None
+            if items:
+                self._pos = cut + 2
+                return items, True
+        return [self.value()], self.next_item()
+
+    def start_hash(self):
+        self.peek()
+        self._hasher = hashlib.sha256()
+        self._hash_from = self._pos
+
+    def finish_hash(self):
+        self._hasher.update(self._buffer[self._hash_from:self._pos].encode("utf-8"))
+        hasher, self._hasher = self._hasher, None
+        return "sha256:" + hasher.hexdigest()
+
+
+class SnapshotStream:
+    # One snapshot file read incrementally: `batches` yields its books a batch at a
+    # time and verifies the checksum once the whole array has gone by. `header` is
+    # complete when the header precedes the books, as `prepare_snapshot` writes it,
+    # and at the latest once `batches` is exhausted
+    def __init__(self, path):
+        self.path = path
+        self.header = _empty_header()
+        self.size = os.path.getsize(path)
+        self._reader = None
+
+    # Fraction of the file read so far
+    def progress(self):
+        if self._reader is None or not self.size:
+            return 0.0
+        return min(self._reader.chars_read / self.size, 1.0)
+
+    def batches(self, batch_size=LOAD_BATCH_SIZE):
+        with open(self.path, "r") as file:
+            reader = self._reader = _JsonReader(file)
+            # Plain lists are snapshots written before the journal existed
+            if reader.peek() == "[":
+                yield from self._read_books(reader, batch_size)
+                return
+            reader.expect("{")
+            found_books = False
+            while reader.peek() != "}":
+                key = reader.value()
+                reader.expect(":")
+                if key == "books":
+                    reader.start_hash()
+                    yield from self._read_books(reader, batch_size)
+                    checksum = reader.finish_hash()
+                    found_books = True
+                else:
+                    self.header[key] = reader.value()
+                if reader.peek() != ",":
+                    break
+                reader.expect(",")
+            reader.expect("}")
+        if not found_books:
+            raise KeyError("books")
+        # The checksum covers the books array exactly as it was written
+        if self.header.get("checksum") not in (None, checksum):
+            raise SnapshotError(f"checksum mismatch in {self.path}")
+
+    def _read_books(self, reader, batch_size):
+        reader.expect("[")
+        if reader.peek() == "]":
+            reader.expect("]")
+            return
+        batch = []
+        more = True
+        while more:
+            items, more = reader.items()
+            batch.extend(items)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+# Function to read only the header of a snapshot file (the fields written before the books)
+def read_header(path):
+    header = _empty_header()
+    with open(path, "r") as file:
+        reader = _JsonReader(file)
+        # Plain lists are snapshots written before the journal existed
+        if reader.peek() != "{":
+            return header
+        reader.expect("{")
+        while reader.peek() == '"':
+            key = reader.value()
+            reader.expect(":")
+            if key == "books":
+                break
+            header[key] = reader.value()
+            if reader.peek() != ",":
+                break
+            reader.expect(",")
+    return header
+
+
+def _fsync_directory(path):
+    # Directories cannot be opened for fsync on every platform (e.g. Windows)
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Function to write and fsync a snapshot to a temp file next to `path`, returning its name
+def prepare_snapshot(path, books, generation, seq, previous_seq):
+    body = _encode_books(books)
+    # The header goes before the books so it can be read without parsing the whole file
+    header = json.dumps({
+        "generation": generation,
+        "seq": seq,
+        "previous_seq": previous_seq,
+        "checksum": _checksum(body),
+    })
+    # One temp file per process, so writers in different processes never share one
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as file:
+        file.write(header[:-1] + ', "books": ' + body + "}")
+        file.flush()
+        os.fsync(file.fileno())
+    return tmp_path
+
+
+# Function to rename a prepared snapshot into place, keeping the current one as the
+# previous generation when `keep_current` is set and pruning older generations
+def install_snapshot(path, tmp_path, generation, keep_current=True):
+    if keep_current and os.path.exists(path):
+        backup_path = generation_path(path, generation - 1)
+        if os.path.exists(backup_path):
+            os.remove(backup_path)
+        try:
+            os.link(path, backup_path)
+        except OSError:
+            # Some filesystems have no hard links; a copy keeps the same guarantee
+            shutil.copyfile(path, backup_path)
+    os.replace(tmp_path, path)
+    _fsync_directory(path)
+    for old_generation in list_generations(path):
+        if old_generation < generation - KEEP_GENERATIONS:
+            os.remove(generation_path(path, old_generation))
+
+
+# Function to create a new persistent book ID
+def new_book_id():
+    return uuid.uuid4().hex
+
+
+# Function to give an ID to every book saved before IDs existed.
+# Returns whether any book had to be given one
+def assign_book_ids(books):
+    migrated = False
+    for book in books:
+        if not book.get("id"):
+            book["id"] = new_book_id()
+            migrated = True
+    return migrated
+
+
+# Function to apply a single log record to an ID-to-book dict
+def apply_record(library, record):
+    op = record["op"]
+    if op == "add":
+        book = record["book"]
+        library[book["id"]] = book
+    elif op == "add_many":
+        for book in record["books"]:
+            library[book["id"]] = book
+    elif op == "update":
+        book_id = record["id"]
+        if book_id in library:
+            library[book_id] = {**library[book_id], **record["fields"]}
+    elif op == "update_many":
+        for change in record["changes"]:
+            if change["id"] in library:
+                library[change["id"]] = {**library[change["id"]], **change["fields"]}
+    elif op == "remove":
+        for book_id in record["ids"]:
+            library.pop(book_id, None)
+    else:
+        raise ValueError(f"Unknown journal operation: {op}")
+
+
+# Function to get the IDs of the books a log record touches
+def record_book_ids(record):
+    op = record["op"]
+    if op == "add":
+        return [record["book"]["id"]]
+    if op == "add_many":
+        return [book["id"] for book in record["books"]]
+    if op == "update":
+        return [record["id"]]
+    if op == "update_many":
+        return [change["id"] for change in record["changes"]]
+    return list(record["ids"])
+
+
+# Function to get the books a log record touches as (book ID, changed fields)
+# pairs; the fields are None for anything but an update
+def record_changes(record):
+    op = record["op"]
+    if op == "update":
+        return [(record["id"], record["fields"])]
+    if op == "update_many":
+        return [(change["id"], change["fields"]) for change in record["changes"]]
+    return [(book_id, None) for book_id in record_book_ids(record)]
+
+
+class FileLock:
+    # Exclusive advisory lock on a file, shared by every process writing the library.
+    # Re-entrant within a process
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def __enter__(self):
+        self._lock.acquire()
+        if self._depth == 0:
+            try:
+                self._file = open(self.path, "a+b")
+                if fcntl is not None:
+                    fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+                else:
+                    self._file.seek(0)
+                    msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+            except BaseException:
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+                self._lock.release()
+                raise
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self._depth -= 1
+        if self._depth == 0:
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            else:
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+            self._file.close()
+            self._file = None
+        self._lock.release()
+        return False
+
+
+# Function to turn a log record written before book IDs existed into its ID-based form
+def _upgrade_record(library, record):
+    op = record["op"]
+    if op == "add" and not record["book"].get("id"):
+        record["book"]["id"] = new_book_id()
+    elif op == "update" and "index" in record:
+        record["id"] = list(library)[record.pop("index")]
+    elif op == "remove" and "indexes" in record:
+        ids = list(library)
+        record["ids"] = [ids[index] for index in record.pop("indexes")]
+    else:
+        return False
+    return True
+
+
+class LibraryJournal:
+    # Snapshot plus append-only log: mutations cost O(size of change), and the log
+    # is periodically folded into a fresh snapshot on a background thread.
+    # Several processes can share the files. Writers take the file lock only to
+    # append or install a snapshot: under it they first read what the others
+    # appended, then number their own records after it, so sequence numbers are
+    # global and every process can follow the log instead of reloading
+    def __init__(self, path, compact_threshold=COMPACT_THRESHOLD):
+        self.path = path
+        self.log_path = path + JOURNAL_SUFFIX
+        self.compact_threshold = compact_threshold
+        self.seq = 0
+        self.generation = 0
+        # Problems found with damaged snapshot generations during the last load
+        self.recovery_errors = []
+        # Set by `load` when books or log records without IDs were given one
+        self.migrated = False
+        # Fraction of the files read by the load in progress
+        self.load_progress = 0.0
+        self._lock = threading.RLock()
+        self._log_file = None
+        self._log_size = 0
+        # Appended records not written to the log yet (see `flush`)
+        self._pending = []
+        self._compaction = None
+        self._compact_lock = threading.Lock()
+        self._snapshot_seq = 0
+        self._previous_seq = 0
+        self._disk_state = None
+        self._file_lock = FileLock(path + LOCK_SUFFIX)
+        # Log file (by inode) and byte offset this journal has read up to
+        self._log_inode = None
+        self._log_offset = 0
+        # Set when records were folded into a snapshot before this journal read them
+        self._needs_reload = False
+
+    # Load the snapshot and replay every log record that is not folded into it yet.
+    # Returns an ordered ID-to-book dict
+    def load(self):
+        books = {}
+        for kind, payload in self.stream():
+            if kind == "reset":
+                books = {}
+            elif kind == "books":
+                books.update((book["id"], book) for book in payload)
+            else:
+                self.upgrade_record(books, payload)
+                apply_record(books, payload)
+        return books
+
+    # Stream the library from disk without parsing the snapshot in one go. Yields
+    # ("books", batch) for the snapshot's books, ("reset", None) when a damaged
+    # generation is abandoned part way and loading starts over from an older one,
+    # then ("record", record) for every log record not folded into the snapshot yet
+    def stream(self, batch_size=LOAD_BATCH_SIZE):
+        # The log may have been replaced since it was opened for appending
+        self.close()
+        with self._lock:
+            self.recovery_errors = []
+            self.migrated = False
+            self.load_progress = 0.0
+            self._needs_reload = False
+            self._log_inode = None
+            self._log_offset = 0
+        candidates = [self.path] + [generation_path(self.path, generation)
+                                    for generation in list_generations(self.path)]
+        header = None
+        for candidate in candidates:
+            if not os.path.exists(candidate):
+                continue
+            yielded = False
+            try:
+                snapshot = SnapshotStream(candidate)
+                for batch in snapshot.batches(batch_size):
+                    if assign_book_ids(batch):
+                        self.migrated = True
+                    self.load_progress = snapshot.progress()
+                    yielded = True
+                    yield "books", batch
+                header = snapshot.header
+                break
+            except (OSError, ValueError, KeyError, SnapshotError) as e:
+                self.recovery_errors.append(f"{candidate}: {e}")
+                self.migrated = False
+                if yielded:
+                    yield "reset", None
+        if header is None:
+            if self.recovery_errors:
+                if not self._log_holds_everything():
+                    raise SnapshotError("no valid snapshot generation left (" + "; ".join(self.recovery_errors) + ")")
+                # Until a second snapshot is written the log keeps every record from the
+                # first one on, so replaying it onto an empty library loses nothing
+                self.recovery_errors.append(f"{self.log_path}: rebuilt the library from the log")
+            header = _empty_header()
+        snapshot_seq = header["seq"]
+        with self._lock:
+            self.generation = header["generation"]
+            self.seq = self._snapshot_seq = snapshot_seq
+            self._previous_seq = header["previous_seq"]
+        for record in self._tail_log():
+            if record["seq"] <= snapshot_seq:
+                continue
+            self.seq = record["seq"]
+            yield "record", record
+        with self._lock:
+            self._log_size = os.path.getsize(self.log_path) if os.path.exists(self.log_path) else 0
+            self._disk_state = self._read_disk_state()
+            self.load_progress = 1.0
+
+    # Whether the log still starts at the first record ever written
+    def _log_holds_everything(self):
+        records = self._read_log()
+        first = next(records, None)
+        records.close()
+        return first is not None and first["seq"] == 1
+
+    # Bring a replayed log record written before book IDs existed to its ID-based
+    # form. `library` is the ID-to-book dict the records are being applied to
+    def upgrade_record(self, library, record):
+        if _upgrade_record(library, record):
+            self.migrated = True
+
+    def _read_disk_state(self):
+        state = []
+        for path in (self.path, self.log_path):
+            try:
+                stat = os.stat(path)
+                state.append((stat.st_ino, stat.st_size, stat.st_mtime_ns))
+            except FileNotFoundError:
+                state.append(None)
+        return state
+
+    # Whether the files were changed by someone other than this journal since it last touched them
+    def changed_on_disk(self):
+        # Our own compaction rewrites both files; that is not an outside change
+        if self._compact_lock.locked():
+            return False
+        with self._lock:
+            return self._read_disk_state() != self._disk_state
+
+    def _read_log(self):
+        if not os.path.exists(self.log_path):
+            return
+        with open(self.log_path, "r") as file:
+            for line in file:
+                if not line.endswith("\n"):
+                    # A torn final line means the process died mid-append; the record never committed
+                    break
+                yield json.loads(line)
+
+    # Records appended to the log since this journal last read it. When the log was
+    # replaced (by a compaction in any process) the new file is read from the top
+    def _tail_log(self):
+        try:
+            file = open(self.log_path, "rb")
+        except FileNotFoundError:
+            self._log_inode, self._log_offset = None, 0
+            return
+        with file:
+            inode = os.fstat(file.fileno()).st_ino
+            if inode != self._log_inode:
+                self._log_inode, self._log_offset = inode, 0
+            file.seek(self._log_offset)
+            for line in file:
+                if not line.endswith(b"\n"):
+                    # Torn, or still being written by another process
+                    break
+                self._log_offset += len(line)
+                yield json.loads(line)
+
+    def _read_disk_header(self):
+        try:
+            return read_header(self.path)
+        except FileNotFoundError:
+            return _empty_header()
+        except (OSError, ValueError):
+            # A damaged current file; loading falls back to an older generation
+            return _empty_header()
+
+    # Read the records other processes appended since this journal last looked.
+    # Returns them in order, or None when some were already folded into a newer
+    # snapshot and only a full reload can bring them back
+    def catch_up(self):
+        with self._lock:
+            if self._needs_reload:
+                return None
+            snapshot_state = self._disk_state[0] if self._disk_state else None
+            records = []
+            for record in self._tail_log():
+                if record["seq"] <= self.seq:
+                    continue
+                if record["seq"] != self.seq + 1:
+                    self._needs_reload = True
+                    return None
+                records.append(record)
+                self.seq = record["seq"]
+            disk_state = self._read_disk_state()
+            if disk_state[0] != snapshot_state:
+                header = self._read_disk_header()
+                if header["seq"] > self.seq:
+                    self._needs_reload = True
+                    return None
+                self.generation = header["generation"]
+                self._snapshot_seq = header["seq"]
+                self._previous_seq = header["previous_seq"]
+            self._disk_state = disk_state
+            return records
+
+    # Queued records, in the form they will be written (without sequence numbers)
+    def pending_records(self):
+        with self._lock:
+            return [{"op": op, **fields} for op, fields in self._pending]
+
+    def _open_log(self):
+        if self._log_file is not None:
+            try:
+                replaced = os.fstat(self._log_file.fileno()).st_ino != os.stat(self.log_path).st_ino
+            except FileNotFoundError:
+                replaced = True
+            if replaced:
+                # Another process compacted and swapped the log out from under us
+                self._log_file.close()
+                self._log_file = None
+        if self._log_file is None:
+            self._log_file = open(self.log_path, "a")
+        return self._log_file
+
+    # Sequence number of the newest record on disk and the byte offset where the log's
+    # complete lines end, found by reading the whole log
+    def _scan_disk(self):
+        seq = self._read_disk_header()["seq"]
+        end = 0
+        if os.path.exists(self.log_path):
+            with open(self.log_path, "rb") as file:
+                for line in file:
+                    if not line.endswith(b"\n"):
+                        break
+                    end += len(line)
+                    seq = max(seq, json.loads(line)["seq"])
+        return seq, end
+
+    # Queue one mutation record for the log; it is numbered and written by the next `flush`
+    def append(self, op, **fields):
+        with self._lock:
+            self._pending.append((op, fields))
+
+    # Write every queued record to the log in one go. Under the writers' file lock,
+    # records other processes appended first are read and the queued ones are
+    # numbered after them. Returns (the other processes' records that were read,
+    # the records written), both in log order
+    def flush(self):
+        with self._lock:
+            if not self._pending:
+                return [], []
+            with self._file_lock:
+                foreign = self.catch_up()
+                if foreign is None:
+                    # Behind a snapshot this journal never read: number after whatever is
+                    # on disk; the store reloads to pick the rest up
+                    self.seq, end = self._scan_disk()
+                    foreign = []
+                else:
+                    end = self._log_offset
+                if os.path.exists(self.log_path) and os.path.getsize(self.log_path) > end:
+                    # Only a writer that died mid-append leaves a torn line behind the lock
+                    os.truncate(self.log_path, end)
+                # Numbered from a local counter: `self.seq` only moves once the records
+                # are on disk, so a failed write leaves the next catch-up where it was
+                seq = self.seq
+                written = []
+                for op, fields in self._pending:
+                    seq += 1
+                    written.append({"seq": seq, "op": op, **fields})
+                data = "".join(json.dumps(record) + "\n" for record in written)
+                log_file = self._open_log()
+                try:
+                    log_file.write(data)
+                    log_file.flush()
+                    os.fsync(log_file.fileno())
+                except BaseException:
+                    # Drop whatever part of the records made it out, so no other
+                    # process reads them; the queue is written again on the next flush
+                    self._log_file = None
+                    try:
+                        log_file.close()
+                    except OSError:
+                        pass
+                    if os.path.exists(self.log_path):
+                        os.truncate(self.log_path, end)
+                    raise
+                self.seq = seq
+                self._pending = []
+                stat = os.fstat(log_file.fileno())
+                self._log_size = stat.st_size
+                if not self._needs_reload:
+                    self._log_inode, self._log_offset = stat.st_ino, stat.st_size
+                self._disk_state = self._read_disk_state()
+            return foreign, written
+
+    def needs_compaction(self):
+        return self._log_size >= self.compact_threshold
+
+    def is_compacting(self):
+        compaction = self._compaction
+        return compaction is not None and compaction.is_alive()
+
+    # Fold the log into a new snapshot of `library` once it has grown past the threshold
+    def maybe_compact(self, library):
+        if self.needs_compaction() and not self.is_compacting():
+            self.compact(library, background=True)
+
+    # Write `library` as the new snapshot and drop the log records it already contains
+    def compact(self, library, background=False):
+        with self._lock:
+            # Take the books under the lock so the snapshot matches the sequence number
+            # exactly. Books are replaced rather than edited, so references are enough;
+            # turning them into dicts and serializing happen outside of it. Queued
+            # records are already part of `library`; replaying them again later is harmless
+            books = list(library)
+            seq = self.seq
+        if not background:
+            self._write_compaction(books, seq)
+            return
+        # Not a daemon: the process waits for a snapshot being written before it exits
+        self._compaction = threading.Thread(
+            target=self._write_compaction, args=(books, seq), name="library-compaction"
+        )
+        self._compaction.start()
+
+    def _write_compaction(self, books, seq):
+        with self._compact_lock:
+            header = self._read_disk_header()
+            # A newer snapshot may have been written (by this or another process)
+            # while this one waited its turn
+            if seq < header["seq"]:
+                return
+            generation = max(self.generation, header["generation"]) + 1
+            # Book records know how to turn themselves into dicts, much faster than dict()
+            books = [book.to_dict() if hasattr(book, "to_dict") else book for book in books]
+            # Serialize outside the file lock; only the swap needs it
+            tmp_path = prepare_snapshot(self.path, books, generation, seq, header["seq"])
+            with self._lock, self._file_lock:
+                if self._read_disk_header() != header:
+                    # Another process installed a snapshot meanwhile; leave it be
+                    os.remove(tmp_path)
+                    return
+                # A damaged current file is not worth keeping as the previous generation
+                install_snapshot(self.path, tmp_path, generation, keep_current=not self.recovery_errors)
+                self.recovery_errors = []
+                self.generation = generation
+                self._previous_seq = header["seq"]
+                self._snapshot_seq = seq
+                # Records after the previous generation stay in the log, so falling back to
+                # that generation still replays every committed change
+                self._truncate_log(self._previous_seq)
+
+    def _truncate_log(self, seq):
+        with self._lock:
+            if not os.path.exists(self.log_path):
+                # Snapshot mode keeps no log; do not leave an empty one behind. The
+                # snapshot just installed is this journal's own write, not an outside change
+                self._disk_state = self._read_disk_state()
+                return
+            remaining = [record for record in self._read_log() if record["seq"] > seq]
+            if self._log_file is not None:
+                self._log_file.close()
+                self._log_file = None
+            tmp_path = f"{self.log_path}.tmp"
+            with open(tmp_path, "w") as file:
+                for record in remaining:
+                    file.write(json.dumps(record) + "\n")
+                # Durable before the swap, like a snapshot: the snapshot already on disk
+                # counts on the records after its previous generation being in the log
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, self.log_path)
+            _fsync_directory(self.log_path)
+            self._log_size = os.path.getsize(self.log_path)
+            # Other processes may have appended records this journal has not read yet;
+            # read the new log from the top on the next catch-up
+            self._log_inode = None
+            self._disk_state = None
+
+    # Time of the last write to the snapshot or log, or None if nothing was written yet
+    def last_modified(self):
+        times = [os.path.getmtime(path) for path in (self.path, self.log_path) if os.path.exists(path)]
+        return max(times) if times else None
+
+    def close(self):
+        compaction = self._compaction
+        if compaction is not None and compaction is not threading.current_thread():
+            compaction.join()
+        with self._lock:
+            self.flush()
+            if self._log_file is not None:
+                self._log_file.close()
+                self._log_file = None
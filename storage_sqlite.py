@@ -0,0 +1,237 @@
+import json
+import os
+import sqlite3
+import sys
+import threading
+
+from storage import LOAD_BATCH_SIZE, LibraryJournal
+
+# Book fields stored in their own columns; anything else goes in `extra` as JSON
+COLUMNS = ["id", "title", "author", "year", "genre", "read"]
+
+# Columns of a row as returned by _book_row
+ROW_COLUMNS = COLUMNS + ["extra"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS books (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    title TEXT NOT NULL,
+    author TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    genre TEXT NOT NULL DEFAULT '',
+    read INTEGER NOT NULL DEFAULT 0,
+    extra TEXT
+);
+"""
+
+# Insert a book, or overwrite the row that already has its ID unless it is unchanged
+UPSERT_SQL = (
+    "INSERT INTO books (id, title, author, year, genre, read, extra) VALUES (?, ?, ?, ?, ?, ?, ?) "
+    "ON CONFLICT (id) DO UPDATE SET title = excluded.title, author = excluded.author, "
+    "year = excluded.year, genre = excluded.genre, read = excluded.read, extra = excluded.extra "
+    "WHERE title IS NOT excluded.title OR author IS NOT excluded.author OR year IS NOT excluded.year "
+    "OR genre IS NOT excluded.genre OR read IS NOT excluded.read OR extra IS NOT excluded.extra"
+)
+
+
+# Function to split a book dict into column values and the JSON of any other fields
+def _book_row(book):
+    extra = {key: value for key, value in book.items() if key not in COLUMNS}
+    return (book["id"], book["title"], book["author"], int(book["year"]), book.get("genre") or "",
+            int(bool(book["read"])), json.dumps(extra) if extra else None)
+
+
+def _row_book(row):
+    book = {
+        "id": row["id"],
+        "title": row["title"],
+        "author": row["author"],
+        "year": row["year"],
+        "genre": row["genre"],
+        "read": bool(row["read"]),
+    }
+    if row["extra"]:
+        book.update(json.loads(row["extra"]))
+    return book
+
+
+class SQLiteStorage:
+    # SQLite storage backend, a drop-in alternative to the JSON journal. Every
+    # change is a single-row (or single-statement) transaction; the database runs
+    # in WAL mode so other processes can read while one writes
+    def __init__(self, path):
+        self.path = path
+        self.generation = 0
+        self.recovery_errors = []
+        self.migrated = False
+        # Fraction of the books read by the load in progress
+        self.load_progress = 0.0
+        self._lock = threading.RLock()
+        # Appended changes not committed yet (see `flush`)
+        self._pending = []
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(SCHEMA)
+        self._data_version = None
+
+    def _read_data_version(self):
+        return self._connection.execute("PRAGMA data_version").fetchone()[0]
+
+    # Read every book into an ordered ID-to-book dict
+    def load(self):
+        return {book["id"]: book for _, batch in self.stream() for book in batch}
+
+    # Stream every book in batches, as ("books", batch) pairs like LibraryJournal.stream
+    def stream(self, batch_size=LOAD_BATCH_SIZE):
+        with self._lock:
+            self.load_progress = 0.0
+            # Taken first so changes committed while the rows are read still count as changes
+            self._data_version = self._read_data_version()
+            total = self._connection.execute("SELECT COUNT(*) FROM books").fetchone()[0]
+        loaded = 0
+        batch = []
+        for book in self.iter_books(batch_size):
+            batch.append(book)
+            if len(batch) >= batch_size:
+                loaded += len(batch)
+                # The table may have been emptied by another connection since it was counted
+                self.load_progress = min(loaded / total, 1.0) if total else 1.0
+                yield "books", batch
+                batch = []
+        if batch:
+            yield "books", batch
+        self.load_progress = 1.0
+
+    # Whether another connection has committed changes since the last load
+    def changed_on_disk(self):
+        with self._lock:
+            return self._read_data_version() != self._data_version
+
+    # SQLite keeps no change log to follow; changes by other connections mean a reload
+    def catch_up(self):
+        return None
+
+    def pending_records(self):
+        with self._lock:
+            return [{"op": op, **fields} for op, fields in self._pending]
+
+    # Queue one mutation (same operations as the JSON journal); it is committed by the next `flush`
+    def append(self, op, **fields):
+        if op not in ("add", "add_many", "update", "update_many", "remove"):
+            raise ValueError(f"Unknown storage operation: {op}")
+        with self._lock:
+            self._pending.append((op, fields))
+
+    # Commit every queued change in a single transaction. Updates only overwrite the
+    # fields they change, so changes by other connections to other fields survive.
+    # Returns (other writers' changes that were read, changes written) like LibraryJournal.flush;
+    # other writers' changes are picked up by a reload instead
+    def flush(self):
+        with self._lock:
+            if not self._pending:
+                return [], []
+            with self._connection:
+                for op, fields in self._pending:
+                    self._apply(op, fields)
+            written = [{"op": op, **fields} for op, fields in self._pending]
+            self._pending = []
+            return [], written
+
+    def _apply(self, op, fields):
+        if op == "add":
+            self._connection.execute(UPSERT_SQL, _book_row(fields["book"]))
+        elif op == "add_many":
+            self._connection.executemany(UPSERT_SQL, [_book_row(book) for book in fields["books"]])
+        elif op == "update":
+            self._update(fields["id"], fields["fields"])
+        elif op == "update_many":
+            for change in fields["changes"]:
+                self._update(change["id"], change["fields"])
+        elif op == "remove":
+            self._connection.executemany("DELETE FROM books WHERE id = ?",
+                                         [(book_id,) for book_id in fields["ids"]])
+
+    def _update(self, book_id, fields):
+        row = self._connection.execute("SELECT * FROM books WHERE id = ?", (book_id,)).fetchone()
+        if row is None:
+            return
+        current = _row_book(row)
+        # Only the columns that change are written
+        changed = [(column, value) for column, value, old in
+                   zip(ROW_COLUMNS, _book_row({**current, **fields}), _book_row(current))
+                   if value != old and column != "id"]
+        if not changed:
+            return
+        self._connection.execute(
+            f"UPDATE books SET {', '.join(f'{column} = ?' for column, _ in changed)} WHERE id = ?",
+            [value for _, value in changed] + [book_id])
+
+    # Every change is already durable; nothing needs folding
+    def maybe_compact(self, library):
+        pass
+
+    # Make sure the database holds exactly `library`, then fold the WAL into the main file
+    def compact(self, library, background=False):
+        with self._lock:
+            # Syncing the whole library supersedes any queued changes
+            self._pending = []
+            with self._connection:
+                rows = [_book_row(book) for book in library]
+                self._connection.execute("CREATE TEMP TABLE IF NOT EXISTS keep_ids (id TEXT PRIMARY KEY)")
+                self._connection.execute("DELETE FROM keep_ids")
+                self._connection.executemany("INSERT OR IGNORE INTO keep_ids VALUES (?)", [row[:1] for row in rows])
+                self._connection.execute("DELETE FROM books WHERE id NOT IN (SELECT id FROM keep_ids)")
+                self._connection.executemany(UPSERT_SQL, rows)
+            self._connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    # Time of the last write to the database files, or None if nothing was written yet
+    def last_modified(self):
+        times = [os.path.getmtime(path) for path in (self.path, self.path + "-wal") if os.path.exists(path)]
+        return max(times) if times else None
+
+    # Stream every book in insertion order without holding them all in memory
+    def iter_books(self, batch_size=1000):
+        with self._lock:
+            cursor = self._connection.execute("SELECT * FROM books ORDER BY seq")
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            for row in rows:
+                yield _row_book(row)
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            self._connection.close()
+
+
+# Function to copy a JSON library (snapshot plus journal) into a SQLite database.
+# Returns the number of books migrated
+def migrate_json_to_sqlite(json_path, db_path):
+    journal = LibraryJournal(json_path)
+    books = journal.load()
+    journal.close()
+    # Filled under a temporary name and moved into place once complete, so a failed
+    # migration leaves no empty database behind to be taken for the library
+    tmp_path = f"{db_path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    storage = SQLiteStorage(tmp_path)
+    try:
+        storage.compact(books.values())
+    finally:
+        storage.close()
+    os.replace(tmp_path, db_path)
+    return len(books)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit("usage: python storage_sqlite.py LIBRARY_JSON LIBRARY_DB")
+    count = migrate_json_to_sqlite(sys.argv[1], sys.argv[2])
+    print(f"Migrated {count} books from {sys.argv[1]} to {sys.argv[2]}")
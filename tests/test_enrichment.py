@@ -0,0 +1,151 @@
+import threading
+import time
+
+import enrichment
+from enrichment import EnrichmentPipeline, MetadataProvider, ProviderError, ResponseCache, lookup_key
+from library_store import LibraryStore, make_book
+from storage import LibraryJournal
+
+# Seconds a test waits for a run to finish before it gives up
+TIMEOUT = 60
+
+
+class FakeProvider(MetadataProvider):
+    # Answers every key with a genre after failing the first `failures` calls,
+    # keeping the keys of every call and the most calls that ran at once
+    name = "fake"
+
+    def __init__(self, failures=0, batch_size=50, max_concurrency=4, delay=0):
+        self.failures = failures
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.delay = delay
+        self.calls = []
+        self.running = 0
+        self.most_running = 0
+        self._lock = threading.Lock()
+
+    def lookup(self, keys):
+        with self._lock:
+            self.calls.append(list(keys))
+            self.running += 1
+            self.most_running = max(self.most_running, self.running)
+            fail = self.failures > 0
+            self.failures -= 1
+        try:
+            time.sleep(self.delay)
+            if fail:
+                raise ProviderError("rate limited")
+            return {key: {"genre": "Fantasy"} for key in keys}
+        finally:
+            with self._lock:
+                self.running -= 1
+
+
+class RecordingEvent(threading.Event):
+    # Cancel event that keeps the timeout of every wait instead of sleeping
+    def __init__(self):
+        super().__init__()
+        self.waits = []
+
+    def wait(self, timeout=None):
+        self.waits.append(timeout)
+        return self.is_set()
+
+
+def open_store(path, count):
+    store = LibraryStore(LibraryJournal(str(path)))
+    store.load()
+    store.add_many([make_book(f"Book {number}", "Author", 2000, "", False) for number in range(count)])
+    return store
+
+
+def run(pipeline):
+    pipeline.start()
+    assert pipeline.wait(TIMEOUT)
+    return pipeline
+
+
+# A batch failing with ProviderError is retried after exponentially growing delays
+def test_failing_batch_is_retried_with_backoff(tmp_path, monkeypatch):
+    store = open_store(tmp_path / "library.json", 3)
+    provider = FakeProvider(failures=2)
+    pipeline = EnrichmentPipeline(store, provider, backoff=0.5)
+    pipeline._cancel = RecordingEvent()
+    monkeypatch.setattr(enrichment.random, "uniform", lambda low, high: low)
+    run(pipeline)
+    assert len(provider.calls) == 3
+    assert pipeline._cancel.waits == [0.5, 1.0]
+    assert (pipeline.enriched, pipeline.failed, pipeline.last_error) == (3, 0, None)
+    assert {book["genre"] for book in store.view()} == {"Fantasy"}
+    store.backend.close()
+
+
+# A batch still failing after max_retries is counted as failed and leaves its books alone
+def test_batch_is_given_up_after_max_retries(tmp_path):
+    store = open_store(tmp_path / "library.json", 3)
+    provider = FakeProvider(failures=10)
+    pipeline = EnrichmentPipeline(store, provider, max_retries=2, backoff=0)
+    run(pipeline)
+    assert len(provider.calls) == 3
+    assert (pipeline.enriched, pipeline.failed) == (0, 3)
+    assert isinstance(pipeline.last_error, ProviderError)
+    assert {book["genre"] for book in store.view()} == {""}
+    store.backend.close()
+
+
+# Cached answers are used until they are `ttl` seconds old, then looked up again
+def test_cached_answers_expire_after_ttl(tmp_path, monkeypatch):
+    cache = ResponseCache(str(tmp_path / "cache.db"), ttl=100)
+    now = time.time()
+    monkeypatch.setattr(enrichment.time, "time", lambda: now)
+    cache.put_many("fake", {("dune", "frank herbert"): {"genre": "SF"}, ("emma", "jane austen"): None})
+    keys = [("dune", "frank herbert"), ("emma", "jane austen"), ("ulysses", "james joyce")]
+    assert cache.get_many("fake", keys) == {("dune", "frank herbert"): {"genre": "SF"},
+                                            ("emma", "jane austen"): None}
+    assert cache.get_many("other", keys) == {}
+    monkeypatch.setattr(enrichment.time, "time", lambda: now + 101)
+    assert cache.get_many("fake", keys) == {}
+    assert cache.purge() == 2
+    cache.close()
+
+
+# A run answers what the cache still holds and only asks the provider for the rest
+def test_run_asks_the_provider_only_for_uncached_keys(tmp_path):
+    store = open_store(tmp_path / "library.json", 4)
+    cache = ResponseCache(str(tmp_path / "cache.db"))
+    cached = lookup_key(make_book("Book 0", "Author", 2000, "", False))
+    cache.put_many("fake", {cached: {"genre": "Poetry"}})
+    provider = FakeProvider()
+    run(EnrichmentPipeline(store, provider, cache))
+    assert sorted(key for call in provider.calls for key in call) == sorted(
+        lookup_key(book) for book in store.view() if book["title"] != "Book 0")
+    assert sorted(book["genre"] for book in store.view()) == ["Fantasy"] * 3 + ["Poetry"]
+    cache.close()
+    store.backend.close()
+
+
+# Lookups get at most the provider's batch_size keys, and no more than its
+# max_concurrency of them run at once, however many workers were asked for
+def test_lookups_respect_batch_size_and_max_concurrency(tmp_path):
+    store = open_store(tmp_path / "library.json", 95)
+    provider = FakeProvider(batch_size=10, max_concurrency=2, delay=0.02)
+    pipeline = run(EnrichmentPipeline(store, provider, workers=8))
+    assert pipeline.workers == 2
+    assert sorted(len(keys) for keys in provider.calls) == [5] + [10] * 9
+    assert provider.most_running <= 2
+    assert pipeline.enriched == 95
+    store.backend.close()
+
+
+# Answers are written back with one update_many call per write_batch_size books
+def test_one_update_many_per_thousand_books(tmp_path, monkeypatch):
+    store = open_store(tmp_path / "library.json", 2500)
+    writes = []
+    update_many = store.update_many
+    monkeypatch.setattr(store, "update_many", lambda changes: writes.append(len(changes)) or update_many(changes))
+    pipeline = run(EnrichmentPipeline(store, FakeProvider(batch_size=500)))
+    assert pipeline.write_batch_size == 1000
+    assert writes == [1000, 1000, 500]
+    assert pipeline.enriched == 2500
+    store.backend.close()
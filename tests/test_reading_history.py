@@ -0,0 +1,41 @@
+import multiprocessing
+
+from reading_history import FINISHED, STARTED, ReadingHistory
+
+EVENTS_PER_PROCESS = 1000
+
+# Seconds a writer waits for the other one before the test gives up
+TIMEOUT = 60
+
+
+def record_events(path, name, start, done, counts):
+    history = ReadingHistory(path)
+    start.wait(TIMEOUT)
+    for number in range(EVENTS_PER_PROCESS):
+        # Titles of different lengths, so a misread offset lands mid-line
+        book = {"id": f"{name}-{number}", "title": name * (number % 7 + 1), "genre": name}
+        history.record(FINISHED if number % 2 else STARTED, book)
+    # Read the other process's events once it has written them all
+    done.wait(TIMEOUT)
+    history.refresh()
+    counts[name] = history.count
+
+
+# Two processes appending to one log at once: each reads every event exactly once
+def test_two_processes_append_without_losing_or_repeating_events(tmp_path):
+    path = str(tmp_path / "reading_history.jsonl")
+    start, done = multiprocessing.Barrier(2), multiprocessing.Barrier(2)
+    counts = multiprocessing.Manager().dict()
+    writers = [multiprocessing.Process(target=record_events, args=(path, name, start, done, counts), daemon=True)
+               for name in ("a", "b")]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join(TIMEOUT)
+        assert writer.exitcode == 0
+    total = 2 * EVENTS_PER_PROCESS
+    assert dict(counts) == {"a": total, "b": total}
+    history = ReadingHistory(path)
+    assert history.count == total
+    assert sum(count for _, count in history.rollups.series("day", FINISHED)) == total // 2
+    assert sum(count for _, _, count in history.rollups.by_genre("day", STARTED)) == total // 2
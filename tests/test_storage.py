@@ -0,0 +1,150 @@
+import json
+import os
+import threading
+
+import pytest
+
+from library_store import LibraryStore, make_book
+from storage import LibraryJournal, generation_path
+
+
+class FailingLog:
+    # Log file whose next write fails, as on a full disk
+    def __init__(self, file):
+        self._file = file
+
+    def write(self, data):
+        raise OSError("No space left on device")
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+def open_store(path):
+    store = LibraryStore(LibraryJournal(str(path)))
+    store.load()
+    return store
+
+
+def titles(store):
+    return sorted(book["title"] for book in store.view())
+
+
+# A flush that fails must not move the journal's sequence number, or records
+# another process writes before the retry are skipped and lost by the next compaction
+def test_failed_flush_keeps_other_writers_records(tmp_path, monkeypatch):
+    path = tmp_path / "library.json"
+    first, second = open_store(path), open_store(path)
+    first.add(make_book("A0", "Author", 2000, "", False))
+    second.refresh_if_stale()
+
+    open_log = first.backend._open_log
+    monkeypatch.setattr(first.backend, "_open_log", lambda: FailingLog(open_log()))
+    with pytest.raises(OSError):
+        first.add(make_book("A1", "Author", 2001, "", False))
+    monkeypatch.undo()
+
+    second.add(make_book("B1", "Author", 2002, "", False))
+    # The retry picks up B1 before writing A1, and the snapshot keeps both
+    first.flush()
+    first.save()
+    assert titles(first) == ["A0", "A1", "B1"]
+    assert titles(open_store(path)) == ["A0", "A1", "B1"]
+    second.refresh_if_stale()
+    assert titles(second) == ["A0", "A1", "B1"]
+    for store in (first, second):
+        store.backend.close()
+
+
+# A snapshot failing its checksum is skipped for the previous generation, and the
+# log still holds every record written after that one
+def test_damaged_snapshot_falls_back_to_older_generation(tmp_path):
+    path = tmp_path / "library.json"
+    store = open_store(path)
+    store.add(make_book("A0", "Author", 2000, "", False))
+    store.save()
+    store.add(make_book("A1", "Author", 2001, "", False))
+    store.save()
+    store.add(make_book("A2", "Author", 2002, "", False))
+    store.backend.close()
+    assert os.path.exists(generation_path(str(path), 1))
+
+    text = path.read_text()
+    path.write_text(text.replace('"title":"A1"', '"title":"XX"'))
+    reopened = open_store(path)
+    assert titles(reopened) == ["A0", "A1", "A2"]
+    assert "checksum mismatch" in reopened.backend.recovery_errors[0]
+    reopened.backend.close()
+
+
+# Records in the log are replayed over the snapshot in order; a torn last line,
+# left by a process that died mid-append, is ignored
+def test_log_is_replayed_over_the_snapshot(tmp_path):
+    path = tmp_path / "library.json"
+    store = open_store(path)
+    first = store.add(make_book("A0", "Author", 2000, "", False))
+    second = store.add(make_book("A1", "Author", 2001, "", False))
+    store.save()
+    store.update(first["id"], {"read": True})
+    store.remove([second["id"]])
+    store.add_many([make_book("A2", "Author", 2002, "", False), make_book("A3", "Author", 2003, "", False)])
+    store.backend.close()
+    with open(f"{path}.log", "a") as log:
+        log.write('{"seq": 99, "op": "remove", "ids": ["')
+
+    reopened = open_store(path)
+    assert titles(reopened) == ["A0", "A2", "A3"]
+    assert reopened.view().get(first["id"])["read"] is True
+    reopened.backend.close()
+
+
+# A library written before books had IDs (a snapshot without them, and log records
+# pointing at books by position) gets IDs on load, and keeps them from then on
+def test_books_and_records_without_ids_are_migrated(tmp_path):
+    path = tmp_path / "library.json"
+    books = [{"title": f"A{number}", "author": "Author", "year": 2000 + number, "genre": "", "read": False}
+             for number in range(3)]
+    path.write_text(json.dumps({"seq": 1, "books": books}))
+    records = [
+        {"seq": 1, "op": "add", "book": {"title": "old", "author": "Author", "year": 1999, "genre": "", "read": False}},
+        {"seq": 2, "op": "update", "index": 0, "fields": {"read": True}},
+        {"seq": 3, "op": "remove", "indexes": [1]},
+        {"seq": 4, "op": "add", "book": {"title": "A3", "author": "Author", "year": 2003, "genre": "", "read": False}},
+    ]
+    (tmp_path / "library.json.log").write_text("".join(json.dumps(record) + "\n" for record in records))
+
+    store = open_store(path)
+    assert titles(store) == ["A0", "A2", "A3"]
+    assert [book["title"] for book in store.view() if book["read"]] == ["A0"]
+    ids = {book["title"]: book["id"] for book in store.view()}
+    assert all(ids.values())
+    store.backend.close()
+    assert all(book.get("id") for book in json.loads(path.read_text())["books"])
+    reopened = open_store(path)
+    assert {book["title"]: book["id"] for book in reopened.view()} == ids
+    reopened.backend.close()
+
+
+# Compactions in one process while another keeps appending lose none of its records
+def test_compaction_while_another_writer_appends(tmp_path):
+    path = tmp_path / "library.json"
+    compacting, writing = open_store(path), open_store(path)
+    expected = [f"B{number:03d}" for number in range(200)]
+
+    def write():
+        for title in expected:
+            writing.add(make_book(title, "Author", 2000, "", False))
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    while writer.is_alive():
+        compacting.refresh_if_stale()
+        compacting.save()
+    writer.join()
+    compacting.save()
+
+    assert titles(open_store(path)) == expected
+    compacting.refresh_if_stale()
+    assert titles(compacting) == expected
+    for store in (compacting, writing):
+        store.backend.close()